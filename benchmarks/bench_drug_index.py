@@ -0,0 +1,63 @@
+"""
+Micro-benchmark du référentiel médicaments (services/drug_index.py).
+
+Mesure le chargement de l'index puis la recherche de noms exacts et de noms
+bruités comme en sortie d'OCR (lettres confondues, accents perdus, suffixes).
+
+    python -m benchmarks.bench_drug_index [--repeat 2000] [--reference CIS_bdpm.txt]
+"""
+import argparse
+import random
+import time
+
+from services.drug_index import DrugIndex, DEFAULT_REFERENCE_FILE
+
+# Confusions typiques de tesseract sur des majuscules
+_OCR_NOISE = {"O": "Q", "I": "l", "E": "F", "C": "G", "A": "4", "S": "5", "B": "8", "N": "M"}
+
+
+def _noisy(name: str, rng: random.Random) -> str:
+    chars = list(name.upper())
+    positions = [i for i, c in enumerate(chars) if c in _OCR_NOISE]
+    if positions:
+        i = rng.choice(positions)
+        chars[i] = _OCR_NOISE[chars[i]]
+    return "".join(chars)
+
+
+def _bench(index: DrugIndex, names, repeat: int) -> float:
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        for name in names:
+            index.lookup(name)
+    return time.perf_counter() - t0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=2000)
+    parser.add_argument("--reference", default=DEFAULT_REFERENCE_FILE)
+    args = parser.parse_args(argv)
+
+    t0 = time.perf_counter()
+    index = DrugIndex.from_file(args.reference)
+    print(f"Index : {len(index)} entrées chargées en {(time.perf_counter() - t0) * 1e3:.1f} ms")
+
+    rng = random.Random(0)
+    exact = [e.nom for e in rng.sample(index._entries, min(50, len(index)))]
+    noisy = [_noisy(n, rng) for n in exact]
+    for label, names in (("exacts", exact), ("bruités", noisy)):
+        elapsed = _bench(index, names, args.repeat)
+        total = len(names) * args.repeat
+        matches = [index.lookup(n) for n in names]
+        hits = sum(m is not None and m.entry.nom == ref for m, ref in zip(matches, exact))
+        print(f"{label:>8} : {elapsed / total * 1e6:6.1f} µs/recherche  {hits}/{len(names)} retrouvés")
+
+    print("\nExemples :")
+    for raw in noisy[:8]:
+        match = index.lookup(raw)
+        print(f"  {raw:<28} → " + (f"{match.entry.nom} ({match.score:.2f})" if match else "-"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""
+Benchmark OCR avant / après prétraitement (services/ocr_preprocess.py).
+
+Pour chaque échantillon : temps de prétraitement + OCR, similarité du texte
+reconnu avec le texte attendu, et part des médicaments attendus (nom +
+fréquence) retrouvés par le parseur.
+
+Échantillons : --samples DIR contenant des photos (jpg/png) et, pour chacune,
+un fichier <nom>.txt avec le texte de l'ordonnance. Sans --samples, des photos
+synthétiques sont générées à partir de benchmarks/data/ordonnances_ocr.txt
+(papier teinté, éclairage inégal, bruit, rotation de quelques degrés, 12 Mpx).
+
+    python -m benchmarks.bench_ocr_preprocess [--samples DIR] [--lang fra]
+
+Nécessite pytesseract et le binaire tesseract.
+"""
+import argparse
+import difflib
+import glob
+import os
+import random
+import sys
+import time
+from io import BytesIO
+
+from PIL import Image, ImageDraw, ImageFont
+
+from services.ocr_preprocess import preprocess_for_ocr
+from services.ordo_extract import _parse_meds_from_text
+
+CORPUS = os.path.join(os.path.dirname(__file__), "data", "ordonnances_ocr.txt")
+
+
+def _synthetic_photo(text: str, rng: random.Random) -> bytes:
+    """Rend le texte sur une page A4 à 300 dpi puis la dégrade comme une photo de téléphone."""
+    page = Image.new("RGB", (2480, 3508), (rng.randint(225, 245), rng.randint(215, 235), rng.randint(190, 215)))
+    draw = ImageDraw.Draw(page)
+    try:
+        font = ImageFont.load_default(size=46)
+    except TypeError:  # Pillow < 10.1
+        font = ImageFont.load_default()
+    y = 200
+    for line in text.splitlines():
+        draw.text((180, y), line, fill=(rng.randint(20, 60), rng.randint(20, 60), rng.randint(60, 110)), font=font)
+        y += 70
+
+    import numpy as np
+    arr = np.asarray(page, dtype=np.float32)
+    h, w = arr.shape[:2]
+    # éclairage inégal (dégradé diagonal) + bruit de capteur
+    light = np.linspace(0.75, 1.05, w)[None, :] * np.linspace(0.85, 1.0, h)[:, None]
+    arr = arr * light[..., None] + np.random.default_rng(rng.randint(0, 10**6)).normal(0, 8, arr.shape)
+    photo = Image.fromarray(np.clip(arr, 0, 255).astype(np.uint8))
+    photo = photo.rotate(rng.uniform(-6, 6), resample=Image.Resampling.BICUBIC, expand=True, fillcolor=(90, 80, 70))
+    photo = photo.resize((3000, round(3000 * photo.height / photo.width)), Image.Resampling.BICUBIC)
+
+    buf = BytesIO()
+    photo.save(buf, format="JPEG", quality=85)
+    return buf.getvalue()
+
+
+def _load_samples(directory):
+    if directory:
+        for path in sorted(glob.glob(os.path.join(directory, "*"))):
+            if os.path.splitext(path)[1].lower() not in {".jpg", ".jpeg", ".png"}:
+                continue
+            truth = os.path.splitext(path)[0] + ".txt"
+            if not os.path.exists(truth):
+                continue
+            with open(path, "rb") as f, open(truth, encoding="utf-8") as t:
+                yield os.path.basename(path), f.read(), t.read()
+        return
+    rng = random.Random(42)
+    with open(CORPUS, encoding="utf-8") as f:
+        docs = [d.strip() for d in f.read().split("=====") if d.strip()]
+    for i, doc in enumerate(docs):
+        yield f"synthetique_{i}", _synthetic_photo(doc, rng), doc
+
+
+def _med_keys(text: str):
+    return {(m.nom.lower(), m.frequence) for m in _parse_meds_from_text(text)}
+
+
+def _run(image_bytes: bytes, truth: str, preprocess: bool, lang: str):
+    import pytesseract
+
+    t0 = time.perf_counter()
+    img = Image.open(BytesIO(image_bytes))
+    img = preprocess_for_ocr(img) if preprocess else img
+    t1 = time.perf_counter()
+    text = pytesseract.image_to_string(img, lang=lang)
+    t2 = time.perf_counter()
+
+    expected = _med_keys(truth)
+    found = _med_keys(text)
+    recall = len(expected & found) / len(expected) if expected else 1.0
+    similarity = difflib.SequenceMatcher(None, " ".join(truth.split()), " ".join(text.split())).ratio()
+    return t1 - t0, t2 - t1, similarity, recall
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--samples", help="dossier d'images + <nom>.txt")
+    parser.add_argument("--lang", default=os.getenv("OCR_LANG", "fra"))
+    args = parser.parse_args(argv)
+
+    try:
+        import pytesseract
+        pytesseract.get_tesseract_version()
+    except Exception as e:
+        print(f"tesseract indisponible : {e}")
+        sys.exit(1)
+
+    totals = {False: [0.0, 0.0, 0.0, 0.0], True: [0.0, 0.0, 0.0, 0.0]}
+    n = 0
+    print(f"{'échantillon':<18} {'mode':<8} {'prétrait.':>9} {'OCR':>8} {'texte':>7} {'médic.':>7}")
+    for name, image_bytes, truth in _load_samples(args.samples):
+        n += 1
+        for preprocess in (False, True):
+            result = _run(image_bytes, truth, preprocess, args.lang)
+            totals[preprocess] = [a + b for a, b in zip(totals[preprocess], result)]
+            prep, ocr, sim, recall = result
+            mode = "prétrait" if preprocess else "brut"
+            print(f"{name:<18} {mode:<8} {prep * 1000:>7.0f}ms {ocr:>7.2f}s {sim:>7.1%} {recall:>7.1%}")
+
+    if not n:
+        print("Aucun échantillon.")
+        return
+    print("\nMoyennes :")
+    for preprocess in (False, True):
+        prep, ocr, sim, recall = (v / n for v in totals[preprocess])
+        mode = "prétraité" if preprocess else "brut"
+        print(f"  {mode:<9} : {prep + ocr:.2f}s / image (dont {prep * 1000:.0f}ms de prétraitement), "
+              f"texte {sim:.1%}, médicaments retrouvés {recall:.1%}")
+
+
+if __name__ == "__main__":
+    main()
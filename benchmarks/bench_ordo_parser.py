@@ -0,0 +1,91 @@
+"""
+Micro-benchmark du parseur de médicaments (services/ordo_extract.py).
+
+Compare l'ancien parseur (plusieurs re.search non compilés par ligne) au
+parseur à passe unique sur un corpus d'ordonnances OCRisées.
+
+    python -m benchmarks.bench_ordo_parser [--repeat 2000]
+"""
+import argparse
+import os
+import re
+import time
+from typing import List, Optional
+
+from services.ordo_extract import _parse_meds_from_text
+
+CORPUS = os.path.join(os.path.dirname(__file__), "data", "ordonnances_ocr.txt")
+
+_LEGACY_FREQ_PATTERNS = [
+    (r"\b(\d+)\s*/\s*jour\b", "{}/jour"),
+    (r"\b(\d+)\s*/\s*semaine\b", "{}/semaine"),
+    (r"\b(\d+)\s*/\s*sem\b", "{}/semaine"),
+    (r"\b(\d+)\s*x\s*par\s*jour\b", "{}/jour"),
+    (r"\b(\d+)\s*fois\s*par\s*jour\b", "{}/jour"),
+    (r"\bquotidien(ne)?\b", "1/jour"),
+]
+
+
+def _legacy_parse(text: str) -> List[tuple]:
+    """Ancienne implémentation, conservée ici comme point de comparaison."""
+    meds = []
+    for raw in [l.strip() for l in text.splitlines() if len(l.strip()) > 2]:
+        freq: Optional[str] = None
+        for pat, fmt in _LEGACY_FREQ_PATTERNS:
+            m = re.search(pat, raw, flags=re.IGNORECASE)
+            if m:
+                freq = fmt.format(m.group(1)) if m.groups() and m.group(1) and "{}" in fmt else fmt
+                break
+        if not freq:
+            m = re.search(r"(\d+)\s*/\s*jour", raw, flags=re.IGNORECASE)
+            if m:
+                freq = f"{m.group(1)}/jour"
+        if not freq:
+            continue
+        cut = re.split(r"(\d+\s*/\s*jour|\d+\s*/\s*semaine|\d+\s*x\s*par\s*jour|\d+\s*fois\s*par\s*jour|quotidien(ne)?)",
+                       raw, flags=re.IGNORECASE)[0].strip(" -•:\t")
+        nom = re.sub(r"^\d+[\.\)-]\s*", "", cut)
+        nom = re.sub(r"[\?\!]+$", "", nom).strip()
+        if len(nom) >= 2:
+            meds.append((nom, freq))
+    return meds
+
+
+def _bench(fn, docs: List[str], repeat: int) -> float:
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        for doc in docs:
+            fn(doc)
+    return time.perf_counter() - t0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=2000)
+    parser.add_argument("--corpus", default=CORPUS)
+    args = parser.parse_args(argv)
+
+    with open(args.corpus, encoding="utf-8") as f:
+        docs = [d.strip() for d in f.read().split("=====") if d.strip()]
+    nb_lines = sum(len(d.splitlines()) for d in docs)
+
+    print(f"Corpus : {len(docs)} ordonnances, {nb_lines} lignes, {args.repeat} répétitions")
+    results = {}
+    for name, fn in (("ancien", _legacy_parse), ("passe unique", _parse_meds_from_text)):
+        _bench(fn, docs, 10)  # chauffe
+        elapsed = _bench(fn, docs, args.repeat)
+        total = nb_lines * args.repeat
+        found = sum(len(fn(d)) for d in docs)
+        results[name] = elapsed
+        print(f"{name:>13} : {total / elapsed:>10,.0f} lignes/s  {elapsed / total * 1e6:6.2f} µs/ligne  "
+              f"{found} médicaments trouvés")
+    print(f"Accélération : x{results['ancien'] / results['passe unique']:.2f}")
+
+    print("\nDétail (passe unique) :")
+    for doc in docs:
+        for m in _parse_meds_from_text(doc):
+            print(f"  - {m.nom} | {m.dose or '-'} | {m.frequence} | {m.duree or '-'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -6,12 +6,14 @@ from jose import JWTError, jwt
 from passlib.context import CryptContext
 from fastapi import HTTPException, status, Depends, Cookie
 from fastapi.security import HTTPBearer
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
+import asyncio
 import os
 from dotenv import load_dotenv
 
 from . import controller as crud
-from .database import get_db
+from .database import get_async_db, get_db
 import time
 
 
@@ -72,6 +74,16 @@ class AuthService:
             return False
         return user
 
+    @staticmethod
+    async def authenticate_user_async(db: AsyncSession, email: str, password: str):
+        user = await crud.get_utilisateur_by_email_async(db, email=email)
+        if not user:
+            return False
+        # bcrypt hors de la boucle d'événements
+        if not await asyncio.to_thread(AuthService.verify_password, password, user.mot_de_passe):
+            return False
+        return user
+
     @staticmethod
     def verify_access_token(token: str, secret_key: str, algorithm: str):
         try:
@@ -120,4 +132,37 @@ def get_current_user_optional(
         user = crud.get_utilisateur(db, utilisateur_id=user_id)
         return user
     except:
-        return None
\ No newline at end of file
+        return None
+
+# Variantes pour les routes async : même session AsyncSession que la route
+async def get_current_user_async(
+    session_token: Optional[str] = Cookie(None),
+    db: AsyncSession = Depends(get_async_db)
+):
+    credentials_exception = HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Non authentifié",
+        headers={"WWW-Authenticate": "Bearer"},
+    )
+    if not session_token:
+        raise credentials_exception
+    try:
+        user_id = AuthService.verify_token(session_token)
+        user = await crud.get_utilisateur_async(db, utilisateur_id=int(user_id))
+    except (HTTPException, ValueError):
+        raise credentials_exception
+    if user is None:
+        raise credentials_exception
+    return user
+
+async def get_current_user_optional_async(
+    session_token: Optional[str] = Cookie(None),
+    db: AsyncSession = Depends(get_async_db)
+):
+    if not session_token:
+        return None
+    try:
+        user_id = AuthService.verify_token(session_token)
+        return await crud.get_utilisateur_async(db, utilisateur_id=int(user_id))
+    except Exception:
+        return None
@@ -1,5 +1,8 @@
-from sqlalchemy.orm import Session, joinedload
+from sqlalchemy import delete, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
 from passlib.context import CryptContext
+import asyncio
 import models
 from . import schemas
 from typing import Optional, List
@@ -94,6 +97,13 @@ def get_ordonnances_par_utilisateur(db: Session, utilisateur_id: int, skip: int
     """Récupère toutes les ordonnances d'un utilisateur."""
     return db.query(models.Ordonnance).filter(models.Ordonnance.utilisateur_id == utilisateur_id).offset(skip).limit(limit).all()
 
+def image_belongs_to_user(db: Session, image_sha256: str, utilisateur_id: int) -> bool:
+    """Vérifie qu'une ordonnance de l'utilisateur référence cette image."""
+    return db.query(models.Ordonnance.id).filter(
+        models.Ordonnance.utilisateur_id == utilisateur_id,
+        models.Ordonnance.image_sha256 == image_sha256,
+    ).first() is not None
+
 def get_ordonnance(db: Session, ordonnance_id: int):
     """Récupère une ordonnance par son ID."""
     return db.query(models.Ordonnance).filter(models.Ordonnance.id == ordonnance_id).first()
@@ -125,16 +135,19 @@ def create_ordonnance_with_meds(
     utilisateur_id: int,
     valid_until: Optional[date],
     meds: List[dict],
+    image_sha256: Optional[str] = None,
 ):
     """
     Crée une ordonnance + médicaments liés.
     meds: [{"nom": str, "frequence": str}]
+    image_sha256: empreinte de l'image dans le stockage d'images (services/blob_store.py)
     """
     # Utiliser les modèles importés en haut du fichier
     ordon = models.Ordonnance( 
         utilisateur_id=utilisateur_id, 
         date_ordonnance=date.today(),
-        nom="" 
+        nom="",
+        image_sha256=image_sha256,
         )
     db.add(ordon)
     db.flush()  # pour obtenir id
@@ -150,12 +163,52 @@ def create_ordonnance_with_meds(
             nom=m.get("nom"),
             frequence=m.get("frequence"),
             dose=m.get("dose"),
+            composant=m.get("composant"),
         )
         db.add(db_medicament)
     db.commit()
     db.refresh(ordon)
     return ordon
 
+def create_ordonnances_with_meds_bulk(
+    db: Session,
+    utilisateur_id: int,
+    valid_until: Optional[date],
+    meds_par_ordonnance: List[List[dict]],
+    images_sha256: Optional[List[Optional[str]]] = None,
+) -> List[int]:
+    """
+    Crée plusieurs ordonnances et leurs médicaments en une seule transaction
+    (scan par lot). Les INSERT sont regroupés par table au flush ; retourne
+    les ids dans l'ordre des listes reçues.
+    """
+    ordonnances = []
+    images_sha256 = images_sha256 or [None] * len(meds_par_ordonnance)
+    for meds, image_sha256 in zip(meds_par_ordonnance, images_sha256):
+        ordon = models.Ordonnance(
+            utilisateur_id=utilisateur_id, date_ordonnance=date.today(), nom="", image_sha256=image_sha256
+        )
+        ordon.medicaments = [
+            models.Medicament(
+                nom=m.get("nom"),
+                frequence=m.get("frequence"),
+                dose=m.get("dose"),
+                composant=m.get("composant"),
+            )
+            for m in meds
+            if m.get("nom") and m.get("frequence")
+        ]
+        ordonnances.append(ordon)
+    try:
+        db.add_all(ordonnances)
+        db.flush()
+        ids = [o.id for o in ordonnances]
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return ids
+
 def get_medicaments_par_ordonnance(db: Session, ordonnance_id: int, skip: int = 0, limit: int = 100):
     """Récupère les médicaments d'une ordonnance."""
     return db.query(models.Medicament).filter(models.Medicament.ordonnance_id == ordonnance_id).offset(skip).limit(limit).all()
@@ -356,13 +409,30 @@ def get_conversations_by_user(db: Session, user_id: int):
     return db.query(models.Conversation).filter(models.Conversation.utilisateur_id == user_id).order_by(models.Conversation.date_derniere_activite.desc()).all()
 
 def get_conversation_by_id(db: Session, conversation_id: int, user_id: int):
-    return db.query(models.Conversation).options(
-        joinedload(models.Conversation.messages)
-    ).filter(
+    """La conversation seule ; ses messages se lisent page par page (get_conversation_messages)."""
+    return db.query(models.Conversation).filter(
         models.Conversation.id == conversation_id,
         models.Conversation.utilisateur_id == user_id
     ).first()
 
+def get_conversation_messages(db: Session, conversation_id: int, before: Optional[int] = None, limit: int = 50):
+    """
+    Pagination par curseur (index (conversation_id, id)) : les `limit` messages
+    précédant le message `before`, ou les derniers si `before` est None.
+    Retourne (messages du plus ancien au plus récent, curseur de la page
+    précédente ou None s'il n'y a plus rien avant). Coût constant, quelle
+    que soit la longueur de la conversation.
+    """
+    query = db.query(models.Message).filter(models.Message.conversation_id == conversation_id)
+    if before is not None:
+        query = query.filter(models.Message.id < before)
+    # Une ligne de plus pour savoir s'il reste des messages plus anciens
+    rows = query.order_by(models.Message.id.desc()).limit(limit + 1).all()
+    has_more = len(rows) > limit
+    page = rows[:limit]
+    page.reverse()
+    return page, (page[0].id if has_more else None)
+
 def update_conversation_title(db: Session, conversation_id: int, user_id: int, new_title: str):
     conversation = db.query(models.Conversation).filter(
         models.Conversation.id == conversation_id,
@@ -376,37 +446,225 @@ def update_conversation_title(db: Session, conversation_id: int, user_id: int, n
     return conversation
 
 def add_message_to_conversation(db: Session, conversation_id: int, role: str, contenu: str):
-    """Ajouter un message à une conversation et mettre à jour la date d'activité."""
+    """
+    Ajouter un message à une conversation et mettre à jour, dans la même
+    transaction, la date d'activité, le compteur et l'aperçu du dernier message.
+    """
     from models import Message, Conversation
-    
-    # Ajouter le message
+    from models.conversation import PREVIEW_LENGTH
+
+    now = datetime.utcnow()
     db_message = Message(
         conversation_id=conversation_id,
         role=role,
         contenu=contenu,
-        timestamp=datetime.utcnow()
+        timestamp=now
     )
     db.add(db_message)
-    
-    # Mettre à jour la date de dernière activité de la conversation
-    conversation = db.query(Conversation).filter(Conversation.id == conversation_id).first()
-    if conversation:
-        conversation.date_derniere_activite = datetime.utcnow()
-        
-    db.commit()
+
+    # Incrément côté base : pas de mise à jour perdue si deux messages arrivent ensemble
+    db.query(Conversation).filter(Conversation.id == conversation_id).update(
+        {
+            Conversation.date_derniere_activite: now,
+            Conversation.nb_messages: Conversation.nb_messages + 1,
+            Conversation.last_message_preview: contenu[:PREVIEW_LENGTH],
+        },
+        synchronize_session=False,
+    )
+    try:
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
     db.refresh(db_message)
     return db_message
 
 def delete_conversation(db: Session, conversation_id: int, utilisateur_id: int):
-    """Supprimer une conversation"""
+    """Supprimer une conversation et ses messages, sans charger ces derniers."""
+    from models import Conversation, Message
+    owned = conversation_belongs_to_user(db, conversation_id, utilisateur_id)
+    if not owned:
+        return False
+    try:
+        db.query(Message).filter(Message.conversation_id == conversation_id).delete(synchronize_session=False)
+        db.query(Conversation).filter(Conversation.id == conversation_id).delete(synchronize_session=False)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return True
+
+def conversation_belongs_to_user(db: Session, conversation_id: int, user_id: int) -> bool:
+    """Vérifie l'appartenance sans charger les messages."""
     from models import Conversation
-    conversation = db.query(Conversation).filter(
+    return db.query(Conversation.id).filter(
         Conversation.id == conversation_id,
-        Conversation.utilisateur_id == utilisateur_id
-    ).first()
-    
+        Conversation.utilisateur_id == user_id
+    ).first() is not None
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Versions asynchrones (AsyncSession, moteur asyncpg) pour les routes async et
+# la boucle WebSocket. Même contrat que les fonctions synchrones ci-dessus.
+# ──────────────────────────────────────────────────────────────────────────────
+async def get_utilisateur_async(db: AsyncSession, utilisateur_id: int):
+    return await db.get(models.Utilisateur, utilisateur_id)
+
+async def get_utilisateur_by_email_async(db: AsyncSession, email: str):
+    result = await db.execute(select(models.Utilisateur).where(models.Utilisateur.email == email))
+    return result.scalars().first()
+
+async def create_utilisateur_simple_async(db: AsyncSession, email: str, mot_de_passe: str, role: str = "utilisateur"):
+    # bcrypt est volontairement lent : hors de la boucle d'événements
+    hashed_password = await asyncio.to_thread(get_password_hash, mot_de_passe)
+    db_utilisateur = models.Utilisateur(
+        email=email,
+        mot_de_passe=hashed_password,
+        nom="",
+        prenom="",
+        date_naissance=date.today(),
+        numero_telephone=None,
+        role=role,
+        sexe=""
+    )
+    db.add(db_utilisateur)
+    await db.commit()
+    await db.refresh(db_utilisateur)
+    return db_utilisateur
+
+async def update_utilisateur_password_async(db: AsyncSession, utilisateur_id: int, hashed_password: str):
+    user = await db.get(models.Utilisateur, utilisateur_id)
+    if not user:
+        return None
+    user.mot_de_passe = hashed_password
+    await db.commit()
+    return user
+
+async def get_allergies_par_utilisateur_async(db: AsyncSession, utilisateur_id: int, skip: int = 0, limit: int = 100):
+    result = await db.execute(
+        select(models.Allergie).where(models.Allergie.utilisateur_id == utilisateur_id).offset(skip).limit(limit)
+    )
+    return result.scalars().all()
+
+async def get_antecedents_par_utilisateur_async(db: AsyncSession, utilisateur_id: int, skip: int = 0, limit: int = 100):
+    result = await db.execute(
+        select(models.AntecedentMedical).where(models.AntecedentMedical.utilisateur_id == utilisateur_id).offset(skip).limit(limit)
+    )
+    return result.scalars().all()
+
+async def create_ordonnance_with_meds_async(
+    db: AsyncSession,
+    utilisateur_id: int,
+    valid_until: Optional[date],
+    meds: List[dict],
+    image_sha256: Optional[str] = None,
+):
+    ordon = models.Ordonnance(
+        utilisateur_id=utilisateur_id, date_ordonnance=date.today(), nom="", image_sha256=image_sha256
+    )
+    ordon.medicaments = [
+        models.Medicament(
+            nom=m.get("nom"),
+            frequence=m.get("frequence"),
+            dose=m.get("dose"),
+            composant=m.get("composant"),
+        )
+        for m in meds
+        if m.get("nom") and m.get("frequence")
+    ]
+    db.add(ordon)
+    try:
+        await db.commit()
+    except Exception:
+        await db.rollback()
+        raise
+    return ordon
+
+async def create_conversation_async(db: AsyncSession, utilisateur_id: int, titre: str):
+    now = datetime.utcnow()
+    db_conversation = models.Conversation(
+        utilisateur_id=utilisateur_id, titre=titre, date_creation=now, date_derniere_activite=now,
+        nb_messages=0, last_message_preview=None,
+    )
+    db.add(db_conversation)
+    await db.commit()
+    return db_conversation
+
+async def get_conversations_by_user_async(db: AsyncSession, user_id: int):
+    result = await db.execute(
+        select(models.Conversation)
+        .where(models.Conversation.utilisateur_id == user_id)
+        .order_by(models.Conversation.date_derniere_activite.desc())
+    )
+    return result.scalars().all()
+
+async def get_conversation_by_id_async(db: AsyncSession, conversation_id: int, user_id: int):
+    result = await db.execute(
+        select(models.Conversation).where(
+            models.Conversation.id == conversation_id,
+            models.Conversation.utilisateur_id == user_id,
+        )
+    )
+    return result.scalars().first()
+
+async def get_conversation_messages_async(db: AsyncSession, conversation_id: int, before: Optional[int] = None, limit: int = 50):
+    stmt = select(models.Message).where(models.Message.conversation_id == conversation_id)
+    if before is not None:
+        stmt = stmt.where(models.Message.id < before)
+    result = await db.execute(stmt.order_by(models.Message.id.desc()).limit(limit + 1))
+    rows = result.scalars().all()
+    has_more = len(rows) > limit
+    page = list(rows[:limit])
+    page.reverse()
+    return page, (page[0].id if has_more else None)
+
+async def update_conversation_title_async(db: AsyncSession, conversation_id: int, user_id: int, new_title: str):
+    conversation = await get_conversation_by_id_async(db, conversation_id, user_id)
     if conversation:
-        db.delete(conversation)
-        db.commit()
-        return True
-    return False
+        conversation.titre = new_title
+        await db.commit()
+    return conversation
+
+async def add_message_to_conversation_async(db: AsyncSession, conversation_id: int, role: str, contenu: str):
+    from models.conversation import PREVIEW_LENGTH
+
+    now = datetime.utcnow()
+    db_message = models.Message(conversation_id=conversation_id, role=role, contenu=contenu, timestamp=now)
+    db.add(db_message)
+    await db.execute(
+        update(models.Conversation)
+        .where(models.Conversation.id == conversation_id)
+        .values(
+            date_derniere_activite=now,
+            nb_messages=models.Conversation.nb_messages + 1,
+            last_message_preview=contenu[:PREVIEW_LENGTH],
+        )
+        .execution_options(synchronize_session=False)
+    )
+    try:
+        await db.commit()
+    except Exception:
+        await db.rollback()
+        raise
+    return db_message
+
+async def delete_conversation_async(db: AsyncSession, conversation_id: int, utilisateur_id: int):
+    if not await conversation_belongs_to_user_async(db, conversation_id, utilisateur_id):
+        return False
+    try:
+        await db.execute(delete(models.Message).where(models.Message.conversation_id == conversation_id))
+        await db.execute(delete(models.Conversation).where(models.Conversation.id == conversation_id))
+        await db.commit()
+    except Exception:
+        await db.rollback()
+        raise
+    return True
+
+async def conversation_belongs_to_user_async(db: AsyncSession, conversation_id: int, user_id: int) -> bool:
+    result = await db.execute(
+        select(models.Conversation.id).where(
+            models.Conversation.id == conversation_id,
+            models.Conversation.utilisateur_id == user_id,
+        )
+    )
+    return result.first() is not None
@@ -1,7 +1,12 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, exc as sa_exc
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+import asyncio
 import logging
 import os
+import threading
+import weakref
 import psycopg2
 from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
 import time
@@ -15,6 +20,7 @@ load_dotenv(find_dotenv())  # charge le premier .env trouvé en remontant l’ar
 import sys
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from models.base import Base
+from services import metrics
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -33,6 +39,14 @@ DB_PORT_STR = os.getenv("DB_PORT", "5432")
 DB_NAME = os.getenv("DB_NAME")
 SQLALCHEMY_ECHO = _as_bool(os.getenv("SQLALCHEMY_ECHO"), default=False)
 
+# Pool de connexions : chaque pool (synchrone, et un par boucle async) ouvre
+# jusqu'à DB_POOL_SIZE + DB_MAX_OVERFLOW connexions
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))  # -1 : jamais
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "0"))  # 0 : aucun
+
 # Valider que toutes les variables d'environnement nécessaires sont définies
 if not all([DB_USER, DB_PASSWORD, DB_NAME]):
     logger.critical("FATAL: Configuration de la base de données manquante. Veuillez définir les variables d'environnement DB_USER, DB_PASSWORD et DB_NAME.")
@@ -76,16 +90,179 @@ def bootstrap_database(max_attempts: int = 60, delay: float = 1.0):
     raise RuntimeError("La base n'est pas disponible après les retries.")
 
 
+# ── Métriques du pool ────────────────────────────────────────────────────────
+_pool_checked_out = metrics.gauge("db_pool_checked_out", "Connexions empruntées au pool")
+_pool_overflow = metrics.gauge("db_pool_overflow", "Connexions ouvertes au-delà de DB_POOL_SIZE")
+_pool_size = metrics.gauge("db_pool_size", "Taille configurée du pool")
+_pool_wait = metrics.histogram("db_pool_checkout_wait_seconds", "Attente pour obtenir une connexion du pool")
+_pool_held = metrics.histogram("db_pool_connection_held_seconds", "Durée d'emprunt d'une connexion")
+_pool_timeouts = metrics.counter("db_pool_timeouts_total", "Attentes de connexion abandonnées après DB_POOL_TIMEOUT")
+_pool_connects = metrics.counter("db_pool_connections_total", "Connexions ouvertes vers Postgres")
+
+class _TimedPoolMixin:
+    """Mesure l'attente dans _do_get (file du pool et ouverture d'une connexion)."""
+    metrics_label = "sync"
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except sa_exc.TimeoutError:
+            _pool_timeouts.inc(pool=self.metrics_label)
+            raise
+        finally:
+            _pool_wait.observe(time.perf_counter() - start, pool=self.metrics_label)
+
+    def recreate(self):
+        # engine.dispose() remplace le pool : l'étiquette suit
+        pool = super().recreate()
+        pool.metrics_label = self.metrics_label
+        return pool
+
+class TimedQueuePool(_TimedPoolMixin, QueuePool):
+    pass
+
+class TimedAsyncQueuePool(_TimedPoolMixin, AsyncAdaptedQueuePool):
+    pass
+
+def _pool_options(poolclass) -> dict:
+    return dict(
+        poolclass=poolclass,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_pre_ping=True,
+    )
+
+def _instrument_pool(engine_, label: str) -> None:
+    pool = engine_.pool
+    pool.metrics_label = label
+    # Référence faible : un moteur async disparaît avec sa boucle
+    ref = weakref.ref(engine_)
+
+    def _read(attr):
+        def fn():
+            e = ref()
+            return getattr(e.pool, attr)() if e is not None else 0
+        return fn
+
+    _pool_checked_out.set_function(_read("checkedout"), pool=label)
+    # overflow() est négatif tant que le pool n'est pas plein
+    overflow = _read("overflow")
+    _pool_overflow.set_function(lambda: max(overflow(), 0), pool=label)
+    _pool_size.set_function(_read("size"), pool=label)
+
+    @event.listens_for(pool, "connect")
+    def _on_connect(dbapi_conn, record):
+        _pool_connects.inc(pool=label)
+
+    @event.listens_for(pool, "checkout")
+    def _on_checkout(dbapi_conn, record, proxy):
+        record.info["checkout_at"] = time.perf_counter()
+
+    @event.listens_for(pool, "checkin")
+    def _on_checkin(dbapi_conn, record):
+        started = record.info.pop("checkout_at", None)
+        if started is not None:
+            _pool_held.observe(time.perf_counter() - started, pool=label)
+
+
 # Construire l'URL de la base de données
 DATABASE_URL = f"postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{db_port}/{DB_NAME}"
-engine = create_engine(DATABASE_URL, echo=SQLALCHEMY_ECHO, pool_pre_ping=True)
+_sync_connect_args = {}
+if DB_STATEMENT_TIMEOUT_MS > 0:
+    _sync_connect_args["options"] = f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}"
+engine = create_engine(
+    DATABASE_URL, echo=SQLALCHEMY_ECHO, connect_args=_sync_connect_args, **_pool_options(TimedQueuePool)
+)
+_instrument_pool(engine, "sync")
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
-def init_db():
-    # Importe tous les modèles pour qu'ils soient enregistrés dans Base
-    from models import utilisateur, ordonnance, medicament, allergie, antecedent
-    logging.info("Création des tables si non existantes…")
-    Base.metadata.create_all(bind=engine)
+# Moteur asyncpg pour les routes async et la boucle WebSocket : les requêtes
+# n'y bloquent plus la boucle d'événements. Le moteur synchrone reste utilisé
+# par les routes def (pool de threads), le worker de scans et les migrations.
+ASYNC_DATABASE_URL = f"postgresql+asyncpg://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{db_port}/{DB_NAME}"
+# Une connexion asyncpg appartient à la boucle qui l'a ouverte ; FastAPI (thread
+# uvicorn) et le serveur WebSocket (boucle principale) ont chacun la leur,
+# donc un moteur (et un pool) par boucle.
+_async_engines: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, AsyncEngine]" = weakref.WeakKeyDictionary()
+_async_engines_lock = threading.Lock()
+# expire_on_commit=False : les objets restent lisibles après commit sans
+# rechargement implicite (impossible en async)
+AsyncSessionLocal = async_sessionmaker(class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
+def get_async_engine() -> AsyncEngine:
+    """Moteur async de la boucle courante (créé au premier appel)."""
+    loop = asyncio.get_running_loop()
+    engine_ = _async_engines.get(loop)
+    if engine_ is None:
+        with _async_engines_lock:
+            engine_ = _async_engines.get(loop)
+            if engine_ is None:
+                connect_args = {}
+                if DB_STATEMENT_TIMEOUT_MS > 0:
+                    connect_args["server_settings"] = {"statement_timeout": str(DB_STATEMENT_TIMEOUT_MS)}
+                engine_ = create_async_engine(
+                    ASYNC_DATABASE_URL, echo=SQLALCHEMY_ECHO, connect_args=connect_args,
+                    **_pool_options(TimedAsyncQueuePool),
+                )
+                _instrument_pool(engine_, f"async:{threading.current_thread().name}")
+                _async_engines[loop] = engine_
+    return engine_
+
+def async_session() -> AsyncSession:
+    """Session async liée au moteur de la boucle courante."""
+    return AsyncSessionLocal(bind=get_async_engine())
+
+ALEMBIC_INI = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'alembic.ini'))
+BASELINE_REVISION = "0001"
+
+def migrate_db():
+    """
+    Met le schéma à jour (alembic upgrade head, voir migrations/). Une base
+    créée avant les migrations par create_all est d'abord complétée puis
+    marquée à la révision initiale.
+    """
+    from alembic import command
+    from alembic.config import Config
+    from sqlalchemy import inspect
+
+    config = Config(ALEMBIC_INI)
+    config.attributes["configure_logger"] = False  # garder la configuration des logs du serveur
+    tables = inspect(engine).get_table_names()
+    if "alembic_version" not in tables and "utilisateur" in tables:
+        logger.info("Base créée sans migrations : marquage au schéma initial…")
+        _complete_legacy_schema(tables)
+        command.stamp(config, BASELINE_REVISION)
+    logger.info("Application des migrations…")
+    command.upgrade(config, "head")
+
+def _complete_legacy_schema(tables):
+    """Amène une base créée par l'ancien init_db au schéma de la révision initiale."""
+    import models  # enregistre tous les modèles dans Base
+    missing = [t for name, t in Base.metadata.tables.items() if name not in tables]
+    with engine.begin() as conn:
+        if missing:
+            Base.metadata.create_all(bind=conn, tables=missing)
+        # create_all n'ajoutait pas les colonnes apparues sur des tables existantes
+        conn.exec_driver_sql("ALTER TABLE ordonnance ADD COLUMN IF NOT EXISTS image_sha256 VARCHAR(64)")
+        has_counters = conn.exec_driver_sql(
+            "SELECT 1 FROM information_schema.columns WHERE table_name = 'conversation' AND column_name = 'nb_messages'"
+        ).first()
+        if not has_counters:
+            logging.info("Ajout des compteurs de messages sur les conversations…")
+            conn.exec_driver_sql(
+                "ALTER TABLE conversation ADD COLUMN IF NOT EXISTS nb_messages INTEGER NOT NULL DEFAULT 0, "
+                "ADD COLUMN IF NOT EXISTS last_message_preview VARCHAR(200)"
+            )
+            # Rattrapage unique des conversations existantes
+            conn.exec_driver_sql(
+                "UPDATE conversation c SET nb_messages = m.n, last_message_preview = m.apercu "
+                "FROM (SELECT conversation_id, count(*) AS n, "
+                "(array_agg(left(contenu, 200) ORDER BY id DESC))[1] AS apercu "
+                "FROM message GROUP BY conversation_id) m WHERE m.conversation_id = c.id"
+            )
 
 def get_db():
     db = SessionLocal()
@@ -93,3 +270,7 @@ def get_db():
         yield db
     finally:
         db.close()
+
+async def get_async_db():
+    async with async_session() as db:
+        yield db
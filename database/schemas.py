@@ -74,6 +74,20 @@ class Medicament(MedicamentBase):
     ordonnance_id: int
     model_config = ConfigDict(from_attributes=True)
 
+# --- Schémas d'extraction d'ordonnance (sortie structurée du LLM) ---
+
+class MedicamentExtrait(BaseModel):
+    nom: str = Field(..., min_length=1)
+    dose: Optional[str] = None
+    frequence: str = Field(..., min_length=1)
+    composant: Optional[str] = None  # DCI, renseignée par le référentiel local
+    nom_reference: Optional[str] = None  # entrée du référentiel retrouvée pour `nom`
+    score: Optional[float] = None
+
+class ExtractionOrdonnance(BaseModel):
+    reponse_textuelle: Optional[str] = None
+    medicaments: List[MedicamentExtrait] = []
+
 # --- Schémas Allergie ---
 
 class AllergieBase(BaseModel):
@@ -0,0 +1,62 @@
+"""
+Environnement Alembic : connexion construite par database/database.py (DB_*),
+métadonnées de models/ pour --autogenerate.
+
+Un verrou consultatif Postgres sérialise les migrations : plusieurs instances
+du serveur qui démarrent ensemble n'appliquent pas deux fois la même révision.
+"""
+import os
+import sys
+from logging.config import fileConfig
+
+from alembic import context
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from database.database import DATABASE_URL, engine  # noqa: E402
+from models import Base  # noqa: E402  (importe tous les modèles)
+
+config = context.config
+# Depuis le serveur (migrate_db), la configuration des logs de l'application est conservée
+if config.config_file_name is not None and config.attributes.get("configure_logger", True):
+    fileConfig(config.config_file_name)
+
+target_metadata = Base.metadata
+
+MIGRATION_LOCK_ID = 0x534F52  # verrou consultatif partagé par toutes les instances
+
+
+def run_migrations_offline() -> None:
+    """Génère le SQL sans se connecter (alembic upgrade head --sql)."""
+    context.configure(
+        url=DATABASE_URL,
+        target_metadata=target_metadata,
+        literal_binds=True,
+        dialect_opts={"paramstyle": "named"},
+    )
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+def run_migrations_online() -> None:
+    with engine.connect() as connection:
+        # DB_STATEMENT_TIMEOUT_MS ne s'applique pas aux migrations (attente du
+        # verrou, CREATE INDEX CONCURRENTLY sur de grosses tables)
+        connection.exec_driver_sql("SET statement_timeout = 0")
+        connection.exec_driver_sql(f"SELECT pg_advisory_lock({MIGRATION_LOCK_ID})")
+        connection.commit()
+        try:
+            context.configure(connection=connection, target_metadata=target_metadata, compare_type=True)
+            with context.begin_transaction():
+                context.run_migrations()
+        finally:
+            connection.exec_driver_sql(f"SELECT pg_advisory_unlock({MIGRATION_LOCK_ID})")
+            # La connexion retourne au pool avec le délai configuré
+            connection.exec_driver_sql("RESET statement_timeout")
+            connection.commit()
+
+
+if context.is_offline_mode():
+    run_migrations_offline()
+else:
+    run_migrations_online()
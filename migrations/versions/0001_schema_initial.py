@@ -0,0 +1,163 @@
+"""schema initial
+
+Schéma tel que le créait Base.metadata.create_all avant les migrations. Les
+bases existantes (sans table alembic_version) sont marquées à cette révision
+par migrate_db() au lieu de la rejouer.
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-19
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+revision = '0001'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table('utilisateur',
+    sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+    sa.Column('nom', sa.String(), nullable=True),
+    sa.Column('prenom', sa.String(), nullable=True),
+    sa.Column('date_naissance', sa.Date(), nullable=True),
+    sa.Column('email', sa.String(), nullable=False),
+    sa.Column('mot_de_passe', sa.String(), nullable=False),
+    sa.Column('numero_telephone', sa.String(), nullable=True),
+    sa.Column('role', sa.String(), nullable=False),
+    sa.Column('avatar', sa.String(), nullable=True),
+    sa.Column('sexe', sa.String(), nullable=True),
+    sa.CheckConstraint("role IN ('admin', 'utilisateur')", name='check_role'),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('email')
+    )
+    op.create_table('allergies',
+    sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+    sa.Column('utilisateur_id', sa.Integer(), nullable=False),
+    sa.Column('nom', sa.String(), nullable=True),
+    sa.Column('description_allergie', sa.Text(), nullable=True),
+    sa.ForeignKeyConstraint(['utilisateur_id'], ['utilisateur.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table('antecedent_medical',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('utilisateur_id', sa.Integer(), nullable=False),
+    sa.Column('nom', sa.String(), nullable=True),
+    sa.Column('description', sa.String(), nullable=True),
+    sa.Column('date_diagnostic', sa.Date(), nullable=True),
+    sa.Column('type', sa.String(), nullable=False),
+    sa.ForeignKeyConstraint(['utilisateur_id'], ['utilisateur.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_antecedent_medical_id'), 'antecedent_medical', ['id'], unique=False)
+    op.create_table('conversation',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('utilisateur_id', sa.Integer(), nullable=False),
+    sa.Column('titre', sa.String(), nullable=False),
+    sa.Column('date_creation', sa.DateTime(), nullable=False),
+    sa.Column('date_derniere_activite', sa.DateTime(), nullable=False),
+    sa.Column('nb_messages', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('last_message_preview', sa.String(length=200), nullable=True),
+    sa.ForeignKeyConstraint(['utilisateur_id'], ['utilisateur.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_conversation_id'), 'conversation', ['id'], unique=False)
+    op.create_table('events',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('utilisateur_id', sa.Integer(), nullable=False),
+    sa.Column('title', sa.String(length=200), nullable=False),
+    sa.Column('description', sa.String(), nullable=True),
+    sa.Column('start_dt', sa.DateTime(), nullable=False),
+    sa.Column('end_dt', sa.DateTime(), nullable=False),
+    sa.Column('timezone', sa.String(length=64), nullable=True),
+    sa.Column('location', sa.String(length=255), nullable=True),
+    sa.Column('done', sa.Boolean(), nullable=False),
+    sa.ForeignKeyConstraint(['utilisateur_id'], ['utilisateur.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_events_id'), 'events', ['id'], unique=False)
+    op.create_table('ordonnance',
+    sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+    sa.Column('utilisateur_id', sa.Integer(), nullable=False),
+    sa.Column('nom', sa.String(), nullable=True),
+    sa.Column('date_ordonnance', sa.Date(), nullable=False),
+    sa.Column('image_sha256', sa.String(length=64), nullable=True),
+    sa.ForeignKeyConstraint(['utilisateur_id'], ['utilisateur.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table('quota_usage',
+    sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+    sa.Column('utilisateur_id', sa.Integer(), nullable=False),
+    sa.Column('periode', sa.String(length=8), nullable=False),
+    sa.Column('debut_periode', sa.Date(), nullable=False),
+    sa.Column('nb_requetes', sa.Integer(), nullable=False),
+    sa.Column('tokens_entree', sa.BigInteger(), nullable=False),
+    sa.Column('tokens_sortie', sa.BigInteger(), nullable=False),
+    sa.ForeignKeyConstraint(['utilisateur_id'], ['utilisateur.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('utilisateur_id', 'periode', 'debut_periode', name='uq_quota_usage_periode')
+    )
+    op.create_table('medicaments',
+    sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+    sa.Column('ordonnance_id', sa.Integer(), nullable=False),
+    sa.Column('nom', sa.String(), nullable=True),
+    sa.Column('description_medicaments', sa.Text(), nullable=True),
+    sa.Column('dose', sa.String(), nullable=True),
+    sa.Column('composant', sa.String(), nullable=True),
+    sa.Column('frequence', sa.String(), nullable=True),
+    sa.ForeignKeyConstraint(['ordonnance_id'], ['ordonnance.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table('message',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('conversation_id', sa.Integer(), nullable=False),
+    sa.Column('role', sa.String(), nullable=False),
+    sa.Column('contenu', sa.Text(), nullable=False),
+    sa.Column('timestamp', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['conversation_id'], ['conversation.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_message_id'), 'message', ['id'], unique=False)
+    op.create_table('scan_job',
+    sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+    sa.Column('utilisateur_id', sa.Integer(), nullable=False),
+    sa.Column('statut', sa.String(length=16), nullable=False),
+    sa.Column('chemin_fichier', sa.String(), nullable=False),
+    sa.Column('nom_fichier', sa.String(), nullable=True),
+    sa.Column('type_contenu', sa.String(), nullable=True),
+    sa.Column('valid_until', sa.Date(), nullable=True),
+    sa.Column('resultats', sa.JSON(), nullable=True),
+    sa.Column('ordonnance_id', sa.Integer(), nullable=True),
+    sa.Column('erreur', sa.Text(), nullable=True),
+    sa.Column('tentatives', sa.Integer(), nullable=False),
+    sa.Column('bail_jusqu_a', sa.DateTime(timezone=True), nullable=True),
+    sa.Column('cree_le', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=False),
+    sa.Column('termine_le', sa.DateTime(timezone=True), nullable=True),
+    sa.ForeignKeyConstraint(['ordonnance_id'], ['ordonnance.id'], ondelete='SET NULL'),
+    sa.ForeignKeyConstraint(['utilisateur_id'], ['utilisateur.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_scan_job_statut_id', 'scan_job', ['statut', 'id'], unique=False)
+    op.create_index(op.f('ix_scan_job_utilisateur_id'), 'scan_job', ['utilisateur_id'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_scan_job_utilisateur_id'), table_name='scan_job')
+    op.drop_index('ix_scan_job_statut_id', table_name='scan_job')
+    op.drop_table('scan_job')
+    op.drop_index(op.f('ix_message_id'), table_name='message')
+    op.drop_table('message')
+    op.drop_table('medicaments')
+    op.drop_table('quota_usage')
+    op.drop_table('ordonnance')
+    op.drop_index(op.f('ix_events_id'), table_name='events')
+    op.drop_table('events')
+    op.drop_index(op.f('ix_conversation_id'), table_name='conversation')
+    op.drop_table('conversation')
+    op.drop_index(op.f('ix_antecedent_medical_id'), table_name='antecedent_medical')
+    op.drop_table('antecedent_medical')
+    op.drop_table('allergies')
+    op.drop_table('utilisateur')
@@ -0,0 +1,55 @@
+"""index des requêtes fréquentes
+
+Index sur les clés étrangères et les tris des listes (messages d'une
+conversation, conversations, agenda, ordonnances, médicaments, allergies).
+Créés avec CREATE INDEX CONCURRENTLY, hors transaction : les tables restent
+accessibles en écriture pendant la construction.
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-19
+"""
+from alembic import op
+
+revision = '0002'
+down_revision = '0001'
+branch_labels = None
+depends_on = None
+
+# (nom, table, colonnes)
+INDEXES = [
+    ("ix_message_conversation_id", "message", ["conversation_id"]),
+    ("ix_conversation_utilisateur_activite", "conversation", ["utilisateur_id", "date_derniere_activite"]),
+    ("ix_events_utilisateur_start", "events", ["utilisateur_id", "start_dt"]),
+    ("ix_ordonnance_utilisateur_date", "ordonnance", ["utilisateur_id", "date_ordonnance"]),
+    ("ix_medicaments_ordonnance_id", "medicaments", ["ordonnance_id"]),
+    ("ix_allergies_utilisateur_id", "allergies", ["utilisateur_id"]),
+]
+
+
+def _drop_if_invalid(name: str) -> None:
+    # Un CREATE INDEX CONCURRENTLY interrompu laisse un index invalide que
+    # IF NOT EXISTS ignorerait : on le supprime avant de recommencer
+    if op.get_context().as_sql:
+        return
+    invalid = op.get_bind().exec_driver_sql(
+        "SELECT 1 FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+        "WHERE c.relname = %(name)s AND NOT i.indisvalid",
+        {"name": name},
+    ).first()
+    if invalid:
+        op.drop_index(name, postgresql_concurrently=True)
+
+
+def upgrade() -> None:
+    with op.get_context().autocommit_block():
+        for name, table, columns in INDEXES:
+            _drop_if_invalid(name)
+            # IF NOT EXISTS : l'index des conversations a pu être créé par l'ancien init_db
+            op.create_index(name, table, columns, postgresql_concurrently=True, if_not_exists=True)
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        for name, _, _ in reversed(INDEXES):
+            op.drop_index(name, postgresql_concurrently=True, if_exists=True)
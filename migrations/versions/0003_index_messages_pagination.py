@@ -0,0 +1,34 @@
+"""index de pagination des messages
+
+(conversation_id, id) pour la pagination par curseur de
+GET /conversations/{id} ; remplace l'index sur conversation_id seul, dont il
+est un préfixe.
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-19
+"""
+from alembic import op
+
+revision = '0003'
+down_revision = '0002'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.create_index(
+            "ix_message_conversation_id_id", "message", ["conversation_id", "id"],
+            postgresql_concurrently=True, if_not_exists=True,
+        )
+        op.drop_index("ix_message_conversation_id", table_name="message", postgresql_concurrently=True, if_exists=True)
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.create_index(
+            "ix_message_conversation_id", "message", ["conversation_id"],
+            postgresql_concurrently=True, if_not_exists=True,
+        )
+        op.drop_index("ix_message_conversation_id_id", table_name="message", postgresql_concurrently=True, if_exists=True)
@@ -8,6 +8,8 @@ from .event import Event
 
 from .conversation import Conversation  # Ajout
 from .message import Message  # Ajout
+from .quota import QuotaUsage
+from .scan_job import ScanJob
 from .event import Event 
 
 
@@ -21,4 +23,6 @@ __all__ = [
     "Event",
     "Conversation",
     "Message",
+    "QuotaUsage",
+    "ScanJob",
 ]
\ No newline at end of file
@@ -6,7 +6,7 @@ class Allergie(Base):
     __tablename__ = 'allergies'
 
     id = Column(Integer, primary_key=True, autoincrement=True)
-    utilisateur_id = Column(Integer, ForeignKey('utilisateur.id'), nullable=False)
+    utilisateur_id = Column(Integer, ForeignKey('utilisateur.id'), nullable=False, index=True)
     nom = Column(String, nullable=True, default="")
     description_allergie = Column(Text, nullable=True, default="")
 
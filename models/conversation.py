@@ -1,16 +1,25 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, DateTime
+from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Index
 from sqlalchemy.orm import relationship
 from datetime import datetime
 from .base import Base
 
+# Longueur de l'aperçu du dernier message gardé sur la conversation
+PREVIEW_LENGTH = 200
+
 class Conversation(Base):
     __tablename__ = "conversation"
+    # Liste des conversations d'un utilisateur, par activité
+    __table_args__ = (Index("ix_conversation_utilisateur_activite", "utilisateur_id", "date_derniere_activite"),)
     
     id = Column(Integer, primary_key=True, index=True)
     utilisateur_id = Column(Integer, ForeignKey("utilisateur.id"), nullable=False)
     titre = Column(String, nullable=False)
     date_creation = Column(DateTime, nullable=False, default=datetime.utcnow)
     date_derniere_activite = Column(DateTime, nullable=False, default=datetime.utcnow)
+    # Dénormalisés, tenus à jour par add_message_to_conversation : la liste
+    # des conversations ne charge pas les messages
+    nb_messages = Column(Integer, nullable=False, default=0, server_default="0")
+    last_message_preview = Column(String(PREVIEW_LENGTH), nullable=True)
     
     # Relations
     utilisateur = relationship("Utilisateur", back_populates="conversations")
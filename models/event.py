@@ -1,9 +1,11 @@
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Boolean
+from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Boolean, Index
 from sqlalchemy.orm import relationship
 from .base import Base
 
 class Event(Base):
     __tablename__ = "events"
+    # Agenda d'un utilisateur, par date de début
+    __table_args__ = (Index("ix_events_utilisateur_start", "utilisateur_id", "start_dt"),)
 
     id = Column(Integer, primary_key=True, index=True)
     utilisateur_id = Column(Integer, ForeignKey("utilisateur.id"), nullable=False)
@@ -7,7 +7,7 @@ class Medicament(Base):
     __tablename__ = 'medicaments'
 
     id = Column(Integer, primary_key=True, autoincrement=True)
-    ordonnance_id = Column(Integer, ForeignKey('ordonnance.id'), nullable=False)
+    ordonnance_id = Column(Integer, ForeignKey('ordonnance.id'), nullable=False, index=True)
     nom = Column(String, nullable=True, default="")
     description_medicaments = Column(Text, nullable=True, default="")
     dose = Column(String, nullable=True, default="")
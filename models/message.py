@@ -1,10 +1,12 @@
-from sqlalchemy import Column, Integer, String, Text, ForeignKey, DateTime
+from sqlalchemy import Column, Integer, String, Text, ForeignKey, DateTime, Index
 from sqlalchemy.orm import relationship
 from datetime import datetime
 from .base import Base
 
 class Message(Base):
     __tablename__ = "message"
+    # Pagination par curseur des messages d'une conversation (id décroissant)
+    __table_args__ = (Index("ix_message_conversation_id_id", "conversation_id", "id"),)
 
     id = Column(Integer, primary_key=True, index=True)
     conversation_id = Column(Integer, ForeignKey("conversation.id"), nullable=False)
@@ -1,14 +1,18 @@
-from sqlalchemy import Column, Integer, String, Text, Date, ForeignKey
+from sqlalchemy import Column, Integer, String, Text, Date, ForeignKey, Index
 from sqlalchemy.orm import relationship
 from .base import Base
 
 class Ordonnance(Base):
     __tablename__ = 'ordonnance'
+    # Ordonnances d'un utilisateur, par date
+    __table_args__ = (Index("ix_ordonnance_utilisateur_date", "utilisateur_id", "date_ordonnance"),)
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     utilisateur_id = Column(Integer, ForeignKey('utilisateur.id'), nullable=False)
     nom = Column(String, nullable=True, default="")
     date_ordonnance = Column(Date, nullable=False)
+    # sha256 de l'image scannée dans le stockage adressé par contenu (services/blob_store.py)
+    image_sha256 = Column(String(64), nullable=True)
    
     utilisateur = relationship("Utilisateur", back_populates="ordonnances")
     medicaments = relationship("Medicament", back_populates="ordonnance", cascade="all, delete")
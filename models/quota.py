@@ -0,0 +1,15 @@
+from sqlalchemy import Column, Integer, BigInteger, String, Date, ForeignKey, UniqueConstraint
+from .base import Base
+
+class QuotaUsage(Base):
+    """Consommation LLM agrégée par utilisateur et par période (jour / mois)."""
+    __tablename__ = "quota_usage"
+    __table_args__ = (UniqueConstraint("utilisateur_id", "periode", "debut_periode", name="uq_quota_usage_periode"),)
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    utilisateur_id = Column(Integer, ForeignKey("utilisateur.id", ondelete="CASCADE"), nullable=False)
+    periode = Column(String(8), nullable=False)  # "day" | "month"
+    debut_periode = Column(Date, nullable=False)
+    nb_requetes = Column(Integer, nullable=False, default=0)
+    tokens_entree = Column(BigInteger, nullable=False, default=0)
+    tokens_sortie = Column(BigInteger, nullable=False, default=0)
@@ -0,0 +1,27 @@
+from sqlalchemy import Column, Integer, String, Text, Date, DateTime, ForeignKey, Index, JSON, func
+from .base import Base
+
+class ScanJob(Base):
+    """
+    File d'attente des scans asynchrones. Les workers réservent les jobs avec
+    FOR UPDATE SKIP LOCKED ; un job "en_cours" dont le bail a expiré (worker
+    tué) est repris par un autre. Sur un job "en_attente", le bail est le délai
+    avant nouvelle tentative après une erreur passagère.
+    """
+    __tablename__ = "scan_job"
+    __table_args__ = (Index("ix_scan_job_statut_id", "statut", "id"),)
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    utilisateur_id = Column(Integer, ForeignKey("utilisateur.id", ondelete="CASCADE"), nullable=False, index=True)
+    statut = Column(String(16), nullable=False, default="en_attente")  # en_attente | en_cours | termine | echec
+    chemin_fichier = Column(String, nullable=False)
+    nom_fichier = Column(String, nullable=True)
+    type_contenu = Column(String, nullable=True)
+    valid_until = Column(Date, nullable=True)
+    resultats = Column(JSON, nullable=True)  # résultats partiels (pages) puis finaux
+    ordonnance_id = Column(Integer, ForeignKey("ordonnance.id", ondelete="SET NULL"), nullable=True)
+    erreur = Column(Text, nullable=True)
+    tentatives = Column(Integer, nullable=False, default=0)
+    bail_jusqu_a = Column(DateTime(timezone=True), nullable=True)
+    cree_le = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+    termine_le = Column(DateTime(timezone=True), nullable=True)
@@ -4,6 +4,7 @@ from database.database import get_db
 from database.schemas import EventCreate, EventOut
 import database.controller as crud
 from database.auth import get_current_user
+from services.broker import get_broker, user_topic
 from pydantic import BaseModel
 
 
@@ -11,21 +12,31 @@ router = APIRouter(prefix="/calendar", tags=["Calendar"])
 
 class DonePayload(BaseModel):
     done: bool
-    
+
+def _publish_calendar(user_id: int, action: str, **payload):
+    """Pousse la modification aux onglets ouverts de l'utilisateur."""
+    get_broker().publish(user_topic(user_id), {"type": "calendar.updated", "action": action, **payload})
+
+def _event_payload(ev) -> dict:
+    return EventOut.model_validate(ev).model_dump(mode="json")
+
 @router.get("/events", response_model=list[EventOut])
 def list_events(db: Session = Depends(get_db), current_user = Depends(get_current_user)):
     return crud.list_events_for_user(db, current_user.id)
 
 @router.post("/events", response_model=EventOut)
 def create_event(event: EventCreate, db: Session = Depends(get_db), current_user = Depends(get_current_user)):
-    return crud.create_event(db, current_user.id, event)
-    
+    ev = crud.create_event(db, current_user.id, event)
+    _publish_calendar(current_user.id, "created", event=_event_payload(ev))
+    return ev
+
 
 @router.delete("/events/{event_id}")
 def remove_event(event_id: int, db: Session = Depends(get_db), current_user = Depends(get_current_user)):
     ok = crud.delete_event(db, current_user.id, event_id)
     if not ok:
         raise HTTPException(404, "Event not found")
+    _publish_calendar(current_user.id, "deleted", event_id=event_id)
     return {"ok": True}
 
 @router.patch("/events/{event_id}/done", response_model=EventOut)
@@ -33,4 +44,5 @@ def set_event_done(event_id: int, payload: DonePayload, db: Session = Depends(ge
     ev = crud.update_event_done(db, current_user.id, event_id, payload.done)
     if not ev:
         raise HTTPException(status_code=404, detail="Événement introuvable")
-    return ev
\ No newline at end of file
+    _publish_calendar(current_user.id, "updated", event=_event_payload(ev))
+    return ev
@@ -0,0 +1,9 @@
+from fastapi import APIRouter
+from services import metrics
+
+router = APIRouter(tags=["Metrics"])
+
+@router.get("/metrics")
+def get_metrics():
+    """Instantané des métriques internes (LLM, files, pool DB…)."""
+    return metrics.snapshot()
@@ -1,13 +1,28 @@
-from fastapi import APIRouter, UploadFile, File, Form, Depends, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
 from sqlalchemy.orm import Session
-from typing import Optional
+from typing import List, Optional
 from datetime import datetime
-from database.database import get_db
-from database.controller import create_ordonnance_with_meds, get_ordonnances_par_utilisateur
-from services.ordo_extract import extract_meds
+import asyncio
+import json
+import logging
+import os
+from sqlalchemy.ext.asyncio import AsyncSession
+from database.database import get_async_db, get_db, SessionLocal
+from database.controller import (
+    create_ordonnance_with_meds, create_ordonnance_with_meds_async, create_ordonnances_with_meds_bulk,
+    get_ordonnances_par_utilisateur, image_belongs_to_user,
+)
+from services.ordo_extract import extract_meds_async, iter_pdf_meds, merge_meds
+from services.ocr_pool import OCRUnavailable
+from services.hybrid_extract import extract_prescription
+from services.quota import QuotaExceeded
+from services.resilience import LLMUnavailable
+from services.scan_jobs import enqueue_scan_job, job_as_dict, jobs_dir
+from services.blob_store import get_blob_store, is_digest
+from server.uploads import StagedUpload, receive_multipart
 from models import Utilisateur
-from database.auth import get_current_user
+from database.auth import get_current_user, get_current_user_async
 
 router = APIRouter(prefix="/ordonnances", tags=["ordonnances"])
 
@@ -26,35 +41,341 @@ def list_ordonnances(
             "id": o.id,
             "title": o.nom or f"Ordonnance du {o.date_ordonnance.strftime('%d/%m/%Y')}",
             "date": o.date_ordonnance.isoformat(),
-            "image": "/images/dna.png" # Image par défaut
+            # Miniature de l'image scannée ; image par défaut pour les ordonnances sans image
+            "image": f"/ordonnances/images/{o.image_sha256}/miniature" if o.image_sha256 else "/images/dna.png",
+            "image_originale": f"/ordonnances/images/{o.image_sha256}" if o.image_sha256 else None,
         })
     return results
 
+# Données médicales : cache du navigateur uniquement, jamais des caches partagés
+IMAGE_CACHE_CONTROL = "private, max-age=31536000, immutable"
+
+def _owned_image(db: Session, sha256: str, current_user: Utilisateur):
+    """Stockage d'images si `sha256` est une image d'une ordonnance de l'utilisateur, sinon 404."""
+    store = get_blob_store()
+    if (
+        not is_digest(sha256)
+        or not image_belongs_to_user(db, sha256, current_user.id)
+        or not store.exists(sha256)
+    ):
+        raise HTTPException(404, "Image introuvable")
+    return store
+
+@router.get("/images/{sha256}")
+def get_ordonnance_image(
+    sha256: str,
+    request: Request,
+    db: Session = Depends(get_db),
+    current_user: Utilisateur = Depends(get_current_user),
+):
+    """Image scannée, adressée par son sha256 : contenu immuable, mis en cache sans limite."""
+    store = _owned_image(db, sha256, current_user)
+    return _immutable_file(request, store.path_for(sha256), f'"{sha256}"', store.content_type(sha256))
+
+@router.get("/images/{sha256}/miniature")
+def get_ordonnance_thumbnail(
+    sha256: str,
+    request: Request,
+    db: Session = Depends(get_db),
+    current_user: Utilisateur = Depends(get_current_user),
+):
+    """
+    Miniature WebP. Tant qu'elle n'est pas générée, l'original est renvoyé
+    avec un cache court (la miniature est relancée au passage).
+    """
+    store = _owned_image(db, sha256, current_user)
+    thumbnail = store.thumbnail_path(sha256)
+    if os.path.exists(thumbnail):
+        return _immutable_file(request, thumbnail, f'"{sha256}-miniature"', "image/webp")
+    store.schedule_thumbnail(sha256)
+    return FileResponse(
+        store.path_for(sha256), media_type=store.content_type(sha256), headers={"Cache-Control": "private, max-age=60"}
+    )
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Comparaison faible (RFC 9110) de l'ETag avec chaque valeur de If-None-Match."""
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*":
+            return True
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+def _immutable_file(request: Request, path: str, etag: str, media_type: str) -> Response:
+    headers = {"ETag": etag, "Cache-Control": IMAGE_CACHE_CONTROL}
+    if _etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    return FileResponse(path, media_type=media_type, headers=headers)
+
+async def _keep_image(staged: StagedUpload) -> str:
+    """Range le fichier scanné dans le stockage d'images (déplacé, pas copié) ; retourne son sha256."""
+    store = get_blob_store()
+    digest = await asyncio.to_thread(store.put_file, staged.path, staged.sha256)
+    store.schedule_thumbnail(digest)
+    return digest
+
 @router.post("/scan")
 async def scan_ordonnance(
-    utilisateur_id: int = Form(...),
-    valid_until: Optional[str] = Form(None),  # "YYYY-MM-DD"
-    image: Optional[UploadFile] = File(None),
-    db: Session = Depends(get_db),
+    request: Request,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: Utilisateur = Depends(get_current_user_async),
 ):
-    image_bytes = await image.read() if image else None
-    meds = extract_meds(image_bytes, typed_text=ocr_text)
-    if not meds:
-        raise HTTPException(status_code=422, detail="Impossible d'extraire des médicaments.")
+    """
+    Formulaire multipart : valid_until ("YYYY-MM-DD"), image et/ou ocr_text
+    (texte déjà OCRisé côté client, en repli).
+    Image : OCR local, puis modèle si la confiance est insuffisante ; réponse
+    JSON unique avec le chemin retenu ("source"), la confiance et les latences.
+    PDF : réponse NDJSON, une ligne par page dès qu'elle est traitée
+    ({"type": "page", ...}), puis l'ordonnance fusionnée ({"type": "ordonnance", ...})
+    ou {"type": "erreur", ...} si aucun médicament n'a été trouvé.
+    """
+    # Corps lu en flux (pas de File/Form) : la limite de taille coupe la réception
+    form = await receive_multipart(request, "image")
+    staged = form.files[0] if form.files else None
+    # Image et ordonnance rattachées à l'utilisateur du jeton (plus de utilisateur_id client)
+    utilisateur_id = current_user.id
+    valid_until = form.fields.get("valid_until") or None
+    ocr_text = form.fields.get("ocr_text") or None
+    valid_dt = _parse_valid_until(valid_until)
+    if staged is not None and staged.is_pdf:
+        return await _scan_pdf(staged, utilisateur_id, valid_dt, valid_until)
+
+    try:
+        extra = {}
+        meds = []
+        if staged is not None:
+            try:
+                # Quota décompté à l'utilisateur du jeton, jamais à un id envoyé par le client
+                extraction = await extract_prescription(staged.path, user_id=utilisateur_id)
+            except QuotaExceeded:
+                raise HTTPException(status_code=429, detail="Quota d'analyses atteint, merci de réessayer plus tard.")
+            except LLMUnavailable:
+                raise HTTPException(status_code=503, detail="Trop de scans en cours, merci de réessayer.", headers={"Retry-After": "5"})
+            if extraction:
+                meds = extraction.medicaments
+                extra = {
+                    "source": extraction.source,
+                    "confiance": round(extraction.confiance, 3),
+                    "latences_ms": {k: round(v * 1000) for k, v in extraction.latences.items()},
+                }
+        if not meds and ocr_text:
+            meds = await extract_meds_async(None, typed_text=ocr_text)
+        if not meds:
+            raise HTTPException(status_code=422, detail="Impossible d'extraire des médicaments.")
 
-    valid_dt = None
-    if valid_until:
+        # L'image n'est gardée que si une ordonnance est enregistrée
+        image_sha256 = await _keep_image(staged) if staged is not None else None
+        ordon = await create_ordonnance_with_meds_async(
+            db, utilisateur_id=utilisateur_id, valid_until=valid_dt, meds=meds, image_sha256=image_sha256
+        )
+    finally:
+        if staged is not None:
+            staged.discard()  # sans effet si le fichier a été rangé dans le stockage
+    return {"id": ordon.id, "medicaments": meds, "valid_until": valid_until, **extra}
+
+def _parse_valid_until(valid_until: Optional[str]):
+    if not valid_until:
+        return None
+    try:
+        return datetime.strptime(valid_until, "%Y-%m-%d").date()
+    except ValueError:
+        return None
+
+def _save_ordonnance(utilisateur_id: int, valid_dt, meds, image_sha256: Optional[str] = None) -> int:
+    # Session propre au flux : celle de la dépendance peut être fermée avant la fin de la réponse
+    db = SessionLocal()
+    try:
+        return create_ordonnance_with_meds(
+            db, utilisateur_id=utilisateur_id, valid_until=valid_dt, meds=meds, image_sha256=image_sha256
+        ).id
+    finally:
+        db.close()
+
+async def _scan_pdf(staged: StagedUpload, utilisateur_id: int, valid_dt, valid_until: Optional[str]) -> StreamingResponse:
+    pages = iter_pdf_meds(staged.path)
+    try:
+        # Première page attendue avant de répondre : un PDF illisible ou sans
+        # moteur de rendu donne encore un vrai code HTTP
+        first = await pages.__anext__()
+    except StopAsyncIteration:
+        staged.discard()
+        raise HTTPException(status_code=422, detail="PDF sans page.")
+    except OCRUnavailable as e:
+        staged.discard()
+        raise HTTPException(status_code=503, detail=str(e))
+    except Exception:
+        staged.discard()
+        raise HTTPException(status_code=422, detail="PDF illisible.")
+
+    async def body():
+        found = []
         try:
-            valid_dt = datetime.strptime(valid_until, "%Y-%m-%d").date()
-        except ValueError:
-            pass
+            try:
+                page = first
+                while True:
+                    if "medicaments" in page:
+                        found.append((page["page"], page["medicaments"]))
+                    yield json.dumps({"type": "page", **page}, ensure_ascii=False) + "\n"
+                    try:
+                        page = await pages.__anext__()
+                    except StopAsyncIteration:
+                        break
+            finally:
+                await pages.aclose()
 
+            # Pages reçues dans l'ordre d'achèvement : fusion dans l'ordre du document
+            meds = merge_meds(m for _, m in sorted(found, key=lambda item: item[0]))
+            if not meds:
+                yield json.dumps({"type": "erreur", "detail": "Impossible d'extraire des médicaments."}, ensure_ascii=False) + "\n"
+                return
+            image_sha256 = await _keep_image(staged)
+            ordon_id = await asyncio.to_thread(_save_ordonnance, utilisateur_id, valid_dt, meds, image_sha256)
+            yield json.dumps(
+                {"type": "ordonnance", "id": ordon_id, "medicaments": meds, "valid_until": valid_until}, ensure_ascii=False
+            ) + "\n"
+        finally:
+            staged.discard()
 
+    return StreamingResponse(body(), media_type="application/x-ndjson")
 
-    ordon = create_ordonnance_with_meds(
-        db, utilisateur_id=utilisateur_id, valid_until=valid_dt, meds=meds
-    )
-    return {"id": ordon.id, "medicaments": meds, "valid_until": valid_until}
+SCAN_BATCH_MAX_FILES = int(os.getenv("SCAN_BATCH_MAX_FILES", "50"))
+
+@router.post("/scan/batch")
+async def scan_ordonnances_batch(
+    request: Request,
+    current_user: Utilisateur = Depends(get_current_user),
+):
+    """
+    Formulaire multipart : fichiers (un ou plusieurs) et valid_until
+    ("YYYY-MM-DD", appliqué à tout le lot).
+    Scan de plusieurs ordonnances (images ou PDF) en une requête. Les fichiers
+    sont traités en parallèle (SCAN_BATCH_CONCURRENCY à la fois) ; réponse
+    NDJSON avec une ligne par fichier dès qu'il est prêt
+    ({"type": "fichier", "index": 0, ...}), puis les ids créés
+    ({"type": "enregistrement", ...}) : toutes les ordonnances du lot sont
+    écrites dans une seule transaction.
+    """
+    utilisateur_id = current_user.id
+    # Fichiers copiés sur disque pendant la réception, avant de répondre
+    form = await receive_multipart(request, "fichiers", max_files=SCAN_BATCH_MAX_FILES)
+    staged: List[StagedUpload] = form.files
+    if not staged:
+        raise HTTPException(status_code=422, detail="Aucun fichier reçu.")
+    valid_until = form.fields.get("valid_until") or None
+    valid_dt = _parse_valid_until(valid_until)
+
+    concurrency = int(os.getenv("SCAN_BATCH_CONCURRENCY", "4"))
+
+    async def body():
+        slots = asyncio.Semaphore(concurrency)
+
+        async def scan_one(index: int, item: StagedUpload):
+            async with slots:
+                line = {"type": "fichier", "index": index, "nom_fichier": item.filename}
+                try:
+                    meds, extra = await _extract_file(item, utilisateur_id)
+                except QuotaExceeded:
+                    return {**line, "erreur": "Quota d'analyses atteint"}, None
+                except LLMUnavailable:
+                    return {**line, "erreur": "Analyse indisponible, merci de réessayer."}, None
+                except Exception as e:
+                    logging.getLogger(__name__).warning(f"Échec du scan de {item.filename}: {e}")
+                    return {**line, "erreur": "Fichier illisible"}, None
+                if not meds:
+                    return {**line, "erreur": "Impossible d'extraire des médicaments."}, None
+                return {**line, "medicaments": meds, **extra}, meds
+
+        tasks = [asyncio.create_task(scan_one(i, item)) for i, item in enumerate(staged)]
+        extracted = {}
+        try:
+            try:
+                for next_done in asyncio.as_completed(tasks):
+                    line, meds = await next_done
+                    if meds:
+                        extracted[line["index"]] = meds
+                    yield json.dumps(line, ensure_ascii=False) + "\n"
+            finally:
+                for task in tasks:
+                    task.cancel()
+
+            if not extracted:
+                yield json.dumps({"type": "enregistrement", "ordonnances": []}) + "\n"
+                return
+            indexes = sorted(extracted)
+            images = [await _keep_image(staged[i]) for i in indexes]
+            ids = await asyncio.to_thread(_save_batch, utilisateur_id, valid_dt, [extracted[i] for i in indexes], images)
+            yield json.dumps({
+                "type": "enregistrement",
+                "ordonnances": [{"index": i, "id": ordon_id} for i, ordon_id in zip(indexes, ids)],
+                "valid_until": valid_until,
+            }) + "\n"
+        finally:
+            for item in staged:
+                item.discard()
+
+    return StreamingResponse(body(), media_type="application/x-ndjson")
+
+async def _extract_file(staged: StagedUpload, utilisateur_id: int):
+    """(médicaments, infos d'extraction) pour un fichier du lot, image ou PDF."""
+    if staged.is_pdf:
+        pages = [page async for page in iter_pdf_meds(staged.path)]
+        pages.sort(key=lambda page: page["page"])
+        return merge_meds(page["medicaments"] for page in pages if "medicaments" in page), {"pages": len(pages)}
+
+    extraction = await extract_prescription(staged.path, user_id=utilisateur_id)
+    if extraction is None:
+        return [], {}
+    return extraction.medicaments, {"source": extraction.source, "confiance": round(extraction.confiance, 3)}
+
+def _save_batch(utilisateur_id: int, valid_dt, meds_par_ordonnance, images_sha256=None) -> List[int]:
+    db = SessionLocal()
+    try:
+        return create_ordonnances_with_meds_bulk(db, utilisateur_id, valid_dt, meds_par_ordonnance, images_sha256)
+    finally:
+        db.close()
+
+@router.post("/scan/jobs", status_code=202)
+async def create_scan_job(
+    request: Request,
+    db: Session = Depends(get_db),
+    current_user: Utilisateur = Depends(get_current_user),
+):
+    """
+    Scan asynchrone (image ou PDF), formulaire multipart : image et
+    valid_until ("YYYY-MM-DD"). Répond tout de suite avec l'id du job.
+    Suivi par GET /ordonnances/scan/jobs/{job_id} ; la fin du traitement est
+    aussi poussée sur la WebSocket ({"type": "scan.termine", ...}).
+    """
+    form = await receive_multipart(request, "image", directory=jobs_dir())
+    if not form.files:
+        raise HTTPException(status_code=422, detail="Aucun fichier reçu.")
+    staged = form.files[0]
+    try:
+        job = await asyncio.to_thread(
+            enqueue_scan_job, db, current_user.id, staged.path, staged.filename, staged.content_type,
+            _parse_valid_until(form.fields.get("valid_until")),
+        )
+    except BaseException:
+        staged.discard()
+        raise
+    return {"job_id": job.id, "statut": job.statut}
+
+@router.get("/scan/jobs/{job_id}")
+def get_scan_job(
+    job_id: int,
+    db: Session = Depends(get_db),
+    current_user: Utilisateur = Depends(get_current_user),
+):
+    from models import ScanJob
+    job = db.get(ScanJob, job_id)
+    if job is None or job.utilisateur_id != current_user.id:
+        raise HTTPException(404, "Scan introuvable")
+    return job_as_dict(job)
 
 @router.get("/{ordonnance_id}")
 def get_ordonnance(ordonnance_id: int, db: Session = Depends(get_db)):
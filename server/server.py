@@ -1,4 +1,5 @@
 import asyncio
+import contextlib
 import json
 import websockets
 import sys
@@ -17,29 +18,35 @@ from urllib.parse import unquote
 from threading import Thread
 from typing import List, Optional
 import uvicorn
-import re
 
 
-from fastapi import FastAPI, Depends, HTTPException, Response, BackgroundTasks
+from fastapi import FastAPI, Depends, HTTPException, Response, BackgroundTasks, Query
 from fastapi.responses import RedirectResponse
 from fastapi.middleware.cors import CORSMiddleware
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 from pydantic import BaseModel, EmailStr
 from jose import jwt, JWTError
 
 # Routes modulaires
-from server.routes import ordonnances, calendar
+from server.routes import ordonnances, calendar, metrics as metrics_routes
 
 # ── Chemin projet
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 # Services / DB / Auth
-from services.service import generate_response, generate_response_with_tools, system_instruction
-from database.database import bootstrap_database, init_db, get_db, SessionLocal
+from services.service import generate_response, generate_response_with_tools, extract_medications
+from services.resilience import LLMUnavailable
+from services.gateway import GatewayBusy
+from services.quota import QuotaExceeded
+from database.database import bootstrap_database, migrate_db, get_db, get_async_db, async_session
 from services.ordo_extract import extract_meds
-from database.auth import AuthService, get_current_user, get_current_user_optional
+from services.hybrid_extract import extract_prescription
+from services.scan_jobs import get_scan_worker
+from services.blob_store import get_blob_store
+from services.broker import get_broker, Subscription, user_topic, conversation_topic
+from database.auth import AuthService, get_current_user, get_current_user_async, get_current_user_optional_async
 import database.controller as crud
-from database.controller import create_ordonnance_with_meds
 import database.schemas as schemas
 import models
 
@@ -62,6 +69,13 @@ HOST = os.getenv("HOST", "0.0.0.0")
 WEBSOCKET_PORT = int(os.getenv("WEBSOCKET_PORT", "8090"))
 FASTAPI_PORT   = int(os.getenv("FASTAPI_PORT", "8080"))
 
+LLM_UNAVAILABLE_MESSAGE = "Sorrel est momentanément indisponible, merci de réessayer dans quelques instants."
+LLM_BUSY_MESSAGE = "Sorrel est très sollicité en ce moment, merci de réessayer d'ici quelques secondes."
+QUOTA_MESSAGES = {
+    "day": "Vous avez atteint votre limite d'utilisation pour aujourd'hui. Elle sera réinitialisée demain.",
+    "month": "Vous avez atteint votre limite d'utilisation pour ce mois-ci.",
+}
+
 # Stockage in-memory par socket
 conversations = {}
 _consumed_jti = set()
@@ -85,6 +99,7 @@ app.add_middleware(
 
 app.include_router(ordonnances.router)
 app.include_router(calendar.router)
+app.include_router(metrics_routes.router)
 
 # ──────────────────────────────────────────────────────────────────────────────
 # Utils
@@ -116,6 +131,24 @@ def _mask(tok: str) -> str:
 def _build_front_url(path: str) -> str:
     return f"{FRONTEND_URL.rstrip('/')}/{path.lstrip('/')}"
 
+def _conversation_summary(conversation) -> dict:
+    return {
+        "id": conversation.id,
+        "titre": conversation.titre,
+        "date_creation": conversation.date_creation.isoformat(),
+        "date_derniere_activite": conversation.date_derniere_activite.isoformat(),
+        "nb_messages": conversation.nb_messages or 0,
+        "last_message_preview": conversation.last_message_preview,
+    }
+
+def _message_to_dict(msg) -> dict:
+    return {
+        "id": msg.id,
+        "role": msg.role,
+        "contenu": msg.contenu,
+        "timestamp": msg.timestamp.isoformat()
+    }
+
 # ──────────────────────────────────────────────────────────────────────────────
 # Mail: lien sécurisé (reset / magic-link)
 # ──────────────────────────────────────────────────────────────────────────────
@@ -171,8 +204,8 @@ def _send_email_link(to_email: str, link: str):
 
 
 @app.post("/mail/send-secure-link", tags=["Mail"])
-async def send_secure_link(payload: SecureLinkRequest, background: BackgroundTasks, db: Session = Depends(get_db)):
-    user = crud.get_utilisateur_by_email(db, email=payload.email)
+async def send_secure_link(payload: SecureLinkRequest, background: BackgroundTasks, db: AsyncSession = Depends(get_async_db)):
+    user = await crud.get_utilisateur_by_email_async(db, email=payload.email)
     user_id = str(user.id) if user else "anonymous"
 
     jti = str(uuid.uuid4())
@@ -198,7 +231,7 @@ class ResetPasswordRequest(BaseModel):
     new_password: str
 
 @app.post("/auth/reset-password", tags=["Authentication"])
-async def reset_password(data: ResetPasswordRequest, db: Session = Depends(get_db)):
+async def reset_password(data: ResetPasswordRequest, db: AsyncSession = Depends(get_async_db)):
     payload = AuthService.verify_access_token(data.token, JWT_SECRET, JWT_ALG)
     if not payload or payload.get("purpose") != "magic-link":
         raise HTTPException(status_code=400, detail="Token invalide ou expiré")
@@ -207,12 +240,12 @@ async def reset_password(data: ResetPasswordRequest, db: Session = Depends(get_d
     if not user_id or user_id == "anonymous":
         raise HTTPException(status_code=400, detail="Utilisateur introuvable")
 
-    user = crud.get_utilisateur(db, utilisateur_id=int(user_id))
+    user = await crud.get_utilisateur_async(db, utilisateur_id=int(user_id))
     if not user:
         raise HTTPException(status_code=404, detail="Utilisateur introuvable")
 
-    hashed = AuthService.get_password_hash(data.new_password)
-    crud.update_utilisateur_password(db, utilisateur_id=user.id, hashed_password=hashed)
+    hashed = await asyncio.to_thread(AuthService.get_password_hash, data.new_password)
+    await crud.update_utilisateur_password_async(db, utilisateur_id=user.id, hashed_password=hashed)
 
     return {"message": "Mot de passe réinitialisé avec succès"}
 
@@ -220,13 +253,13 @@ async def reset_password(data: ResetPasswordRequest, db: Session = Depends(get_d
 # Auth routes
 # ──────────────────────────────────────────────────────────────────────────────
 @app.post("/auth/register", tags=["Authentication"])
-async def register(user_data: schemas.RegisterRequest, response: Response, db: Session = Depends(get_db)):
+async def register(user_data: schemas.RegisterRequest, response: Response, db: AsyncSession = Depends(get_async_db)):
     try:
-        db_user = crud.get_utilisateur_by_email(db, email=user_data.email)
+        db_user = await crud.get_utilisateur_by_email_async(db, email=user_data.email)
         if db_user:
             raise HTTPException(status_code=400, detail="Un compte avec cet email existe déjà")
 
-        new_user = crud.create_utilisateur_simple(
+        new_user = await crud.create_utilisateur_simple_async(
             db=db,
             email=user_data.email,
             mot_de_passe=user_data.mot_de_passe,
@@ -251,9 +284,9 @@ async def register(user_data: schemas.RegisterRequest, response: Response, db: S
         raise HTTPException(status_code=500, detail=f"Erreur serveur: {str(e)}")
 
 @app.post("/auth/login", tags=["Authentication"])
-async def login(login_data: schemas.LoginRequest, response: Response, db: Session = Depends(get_db)):
+async def login(login_data: schemas.LoginRequest, response: Response, db: AsyncSession = Depends(get_async_db)):
     try:
-        user = AuthService.authenticate_user(db, login_data.email, login_data.mot_de_passe)
+        user = await AuthService.authenticate_user_async(db, login_data.email, login_data.mot_de_passe)
         if not user:
             raise HTTPException(status_code=401, detail="Email ou mot de passe incorrect")
 
@@ -312,15 +345,15 @@ async def consume_link(token: str, response: Response):
         return RedirectResponse(fallback_err, status_code=302)
 
 @app.get("/auth/me", tags=["Authentication"])
-async def get_current_user_info(current_user = Depends(get_current_user), db: Session = Depends(get_db)):
+async def get_current_user_info(current_user = Depends(get_current_user_async), db: AsyncSession = Depends(get_async_db)):
     is_complete = compute_is_profile_complete(current_user)
 
     allergies = []
     antecedents = []
     try:
-        allergies_rows = crud.get_allergies_par_utilisateur(db, current_user.id)
+        allergies_rows = await crud.get_allergies_par_utilisateur_async(db, current_user.id)
         allergies = [{"id": a.id, "nom": a.nom or ""} for a in allergies_rows]
-        antecedent_rows = crud.get_antecedents_par_utilisateur(db, current_user.id)
+        antecedent_rows = await crud.get_antecedents_par_utilisateur_async(db, current_user.id)
         antecedents = [{"id": m.id, "nom": m.nom or ""} for m in antecedent_rows]
     except Exception:
         pass
@@ -341,7 +374,7 @@ async def get_current_user_info(current_user = Depends(get_current_user), db: Se
     }
 
 @app.get("/auth/check", tags=["Authentication"])
-async def check_auth(current_user = Depends(get_current_user_optional)):
+async def check_auth(current_user = Depends(get_current_user_optional_async)):
     if not current_user:
         return {"authenticated": False, "user": None}
     is_complete = compute_is_profile_complete(current_user)
@@ -490,75 +523,64 @@ def delete_antecedent(utilisateur_id: int, antecedent_id: int, db: Session = Dep
 # Conversations (CRUD)
 # ──────────────────────────────────────────────────────────────────────────────
 @app.post("/conversations/", tags=["Conversations"])
-async def create_conversation(data: dict, db: Session = Depends(get_db), current_user = Depends(get_current_user)):
+async def create_conversation(data: dict, db: AsyncSession = Depends(get_async_db), current_user = Depends(get_current_user_async)):
     titre = data.get("titre", "Nouvelle conversation")
-    conversation = crud.create_conversation(db, current_user.id, titre)
-    return {
-        "id": conversation.id,
-        "titre": conversation.titre,
-        "date_creation": conversation.date_creation.isoformat(),
-        "date_derniere_activite": conversation.date_derniere_activite.isoformat()
-    }
+    conversation = await crud.create_conversation_async(db, current_user.id, titre)
+    summary = _conversation_summary(conversation)
+    get_broker().publish(user_topic(current_user.id), {"type": "conversation.created", "conversation": summary})
+    return summary
 
 @app.get("/conversations/", tags=["Conversations"])
-async def get_user_conversations(db: Session = Depends(get_db), current_user = Depends(get_current_user)):
-    convs = crud.get_conversations_by_user(db, current_user.id)
-    return [
-        {
-            "id": conv.id,
-            "titre": conv.titre,
-            "date_creation": conv.date_creation.isoformat(),
-            "date_derniere_activite": conv.date_derniere_activite.isoformat(),
-            "nb_messages": len(conv.messages) if hasattr(conv, 'messages') else 0
-        }
-        for conv in convs
-    ]
+async def get_user_conversations(db: AsyncSession = Depends(get_async_db), current_user = Depends(get_current_user_async)):
+    # Une seule requête : compteur et aperçu sont stockés sur la conversation
+    convs = await crud.get_conversations_by_user_async(db, current_user.id)
+    return [_conversation_summary(conv) for conv in convs]
 
 @app.get("/conversations/{conversation_id}", tags=["Conversations"])
-async def get_conversation(conversation_id: int, db: Session = Depends(get_db), current_user = Depends(get_current_user)):
-    conversation = crud.get_conversation_by_id(db, conversation_id, current_user.id)
+async def get_conversation(
+    conversation_id: int,
+    before: int | None = Query(None, description="id du plus ancien message déjà affiché"),
+    limit: int = Query(50, ge=1, le=200),
+    db: AsyncSession = Depends(get_async_db),
+    current_user = Depends(get_current_user_async),
+):
+    """
+    Conversation et une page de messages, du plus ancien au plus récent. Sans
+    `before`, la page la plus récente ; `next_before` (null s'il n'y a rien
+    de plus ancien) sert de `before` pour la page précédente.
+    """
+    conversation = await crud.get_conversation_by_id_async(db, conversation_id, current_user.id)
     if not conversation:
         raise HTTPException(status_code=404, detail="Conversation not found")
+    messages, next_before = await crud.get_conversation_messages_async(db, conversation_id, before=before, limit=limit)
     return {
-        "id": conversation.id,
-        "titre": conversation.titre,
-        "date_creation": conversation.date_creation.isoformat(),
-        "date_derniere_activite": conversation.date_derniere_activite.isoformat(),
-        "messages": [
-            {
-                "id": msg.id,
-                "role": msg.role,
-                "contenu": msg.contenu,
-                "timestamp": msg.timestamp.isoformat()
-            }
-            for msg in conversation.messages
-        ]
+        **_conversation_summary(conversation),
+        "messages": [_message_to_dict(msg) for msg in messages],
+        "next_before": next_before,
     }
 
 @app.put("/conversations/{conversation_id}", tags=["Conversations"])
-async def update_conversation(conversation_id: int, data: dict, db: Session = Depends(get_db), current_user = Depends(get_current_user)):
-    conversation = crud.update_conversation_title(db, conversation_id, current_user.id, data["titre"])
+async def update_conversation(conversation_id: int, data: dict, db: AsyncSession = Depends(get_async_db), current_user = Depends(get_current_user_async)):
+    conversation = await crud.update_conversation_title_async(db, conversation_id, current_user.id, data["titre"])
     if not conversation:
         raise HTTPException(status_code=404, detail="Conversation non trouvée")
-    return {
-        "id": conversation.id,
-        "titre": conversation.titre,
-        "date_creation": conversation.date_creation.isoformat(),
-        "date_derniere_activite": conversation.date_derniere_activite.isoformat()
-    }
+    summary = _conversation_summary(conversation)
+    get_broker().publish(user_topic(current_user.id), {"type": "conversation.updated", "conversation": summary})
+    return summary
 
 @app.delete("/conversations/{conversation_id}", tags=["Conversations"])
-async def delete_conversation(conversation_id: int, db: Session = Depends(get_db), current_user = Depends(get_current_user)):
-    success = crud.delete_conversation(db, conversation_id, current_user.id)
+async def delete_conversation(conversation_id: int, db: AsyncSession = Depends(get_async_db), current_user = Depends(get_current_user_async)):
+    success = await crud.delete_conversation_async(db, conversation_id, current_user.id)
     if not success:
         raise HTTPException(status_code=404, detail="Conversation non trouvée")
+    get_broker().publish(user_topic(current_user.id), {"type": "conversation.deleted", "conversation_id": conversation_id})
     return {"message": "Conversation supprimée avec succès"}
 
 @app.on_event("startup")
 def _startup_db():
-    # Attend que Postgres soit prêt, crée la DB si besoin, puis crée les tables
+    # Attend que Postgres soit prêt, crée la DB si besoin, puis applique les migrations
     bootstrap_database()
-    init_db()
+    migrate_db()
 
 # ──────────────────────────────────────────────────────────────────────────────
 # Root
@@ -570,13 +592,109 @@ def read_root():
 # ──────────────────────────────────────────────────────────────────────────────
 # WebSocket
 # ──────────────────────────────────────────────────────────────────────────────
+def _user_id_from_token(token: str | None) -> int | None:
+    if not token:
+        return None
+    try:
+        return int(AuthService.verify_token(token))
+    except Exception:
+        return None
+
+async def _pump_events(websocket, subscription: Subscription, client_id: int):
+    """
+    Relaye vers la socket les deltas publiés par les autres onglets / l'API.
+    Socket fermée : l'abonnement est retiré tout de suite (sans attendre la
+    fin du handler, qui peut être pris par un appel au modèle) et le relais s'arrête.
+    """
+    try:
+        while True:
+            event = await subscription.get()
+            if event.get("origin") == client_id:
+                continue
+            payload = {k: v for k, v in event.items() if k != "origin"}
+            await websocket.send(json.dumps(payload))
+    except websockets.exceptions.ConnectionClosed:
+        get_broker().unsubscribe(subscription)
+    except Exception:
+        logging.exception(f"❌ Relais des événements interrompu (client_id={client_id})")
+        get_broker().unsubscribe(subscription)
+
+async def _follow_conversation(db: AsyncSession, subscription: Subscription, client_id: int, conversation_id, user_id):
+    """Abonne la socket au topic de la conversation courante (une seule à la fois)."""
+    state = conversations[client_id]
+    if not conversation_id or state.get("followed_conversation_id") == conversation_id:
+        return
+    if not user_id or not await crud.conversation_belongs_to_user_async(db, conversation_id, user_id):
+        return
+    previous = state.get("followed_conversation_id")
+    broker = get_broker()
+    if previous:
+        broker.unsubscribe(subscription, conversation_topic(previous))
+    broker.subscribe(subscription, conversation_topic(conversation_id))
+    state["followed_conversation_id"] = conversation_id
+
+def _publish_message(conversation_id, msg, client_id: int):
+    get_broker().publish(conversation_topic(conversation_id), {
+        "type": "message.created",
+        "conversation_id": conversation_id,
+        "message": _message_to_dict(msg),
+        "origin": client_id,
+    })
+
+async def _extract_and_save_prescription(user_parts: list, utilisateur_id, quota_user_id: int | None = None, image_bytes: bytes | None = None) -> str:
+    """
+    Extraction des médicaments (OCR local, puis modèle si la confiance est
+    insuffisante) puis sauvegarde de l'ordonnance.
+    """
+    if image_bytes:
+        extraction = await extract_prescription(image_bytes, user_parts, user_id=quota_user_id)
+    else:
+        extraction = await extract_medications(user_parts, user_id=quota_user_id)
+    if extraction is None:
+        return "Je n'ai pas réussi à lire cette ordonnance. Pouvez-vous envoyer une photo plus nette ?"
+    if not extraction.medicaments:
+        return extraction.reponse_textuelle or "Cette image ne semble pas être une ordonnance lisible."
+
+    meds = [m if isinstance(m, dict) else m.model_dump() for m in extraction.medicaments]
+    image_sha256 = None
+    if image_bytes:
+        try:
+            store = get_blob_store()
+            image_sha256 = await asyncio.to_thread(store.put_bytes, image_bytes)
+            store.schedule_thumbnail(image_sha256)
+        except Exception as e:
+            print(f"Image d'ordonnance non conservée: {e}")
+    try:
+        async with async_session() as db_session:
+            await crud.create_ordonnance_with_meds_async(
+                db=db_session,
+                utilisateur_id=utilisateur_id,
+                meds=meds,
+                valid_until=None,
+                image_sha256=image_sha256,
+            )
+        print(f"✅ Ordonnance sauvegardée pour user {utilisateur_id} ({getattr(extraction, 'source', 'llm')}).")
+    except Exception as e:
+        print(f"Erreur sauvegarde ordonnance extraite: {e}")
+        return "J'ai lu votre ordonnance mais je n'ai pas pu l'enregistrer. Merci de réessayer."
+
+    med_list_str = "\n".join(f"- {m['nom']} ({m.get('frequence') or 'fréquence non spécifiée'})" for m in meds)
+    return (extraction.reponse_textuelle or "J'ai sauvegardé votre ordonnance.") + "\n" + med_list_str
+
 async def handle_client(websocket):
-    global current_system_instruction
     headers = dict(websocket.request.headers)
     ws_session_token = _get_cookie_from_headers(headers, "session_token")
 
     client_id = id(websocket)
-    conversations[client_id] = {"history": [], "conversation_id": None, "user_id": None}
+    conversations[client_id] = {"history": [], "conversation_id": None, "user_id": None, "followed_conversation_id": None}
+
+    # Abonnement aux deltas de l'utilisateur (titres, calendrier, nouvelles conversations)
+    broker = get_broker()
+    subscription = Subscription(asyncio.get_running_loop())
+    session_user_id = _user_id_from_token(ws_session_token)
+    if session_user_id:
+        broker.subscribe(subscription, user_topic(session_user_id))
+    pump_task = asyncio.create_task(_pump_events(websocket, subscription, client_id))
 
     try:
         print(f"✅ Connexion WS client_id={client_id}")
@@ -584,7 +702,7 @@ async def handle_client(websocket):
 
         async for message in websocket:
             print(f"📩 Reçu brut: {message}")
-            db = next(get_db())
+            db = async_session()
             try:
                 data = json.loads(message)
 
@@ -592,6 +710,12 @@ async def handle_client(websocket):
                 if data.get("action") == "load_history":
                     conversations[client_id]["history"] = data.get("history", [])
                     print(f"Client {client_id}: Historique chargé ({len(conversations[client_id]['history'])} messages)")
+                    await _follow_conversation(db, subscription, client_id, data.get("conversation_id"), session_user_id)
+                    continue
+
+                # Abonnement explicite à une conversation (onglet ouvert sans envoyer de message)
+                if data.get("action") == "subscribe":
+                    await _follow_conversation(db, subscription, client_id, data.get("conversation_id"), session_user_id)
                     continue
 
                 user_message   = data.get("message", "")
@@ -605,13 +729,20 @@ async def handle_client(websocket):
                     await websocket.send(json.dumps({"error": "Non authentifié (aucun session_token)."}))
                     continue
 
+                if not session_user_id:
+                    session_user_id = _user_id_from_token(token_to_use)
+                    if session_user_id:
+                        broker.subscribe(subscription, user_topic(session_user_id))
+
                 # Mémoriser conv/user pour cette session
                 conversations[client_id]["conversation_id"] = conversation_id
                 conversations[client_id]["user_id"] = user_id
+                await _follow_conversation(db, subscription, client_id, conversation_id, session_user_id)
 
-                # Construire system prompt
+                # Construire le contexte dynamique ; l'instruction système statique
+                # reste inchangée pour pouvoir être mise en cache côté fournisseur.
                 today_str = datetime.now().strftime("%d/%m/%Y")
-                current_system_instruction = system_instruction
+                current_system_instruction = ""
 
                 if user_context:
                     context_parts = ["Voici des informations sur l'utilisateur actuel :"]
@@ -637,8 +768,8 @@ async def handle_client(websocket):
                         if antecedents_str:
                             context_parts.append(f"- Antécédents médicaux: {antecedents_str}")
                     if len(context_parts) > 1:
-                        current_system_instruction += "\n\n" + "\n".join(context_parts)
-                        current_system_instruction += "\n\nBase tes réponses sur ces infos."
+                        current_system_instruction += "\n".join(context_parts)
+                        current_system_instruction += "\n\nBase tes réponses sur ces infos.\n"
 
                 current_system_instruction += f"""
 Aujourd'hui on est le {today_str}
@@ -650,6 +781,7 @@ Capacités d’action calendrier :
 
                 # Contenu utilisateur
                 user_parts = []
+                image_data = None
                 if user_message:
                     user_parts.append(user_message)
                 if image_data_url:
@@ -665,62 +797,53 @@ Capacités d’action calendrier :
                 # Historique + persistance message user
                 conversations[client_id]["history"].append({"role": "user", "parts": user_parts})
                 if conversation_id and user_message:
-                    crud.add_message_to_conversation(db, conversation_id, "user", user_message)
+                    user_msg = await crud.add_message_to_conversation_async(db, conversation_id, "user", user_message)
+                    _publish_message(conversation_id, user_msg, client_id)
 
-                # Génération (avec outils puis fallback)
-                try:
-                    response_text = generate_response_with_tools(
-                        prompt_parts=user_parts,
-                        system_instruction_update=current_system_instruction,
-                        session_token=token_to_use
-                    )
-                except Exception:
-                    response_text = generate_response(conversations[client_id]["history"], current_system_instruction)
-
-                # NOUVELLE LOGIQUE : Extraire les médicaments de la réponse du LLM
-                final_response_to_user = response_text
+                has_image = any(isinstance(p, Image.Image) for p in user_parts)
+
+                # Génération. Photo d'ordonnance → extraction structurée dédiée ;
+                # sinon chat avec outils puis fallback. Si le fournisseur est
+                # indisponible (retries épuisés, disjoncteur ouvert), on ne relance
+                # pas un second appel complet avec tout l'historique.
                 try:
-                    # Le LLM peut renvoyer du markdown (```json ... ```)
-                    json_match = re.search(r'```json\s*([\s\S]+?)\s*```', response_text)
-                    if json_match:
-                        clean_json_str = json_match.group(1)
-                        response_data = json.loads(clean_json_str)
-                        
-                        meds_from_llm = response_data.get("medicaments")
-                        
-                        if meds_from_llm and isinstance(meds_from_llm, list):
-                            for med in meds_from_llm:
-                                if 'dose' not in med:
-                                    med['dose'] = None
-
-                            db_session = SessionLocal()
-                            try:
-                                create_ordonnance_with_meds(
-                                    db=db_session,
-                                    utilisateur_id=user_id,
-                                    meds=meds_from_llm,
-                                    valid_until=None
-                                )
-                                db_session.commit()
-                                print(f"✅ Ordonnance sauvegardée pour user {user_id} via LLM.")
-                                
-                                # Formatter la réponse pour l'utilisateur
-                                med_list_str = "\n".join([f"- {med['nom']} ({med.get('frequence', 'fréquence non spécifiée')})" for med in meds_from_llm])
-                                final_response_to_user = response_data.get("reponse_textuelle", "J'ai sauvegardé votre ordonnance.") + "\n" + med_list_str
-
-                            except Exception as e:
-                                db_session.rollback()
-                                print(f"Erreur sauvegarde ordonnance depuis LLM: {e}")
-                            finally:
-                                db_session.close()
-                except (json.JSONDecodeError, TypeError) as e:
-                    print(f"Réponse du LLM n'était pas un JSON valide: {e}")
-                    # On envoie la réponse texte brute du LLM
+                    if has_image:
+                        final_response_to_user = await _extract_and_save_prescription(
+                            user_parts, session_user_id or user_id, quota_user_id=session_user_id,
+                            image_bytes=image_data,
+                        )
+                    else:
+                        try:
+                            final_response_to_user = await generate_response_with_tools(
+                                prompt_parts=user_parts,
+                                session_token=token_to_use,
+                                user_context=current_system_instruction,
+                                user_id=session_user_id
+                            )
+                        except (LLMUnavailable, QuotaExceeded):
+                            raise
+                        except Exception:
+                            final_response_to_user = await generate_response(
+                                conversations[client_id]["history"],
+                                user_context=current_system_instruction,
+                                user_id=session_user_id
+                            )
+                except QuotaExceeded as e:
+                    logging.info(str(e))
+                    final_response_to_user = QUOTA_MESSAGES.get(e.period, QUOTA_MESSAGES["day"])
+                except GatewayBusy as e:
+                    # Délestage : réponse immédiate plutôt qu'une longue attente
+                    logging.info(f"Passerelle LLM saturée: {e}")
+                    final_response_to_user = LLM_BUSY_MESSAGE
+                except LLMUnavailable as e:
+                    logging.warning(f"LLM indisponible: {e}")
+                    final_response_to_user = LLM_UNAVAILABLE_MESSAGE
 
                 # Historique + persistance assistant
                 conversations[client_id]["history"].append({"role": "model", "parts": [final_response_to_user]})
                 if conversation_id:
-                    crud.add_message_to_conversation(db, conversation_id, "assistant", final_response_to_user)
+                    assistant_msg = await crud.add_message_to_conversation_async(db, conversation_id, "assistant", final_response_to_user)
+                    _publish_message(conversation_id, assistant_msg, client_id)
 
                 await websocket.send(json.dumps({
                     "response": final_response_to_user,
@@ -735,8 +858,10 @@ Capacités d’action calendrier :
                 logging.exception("❌ Erreur traitement WS")
                 await websocket.send(json.dumps({"error": "Une erreur est survenue"}))
             finally:
-                db.close()
+                await db.close()
     finally:
+        pump_task.cancel()
+        broker.unsubscribe(subscription)
         conversations.pop(client_id, None)
         print(f"🛑 Déconnexion WebSocket client_id={client_id}")
 
@@ -761,7 +886,7 @@ async def main():
         print("🔧 Bootstrap base de données...")
         from database.database import bootstrap_database
         bootstrap_database()
-        init_db()
+        migrate_db()
         print("✅ Base de données initialisée et prête!")
 
         fastapi_thread = Thread(target=start_fastapi_server, daemon=True)
@@ -770,7 +895,21 @@ async def main():
         print(f"🚀 Serveur FastAPI démarré sur {HOST}:{FASTAPI_PORT}")
         print(f"📖 Documentation API disponible sur http://{HOST}:{FASTAPI_PORT}/docs")
 
-        await start_websocket_server()
+        scan_worker_task = None
+        if os.getenv("SCAN_JOBS_IN_PROCESS", "1").strip().lower() in {"1", "true", "yes", "on"}:
+            # Worker des scans asynchrones sur la boucle principale ; d'autres
+            # peuvent tourner à part (python -m services.scan_jobs). La référence
+            # est gardée : la boucle ne conserve les tâches que faiblement.
+            scan_worker_task = asyncio.create_task(get_scan_worker().run())
+
+        try:
+            await start_websocket_server()
+        finally:
+            if scan_worker_task is not None:
+                # Un job interrompu garde son bail et sera repris à son expiration
+                scan_worker_task.cancel()
+                with contextlib.suppress(asyncio.CancelledError):
+                    await scan_worker_task
     except Exception as e:
         logging.error(f"Erreur lors du démarrage du serveur: {e}")
         raise
@@ -0,0 +1,255 @@
+"""
+Réception des fichiers envoyés aux routes de scan.
+
+Le corps multipart est lu directement depuis `request.stream()` et découpé
+par python-multipart au fil de l'eau : chaque bloc d'un fichier est haché
+(sha256), compté puis écrit dans un fichier temporaire. Dès que la taille
+maximale (SCAN_UPLOAD_MAX_BYTES) est dépassée, la lecture s'arrête et la
+requête échoue en 413, sans que le reste du corps soit reçu ni mis en mémoire.
+L'OCR reçoit ensuite le chemin, jamais les octets.
+
+    form = await receive_multipart(request, "image")
+    try:
+        text = await get_ocr_pool().ocr(form.files[0].path)
+    finally:
+        form.discard()
+"""
+import asyncio
+import contextlib
+import hashlib
+import os
+import tempfile
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+from fastapi import HTTPException, Request
+
+try:
+    import python_multipart as multipart
+    from python_multipart.exceptions import FormParserError
+    from python_multipart.multipart import parse_options_header
+except ModuleNotFoundError:  # anciennes versions du paquet
+    import multipart
+    from multipart.exceptions import FormParserError
+    from multipart.multipart import parse_options_header
+
+MAX_FIELD_BYTES = 1024 * 1024
+MAX_FIELDS = 20
+
+
+@dataclass
+class StagedUpload:
+    path: str
+    sha256: str
+    size: int
+    filename: Optional[str]
+    content_type: Optional[str]
+    is_pdf: bool
+
+    def discard(self) -> None:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.path)
+
+
+@dataclass
+class ScanForm:
+    """Champs texte et fichiers (déjà sur disque) d'un formulaire de scan."""
+    fields: Dict[str, str] = field(default_factory=dict)
+    files: List[StagedUpload] = field(default_factory=list)
+
+    def discard(self) -> None:
+        for staged in self.files:
+            staged.discard()
+
+
+def max_upload_bytes() -> int:
+    return int(os.getenv("SCAN_UPLOAD_MAX_BYTES", 20 * 1024 * 1024))
+
+
+class _TooLarge(Exception):
+    pass
+
+
+class _Part:
+    """Partie en cours de réception ; `pending` contient les blocs pas encore écrits."""
+
+    def __init__(self):
+        self.headers: Dict[bytes, bytes] = {}
+        self.name = ""
+        self.filename: Optional[str] = None
+        self.value = bytearray()
+        self.digest = hashlib.sha256()
+        self.size = 0
+        self.head = b""
+        self.pending: List[bytes] = []
+        self.file = None
+        self.path: Optional[str] = None
+
+
+class _MultipartReader:
+    """
+    Callbacks de python-multipart (synchrones) : contrôle des tailles et
+    hachage au fil de l'eau ; les écritures disque sont faites ensuite, hors
+    de la boucle d'événements (flush, dans un thread).
+    """
+
+    def __init__(self, file_field: str, directory: Optional[str], max_bytes: int, max_files: int):
+        self.file_field = file_field
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.fields: Dict[str, str] = {}
+        self.parts: List[_Part] = []  # fichiers retenus, dans l'ordre d'envoi
+        self.current = _Part()
+        self._header_name = b""
+        self._header_value = b""
+        self._field_count = 0
+
+    def callbacks(self) -> dict:
+        return {
+            "on_part_begin": self.on_part_begin,
+            "on_part_data": self.on_part_data,
+            "on_part_end": self.on_part_end,
+            "on_header_field": self.on_header_field,
+            "on_header_value": self.on_header_value,
+            "on_header_end": self.on_header_end,
+            "on_headers_finished": self.on_headers_finished,
+        }
+
+    def on_part_begin(self) -> None:
+        self.current = _Part()
+
+    def on_header_field(self, data: bytes, start: int, end: int) -> None:
+        self._header_name += data[start:end]
+
+    def on_header_value(self, data: bytes, start: int, end: int) -> None:
+        self._header_value += data[start:end]
+
+    def on_header_end(self) -> None:
+        self.current.headers[self._header_name.lower()] = self._header_value
+        self._header_name = self._header_value = b""
+
+    def on_headers_finished(self) -> None:
+        part = self.current
+        _, options = parse_options_header(part.headers.get(b"content-disposition", b""))
+        part.name = options.get(b"name", b"").decode("utf-8", "replace")
+        if b"filename" in options:
+            part.filename = options[b"filename"].decode("utf-8", "replace")
+            # champ fichier vide (formulaire envoyé sans fichier) ou inattendu : ignoré
+            if part.filename and part.name == self.file_field:
+                if len(self.parts) >= self.max_files:
+                    raise _TooLarge(f"{self.max_files} fichier(s) maximum par requête.")
+                self.parts.append(part)
+        else:
+            self._field_count += 1
+            if self._field_count > MAX_FIELDS:
+                raise _TooLarge("Trop de champs dans le formulaire.")
+
+    def on_part_data(self, data: bytes, start: int, end: int) -> None:
+        part = self.current
+        chunk = data[start:end]
+        if part.filename is None:
+            if len(part.value) + len(chunk) > MAX_FIELD_BYTES:
+                raise _TooLarge("Champ de formulaire trop volumineux.")
+            part.value.extend(chunk)
+            return
+        if part not in self.parts:
+            return
+        part.size += len(chunk)
+        if part.size > self.max_bytes:
+            raise _TooLarge(f"Fichier trop volumineux ({self.max_bytes // (1024 * 1024)} Mo maximum).")
+        if len(part.head) < 5:
+            part.head += chunk[:5 - len(part.head)]
+        part.digest.update(chunk)
+        part.pending.append(chunk)
+
+    def on_part_end(self) -> None:
+        part = self.current
+        if part.filename is None and part.name:
+            self.fields[part.name] = part.value.decode("utf-8", "replace")
+
+    def flush(self) -> None:
+        """Écrit les blocs en attente (appelé dans un thread)."""
+        for part in self.parts:
+            if not part.pending:
+                continue
+            if part.file is None:
+                suffix = os.path.splitext(part.filename or "")[1] or ".bin"
+                fd, part.path = tempfile.mkstemp(suffix=suffix, prefix="upload-", dir=self.directory)
+                part.file = os.fdopen(fd, "wb")
+            part.file.writelines(part.pending)
+            part.pending.clear()
+
+    def close(self) -> None:
+        for part in self.parts:
+            if part.file is not None:
+                part.file.close()
+
+    def remove_files(self) -> None:
+        for part in self.parts:
+            if part.path:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(part.path)
+
+
+async def receive_multipart(
+    request: Request,
+    file_field: str,
+    directory: Optional[str] = None,
+    max_bytes: Optional[int] = None,
+    max_files: int = 1,
+) -> ScanForm:
+    """
+    Lit le formulaire multipart de `request` : les fichiers du champ
+    `file_field` sont copiés dans `directory` (défaut : dossier temporaire du
+    système), les autres champs fichier sont ignorés.
+    Un formulaire urlencoded (sans fichier) est aussi accepté.
+    Lève HTTPException(413) dès qu'un fichier dépasse `max_bytes` ou qu'il y a
+    plus de `max_files` fichiers, 400 si le corps est invalide ou un fichier vide.
+    """
+    max_bytes = max_bytes or max_upload_bytes()
+    content_type, params = parse_options_header(request.headers.get("content-type", ""))
+    if content_type == b"application/x-www-form-urlencoded":
+        # formulaire sans fichier (ex: texte OCRisé côté client)
+        async with request.form(max_files=0, max_fields=MAX_FIELDS, max_part_size=MAX_FIELD_BYTES) as data:
+            return ScanForm(fields={k: v for k, v in data.items() if isinstance(v, str)})
+    boundary = params.get(b"boundary")
+    if content_type != b"multipart/form-data" or not boundary:
+        raise HTTPException(status_code=400, detail="Formulaire multipart attendu.")
+    declared = request.headers.get("content-length")
+    if declared and declared.isdigit() and int(declared) > max_files * max_bytes + MAX_FIELDS * MAX_FIELD_BYTES:
+        raise HTTPException(status_code=413, detail=f"Fichier trop volumineux ({max_bytes // (1024 * 1024)} Mo maximum).")
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    reader = _MultipartReader(file_field, directory, max_bytes, max_files)
+    parser = multipart.MultipartParser(boundary, reader.callbacks())
+    try:
+        try:
+            async for chunk in request.stream():
+                parser.write(chunk)
+                if any(part.pending for part in reader.parts):
+                    await asyncio.to_thread(reader.flush)
+            parser.finalize()
+        finally:
+            reader.close()
+    except BaseException as e:
+        reader.remove_files()
+        if isinstance(e, _TooLarge):
+            raise HTTPException(status_code=413, detail=str(e))
+        if isinstance(e, FormParserError):
+            raise HTTPException(status_code=400, detail="Formulaire multipart invalide.")
+        raise
+
+    form = ScanForm(fields=reader.fields)
+    for part in reader.parts:
+        if part.path:
+            form.files.append(StagedUpload(
+                path=part.path, sha256=part.digest.hexdigest(), size=part.size, filename=part.filename,
+                content_type=part.headers.get(b"content-type", b"").decode("latin-1") or None,
+                is_pdf=part.headers.get(b"content-type") == b"application/pdf" or part.head == b"%PDF-",
+            ))
+    if len(form.files) < len(reader.parts):
+        form.discard()
+        raise HTTPException(status_code=400, detail="Fichier vide.")
+    return form
@@ -0,0 +1,204 @@
+"""
+Stockage des images d'ordonnance adressé par contenu.
+
+Chaque fichier est rangé sous son sha256, dans deux niveaux de sous-dossiers
+(BLOB_STORE_DIR/ab/cd/abcd…) pour ne pas accumuler des milliers d'entrées par
+dossier ; un même fichier envoyé deux fois n'est stocké qu'une fois. Un blob
+n'est jamais modifié : les réponses HTTP peuvent être mises en cache
+indéfiniment.
+
+Les miniatures WebP (BLOB_THUMBNAIL_SIZE px de côté au plus) sont générées en
+arrière-plan par un thread dédié, à côté de l'original (suffixe .thumb.webp).
+
+    store = get_blob_store()
+    digest = store.put_file(staged.path, staged.sha256)  # déplace le fichier
+    store.schedule_thumbnail(digest)
+"""
+import contextlib
+import hashlib
+import logging
+import os
+import re
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from services import metrics
+
+logger = logging.getLogger(__name__)
+
+THUMBNAIL_SUFFIX = ".thumb.webp"
+_DIGEST_RE = re.compile(r"^[0-9a-f]{64}$")
+
+_writes = metrics.counter("blob_store_writes_total", "Écritures dans le stockage d'images (nouveau / doublon)")
+_thumbnails = metrics.counter("blob_thumbnails_total", "Miniatures générées (ok / echec)")
+
+# Signatures des formats acceptés par les routes de scan
+_SIGNATURES = (
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"%PDF-", "application/pdf"),
+    (b"GIF8", "image/gif"),
+    (b"II*\x00", "image/tiff"),
+    (b"MM\x00*", "image/tiff"),
+)
+
+
+def is_digest(value: str) -> bool:
+    return bool(_DIGEST_RE.match(value or ""))
+
+
+def sniff_content_type(head: bytes) -> str:
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    for signature, content_type in _SIGNATURES:
+        if head.startswith(signature):
+            return content_type
+    return "application/octet-stream"
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(256 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class BlobStore:
+    def __init__(self, root: str = None, thumbnail_size: int = None):
+        self.root = root or os.getenv("BLOB_STORE_DIR", os.path.join(".cache", "blobs"))
+        self.thumbnail_size = thumbnail_size or int(os.getenv("BLOB_THUMBNAIL_SIZE", "320"))
+        # Un seul thread : les miniatures passent après les scans, pas en concurrence
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="blob-thumbs")
+
+    def path_for(self, digest: str) -> str:
+        if not is_digest(digest):
+            raise ValueError(f"Empreinte invalide: {digest!r}")
+        return os.path.join(self.root, digest[:2], digest[2:4], digest)
+
+    def thumbnail_path(self, digest: str) -> str:
+        return self.path_for(digest) + THUMBNAIL_SUFFIX
+
+    def exists(self, digest: str) -> bool:
+        return os.path.exists(self.path_for(digest))
+
+    def put_file(self, path: str, sha256: Optional[str] = None, move: bool = True) -> str:
+        """
+        Range `path` sous son empreinte (calculée si `sha256` n'est pas fourni)
+        et retourne celle-ci. Avec `move`, le fichier source est déplacé, ou
+        supprimé si le blob existait déjà.
+        """
+        digest = sha256 or file_sha256(path)
+        dest = self.path_for(digest)
+        if os.path.exists(dest):
+            _writes.inc(statut="doublon")
+            if move:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(path)
+            return digest
+
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        if move:
+            try:
+                # Même système de fichiers : renommage atomique, sans copie
+                os.replace(path, dest)
+                _writes.inc(statut="nouveau")
+                return digest
+            except OSError:
+                pass
+        # Copie dans le dossier cible puis renommage : jamais de blob tronqué visible
+        fd, tmp = tempfile.mkstemp(prefix=".tmp-", dir=os.path.dirname(dest))
+        try:
+            with os.fdopen(fd, "wb") as out, open(path, "rb") as src:
+                shutil.copyfileobj(src, out, length=256 * 1024)
+            os.replace(tmp, dest)
+        except BaseException:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(tmp)
+            raise
+        if move:
+            os.remove(path)
+        _writes.inc(statut="nouveau")
+        return digest
+
+    def put_bytes(self, data: bytes) -> str:
+        digest = hashlib.sha256(data).hexdigest()
+        dest = self.path_for(digest)
+        if os.path.exists(dest):
+            _writes.inc(statut="doublon")
+            return digest
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(prefix=".tmp-", dir=os.path.dirname(dest))
+        try:
+            with os.fdopen(fd, "wb") as out:
+                out.write(data)
+            os.replace(tmp, dest)
+        except BaseException:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(tmp)
+            raise
+        _writes.inc(statut="nouveau")
+        return digest
+
+    def content_type(self, digest: str) -> str:
+        with open(self.path_for(digest), "rb") as f:
+            return sniff_content_type(f.read(16))
+
+    # ── Miniatures ───────────────────────────────────────────────────────────
+    def schedule_thumbnail(self, digest: str) -> None:
+        """Génère la miniature en arrière-plan (appelable depuis n'importe quel thread)."""
+        if not os.path.exists(self.thumbnail_path(digest)):
+            self._executor.submit(self._make_thumbnail, digest)
+
+    def _make_thumbnail(self, digest: str) -> None:
+        dest = self.thumbnail_path(digest)
+        if os.path.exists(dest):
+            return
+        try:
+            image = self._open_image(digest)
+            image.thumbnail((self.thumbnail_size, self.thumbnail_size))
+            if image.mode not in ("RGB", "RGBA", "L"):
+                image = image.convert("RGB")
+            fd, tmp = tempfile.mkstemp(prefix=".tmp-", dir=os.path.dirname(dest))
+            with os.fdopen(fd, "wb") as out:
+                image.save(out, format="WEBP", quality=80)
+            os.replace(tmp, dest)
+            _thumbnails.inc(statut="ok")
+        except Exception as e:
+            _thumbnails.inc(statut="echec")
+            logger.warning(f"Miniature de {digest[:12]} impossible: {e}")
+
+    def _open_image(self, digest: str):
+        from PIL import Image, ImageOps
+
+        path = self.path_for(digest)
+        if self.content_type(digest) == "application/pdf":
+            import pypdfium2 as pdfium
+
+            pdf = pdfium.PdfDocument(path)
+            try:
+                page = pdf[0]
+                scale = self.thumbnail_size / max(page.get_size())
+                return page.render(scale=scale * 2).to_pil()
+            finally:
+                pdf.close()
+        with Image.open(path) as image:
+            image.draft("RGB", (self.thumbnail_size * 2, self.thumbnail_size * 2))
+            # Photos de téléphone : l'orientation EXIF est appliquée avant réduction
+            return ImageOps.exif_transpose(image)
+
+
+_store: Optional[BlobStore] = None
+_store_lock = threading.Lock()
+
+
+def get_blob_store() -> BlobStore:
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = BlobStore()
+    return _store
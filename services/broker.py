@@ -0,0 +1,210 @@
+"""
+Bus pub/sub pour pousser des deltas (messages, titres, calendrier) à toutes
+les sockets ouvertes d'un utilisateur.
+
+Les topics sont indexés par utilisateur (`user:<id>`) et par conversation
+(`conversation:<id>`). `MessageBroker` est l'interface commune :
+- `InProcessBroker` (BROKER_BACKEND=memory, défaut) quand API FastAPI et
+  serveur WebSocket tournent dans le même processus (mais pas le même thread) ;
+- `PostgresBroker` (BROKER_BACKEND=postgres) quand d'autres processus publient
+  aussi (workers de scan) : les événements passent par LISTEN/NOTIFY.
+"""
+import asyncio
+import json
+import logging
+import os
+import queue
+import select
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import Dict, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+SUBSCRIPTION_QUEUE_SIZE = int(os.getenv("BROKER_QUEUE_SIZE", "100"))
+
+
+def user_topic(user_id) -> str:
+    return f"user:{user_id}"
+
+
+def conversation_topic(conversation_id) -> str:
+    return f"conversation:{conversation_id}"
+
+
+class Subscription:
+    """
+    Abonné rattaché à une boucle asyncio (typiquement une socket).
+    Les événements sont mis en file ; si l'abonné est trop lent, les plus
+    anciens sont jetés plutôt que de bloquer l'éditeur.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, maxsize: int = SUBSCRIPTION_QUEUE_SIZE):
+        self.loop = loop
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=maxsize)
+        self.topics: Set[str] = set()
+
+    def deliver(self, event: dict) -> None:
+        # Toujours appelé dans self.loop
+        if self.queue.full():
+            try:
+                self.queue.get_nowait()
+            except asyncio.QueueEmpty:
+                pass
+        self.queue.put_nowait(event)
+
+    async def get(self) -> dict:
+        return await self.queue.get()
+
+
+class MessageBroker(ABC):
+    """Interface commune aux backends pub/sub."""
+
+    @abstractmethod
+    def subscribe(self, subscription: Subscription, topic: str) -> None:
+        ...
+
+    @abstractmethod
+    def unsubscribe(self, subscription: Subscription, topic: Optional[str] = None) -> None:
+        """Retire l'abonnement à `topic`, ou à tous ses topics si None."""
+
+    @abstractmethod
+    def publish(self, topic: str, event: dict) -> None:
+        """Publie sans bloquer ; appelable depuis n'importe quel thread."""
+
+
+class InProcessBroker(MessageBroker):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._topics: Dict[str, Set[Subscription]] = {}
+
+    def subscribe(self, subscription: Subscription, topic: str) -> None:
+        with self._lock:
+            self._topics.setdefault(topic, set()).add(subscription)
+            subscription.topics.add(topic)
+
+    def unsubscribe(self, subscription: Subscription, topic: Optional[str] = None) -> None:
+        with self._lock:
+            topics = [topic] if topic else list(subscription.topics)
+            for t in topics:
+                subs = self._topics.get(t)
+                if subs is not None:
+                    subs.discard(subscription)
+                    if not subs:
+                        del self._topics[t]
+                subscription.topics.discard(t)
+
+    def publish(self, topic: str, event: dict) -> None:
+        with self._lock:
+            subs = list(self._topics.get(topic, ()))
+        if not subs:
+            return
+        try:
+            current = asyncio.get_running_loop()
+        except RuntimeError:
+            current = None
+        for sub in subs:
+            if sub.loop is current:
+                sub.deliver(event)
+            elif not sub.loop.is_closed():
+                # Publication depuis le thread FastAPI → on repasse par la boucle WS
+                sub.loop.call_soon_threadsafe(sub.deliver, event)
+
+
+class PostgresBroker(InProcessBroker):
+    """
+    Publication par NOTIFY sur un canal Postgres ; un thread écoute le canal
+    (LISTEN) et distribue aux abonnés locaux, y compris les événements émis
+    par ce processus. Les NOTIFY partent d'un thread dédié : publish() ne
+    bloque jamais la boucle appelante.
+    """
+
+    CHANNEL = "sorrel_broker"
+    # Limite de Postgres pour la charge utile d'un NOTIFY
+    MAX_PAYLOAD_BYTES = 7900
+
+    def __init__(self, dsn: str = None):
+        super().__init__()
+        if dsn is None:
+            from database.database import DATABASE_URL
+            dsn = DATABASE_URL
+        self._dsn = dsn
+        self._outbox: "queue.SimpleQueue[str]" = queue.SimpleQueue()
+        threading.Thread(target=self._listen, name="broker-listen", daemon=True).start()
+        threading.Thread(target=self._send, name="broker-notify", daemon=True).start()
+
+    def publish(self, topic: str, event: dict) -> None:
+        payload = json.dumps({"topic": topic, "event": event}, ensure_ascii=False, default=str)
+        if len(payload.encode("utf-8")) > self.MAX_PAYLOAD_BYTES:
+            # Trop gros pour NOTIFY : seuls les abonnés de ce processus le reçoivent
+            logger.warning(f"Événement trop volumineux pour NOTIFY ({topic}), diffusion locale uniquement")
+            super().publish(topic, event)
+            return
+        self._outbox.put(payload)
+
+    def _connect(self):
+        import psycopg2
+        conn = psycopg2.connect(self._dsn)
+        conn.autocommit = True
+        return conn
+
+    def _send(self) -> None:
+        conn = None
+        while True:
+            payload = self._outbox.get()
+            for attempt in range(3):
+                try:
+                    if conn is None or conn.closed:
+                        conn = self._connect()
+                    with conn.cursor() as cur:
+                        cur.execute("SELECT pg_notify(%s, %s)", (self.CHANNEL, payload))
+                    break
+                except Exception:
+                    logger.exception("NOTIFY impossible, nouvelle connexion")
+                    conn = None
+                    time.sleep(0.5 * (attempt + 1))
+
+    def _listen(self) -> None:
+        delay = 1.0
+        while True:
+            try:
+                conn = self._connect()
+                with conn.cursor() as cur:
+                    cur.execute(f"LISTEN {self.CHANNEL}")
+                delay = 1.0
+                while True:
+                    if select.select([conn], [], [], 5.0) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        notify = conn.notifies.pop(0)
+                        try:
+                            message = json.loads(notify.payload)
+                            InProcessBroker.publish(self, message["topic"], message["event"])
+                        except (ValueError, KeyError):
+                            logger.warning("Notification broker invalide ignorée")
+            except Exception:
+                logger.exception(f"Écoute du broker interrompue, reconnexion dans {delay:.0f}s")
+                time.sleep(delay)
+                delay = min(delay * 2, 30.0)
+
+
+_broker: Optional[MessageBroker] = None
+_broker_lock = threading.Lock()
+
+
+def get_broker() -> MessageBroker:
+    """Retourne le broker configuré par BROKER_BACKEND (défaut: memory)."""
+    global _broker
+    if _broker is None:
+        with _broker_lock:
+            if _broker is None:
+                backend = os.getenv("BROKER_BACKEND", "memory").strip().lower()
+                if backend == "postgres":
+                    _broker = PostgresBroker()
+                else:
+                    if backend != "memory":
+                        logger.warning(f"BROKER_BACKEND '{backend}' inconnu, utilisation du broker en mémoire.")
+                    _broker = InProcessBroker()
+    return _broker
@@ -0,0 +1,411 @@
+"""
+Enregistrement / rejeu du trafic LLM sous forme de cassettes JSONL compressées.
+
+Enregistrement : LLM_RECORD_CASSETTE=/chemin/cassette.jsonl.gz
+    Chaque appel à generate_response / generate_response_with_tools produit
+    un enregistrement "turn" (forme du prompt, latence totale), ses appels au
+    modèle produisent des enregistrements "call" (forme de la requête, réponse
+    expurgée, tokens, latence) et ses appels d'outils des enregistrements "tool".
+    Les textes sont expurgés en conservant leur longueur et leur structure
+    (blocs JSON, dates des tool-calls) ; mettre CASSETTE_REDACT=0 pour garder
+    le texte brut en local.
+
+Rejeu : LLM_BACKEND=replay + LLM_REPLAY_CASSETTE=..., ou en CLI :
+    python -m services.cassette replay cassette.jsonl.gz [--speed 1.0] [--json]
+"""
+import argparse
+import asyncio
+import contextvars
+import functools
+import gzip
+import hashlib
+import json
+import logging
+import os
+import re
+import statistics
+import threading
+import time
+from collections import deque
+from typing import Any, Dict, List, Optional
+
+from services.llm import FunctionCall, LLMBackend, LLMRequest, LLMResponse, _is_image
+
+logger = logging.getLogger(__name__)
+
+_JSON_BLOCK = re.compile(r"```json\s*([\s\S]+?)\s*```")
+_ISO_DATETIME = re.compile(r"^\d{4}-\d{2}-\d{2}([T ]\d{2}:\d{2}(:\d{2})?(\.\d+)?(Z|[+-]\d{2}:?\d{2})?)?$")
+_WORD_CHAR = re.compile(r"\w", re.UNICODE)
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Expurgation
+# ──────────────────────────────────────────────────────────────────────────────
+def _redact_str(value: str) -> str:
+    if _ISO_DATETIME.match(value):
+        return value
+    return _WORD_CHAR.sub("x", value)
+
+
+def _redact_json(value):
+    if isinstance(value, str):
+        return _redact_str(value)
+    if isinstance(value, list):
+        return [_redact_json(v) for v in value]
+    if isinstance(value, dict):
+        return {k: _redact_json(v) for k, v in value.items()}
+    return value
+
+
+def redact_text(text: str) -> str:
+    """Conserve longueur, ponctuation et blocs JSON (clés intactes, valeurs masquées)."""
+    out, last = [], 0
+    for m in _JSON_BLOCK.finditer(text):
+        out.append(_redact_str(text[last:m.start()]))
+        try:
+            block = json.dumps(_redact_json(json.loads(m.group(1))), ensure_ascii=False, indent=2)
+            out.append("```json\n" + block + "\n```")
+        except json.JSONDecodeError:
+            out.append(_redact_str(m.group(0)))
+        last = m.end()
+    out.append(_redact_str(text[last:]))
+    return "".join(out)
+
+
+def _describe_parts(parts, redact: bool) -> List[Dict[str, Any]]:
+    if isinstance(parts, (str, dict)) or _is_image(parts):
+        parts = [parts]
+    shapes = []
+    for part in parts or []:
+        if isinstance(part, str):
+            shapes.append({"type": "text", "chars": len(part), "text": redact_text(part) if redact else part})
+        elif _is_image(part):
+            shapes.append({"type": "image", "width": part.size[0], "height": part.size[1],
+                           "mode": part.mode, "format": getattr(part, "format", None)})
+        elif isinstance(part, dict) and "parts" in part:
+            shapes.append({"type": "history", "role": part.get("role"), "parts": _describe_parts(part["parts"], redact)})
+        elif isinstance(part, dict) and "function_response" in part:
+            shapes.append({"type": "function_response", "name": part["function_response"].get("name")})
+        else:
+            shapes.append({"type": type(part).__name__})
+    return shapes
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Enregistrement
+# ──────────────────────────────────────────────────────────────────────────────
+_current_turn: contextvars.ContextVar[Optional[int]] = contextvars.ContextVar("cassette_turn", default=None)
+
+
+class CassetteWriter:
+    def __init__(self, path: str, redact: bool = True):
+        self.path = path
+        self.redact = redact
+        self._lock = threading.Lock()
+        self._file = gzip.open(path, "at", encoding="utf-8")
+        self._next_turn = 0
+
+    def new_turn(self) -> int:
+        with self._lock:
+            self._next_turn += 1
+            return self._next_turn
+
+    def write(self, record: dict) -> None:
+        line = json.dumps(record, ensure_ascii=False, default=str)
+        with self._lock:
+            self._file.write(line + "\n")
+            self._file.flush()
+
+    def close(self) -> None:
+        with self._lock:
+            self._file.close()
+
+
+_writer: Optional[CassetteWriter] = None
+_writer_lock = threading.Lock()
+
+
+def get_recorder() -> Optional[CassetteWriter]:
+    global _writer
+    path = os.getenv("LLM_RECORD_CASSETTE")
+    if not path:
+        return None
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                redact = os.getenv("CASSETTE_REDACT", "1").strip().lower() not in {"0", "false", "no"}
+                _writer = CassetteWriter(path, redact=redact)
+                logger.info(f"Enregistrement des appels LLM dans {path}")
+    return _writer
+
+
+def recorded(entry: str):
+    """Décore un point d'entrée async du service (prompt_parts, system_instruction_update, ...)."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            writer = get_recorder()
+            if writer is None:
+                return await fn(*args, **kwargs)
+            prompt_parts = kwargs.get("prompt_parts", args[0] if args else [])
+            instruction = kwargs.get("system_instruction_update", args[1] if len(args) > 1 else None)
+            user_context = kwargs.get("user_context")
+            turn = writer.new_turn()
+            token = _current_turn.set(turn)
+            t0 = time.perf_counter()
+            error = None
+            try:
+                return await fn(*args, **kwargs)
+            except Exception as e:
+                error = type(e).__name__
+                raise
+            finally:
+                _current_turn.reset(token)
+                writer.write({
+                    "kind": "turn",
+                    "turn": turn,
+                    "entry": entry,
+                    "ts": time.time(),
+                    "system_instruction_chars": len(instruction or ""),
+                    "context_chars": len(user_context or ""),
+                    "parts": _describe_parts(prompt_parts, writer.redact),
+                    "latency": time.perf_counter() - t0,
+                    "error": error,
+                })
+        return wrapper
+    return decorator
+
+
+def record_tool_call(name: str, latency: float) -> None:
+    writer = get_recorder()
+    if writer is None:
+        return
+    writer.write({"kind": "tool", "turn": _current_turn.get(), "name": name, "latency": latency})
+
+
+class RecordingBackend(LLMBackend):
+    """Enveloppe un backend et écrit chaque appel dans la cassette."""
+
+    def __init__(self, inner: LLMBackend, writer: CassetteWriter):
+        self.inner = inner
+        self.writer = writer
+        self.name = f"recording:{inner.name}"
+
+    async def generate(self, request: LLMRequest) -> LLMResponse:
+        t0 = time.perf_counter()
+        error = None
+        resp: Optional[LLMResponse] = None
+        try:
+            resp = await self.inner.generate(request)
+            return resp
+        except Exception as e:
+            error = type(e).__name__
+            raise
+        finally:
+            redact = self.writer.redact
+            instruction = request.system_instruction or ""
+            record = {
+                "kind": "call",
+                "turn": _current_turn.get(),
+                "ts": time.time(),
+                "request": {
+                    "model": request.model,
+                    "route": request.route,
+                    "system_instruction_chars": len(instruction),
+                    "system_instruction_sha": hashlib.sha256(instruction.encode()).hexdigest()[:16],
+                    "context_chars": len(request.context or ""),
+                    "tools": bool(request.tools),
+                    "generation_config": request.generation_config,
+                    "parts": _describe_parts(request.parts, redact),
+                },
+                "latency": time.perf_counter() - t0,
+                "error": error,
+            }
+            if resp is not None:
+                record["response"] = {
+                    "text": redact_text(resp.text) if redact else resp.text,
+                    "function_calls": [
+                        {"name": fc.name, "args": _redact_json(fc.args) if redact else fc.args}
+                        for fc in resp.function_calls
+                    ],
+                    "prompt_tokens": resp.prompt_tokens,
+                    "output_tokens": resp.output_tokens,
+                    "cached_tokens": resp.cached_tokens,
+                }
+            self.writer.write(record)
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Rejeu
+# ──────────────────────────────────────────────────────────────────────────────
+def load_cassette(path: str) -> List[dict]:
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+class ReplayBackend(LLMBackend):
+    """Rejoue les appels enregistrés dans l'ordre, en reproduisant leur latence."""
+    name = "replay"
+
+    def __init__(self, records: List[dict], speed: float = 1.0):
+        self.speed = speed
+        # Les appels sont rangés par tour : l'enregistrement peut entrelacer
+        # plusieurs sockets, le rejeu doit rendre à chaque tour ses propres appels.
+        self._calls: Dict[Optional[int], deque] = {}
+        for r in records:
+            if r.get("kind") == "call":
+                self._calls.setdefault(r.get("turn"), deque()).append(r)
+        self._order = deque(r for r in records if r.get("kind") == "call")
+
+    @classmethod
+    def from_env(cls) -> "ReplayBackend":
+        path = os.getenv("LLM_REPLAY_CASSETTE")
+        if not path:
+            raise ValueError("LLM_REPLAY_CASSETTE doit être défini avec LLM_BACKEND=replay")
+        return cls(load_cassette(path), speed=float(os.getenv("LLM_REPLAY_SPEED", "1.0")))
+
+    def _next_call(self) -> dict:
+        turn = _current_turn.get()
+        if turn is not None:
+            queue = self._calls.get(turn)
+            if not queue:
+                raise RuntimeError(f"Cassette épuisée pour le tour {turn}")
+            return queue.popleft()
+        # Hors rejeu de pipeline : ordre global du fichier
+        while self._order:
+            record = self._order.popleft()
+            queue = self._calls.get(record.get("turn"))
+            if queue and queue[0] is record:
+                return queue.popleft()
+        raise RuntimeError("Cassette épuisée")
+
+    async def generate(self, request: LLMRequest) -> LLMResponse:
+        record = self._next_call()
+        t0 = time.perf_counter()
+        if self.speed > 0:
+            await asyncio.sleep(record["latency"] / self.speed)
+        if record.get("error"):
+            raise RuntimeError(f"Erreur rejouée: {record['error']}")
+        resp = record.get("response") or {}
+        return LLMResponse(
+            text=resp.get("text", ""),
+            function_calls=[FunctionCall(name=fc["name"], args=fc.get("args", {})) for fc in resp.get("function_calls", [])],
+            model=record["request"]["model"],
+            prompt_tokens=resp.get("prompt_tokens", 0),
+            output_tokens=resp.get("output_tokens", 0),
+            cached_tokens=resp.get("cached_tokens", 0),
+            latency=time.perf_counter() - t0,
+        )
+
+
+def _build_parts(shapes: List[dict]) -> list:
+    """Reconstruit des parts synthétiques de même forme (longueurs, tailles d'images)."""
+    from PIL import Image
+    parts = []
+    for shape in shapes:
+        kind = shape["type"]
+        if kind == "text":
+            parts.append(shape.get("text") or "x" * shape["chars"])
+        elif kind == "image":
+            parts.append(Image.new(shape.get("mode") or "RGB", (shape["width"], shape["height"]), "white"))
+        elif kind == "history":
+            parts.append({"role": shape.get("role"), "parts": _build_parts(shape["parts"])})
+    return parts
+
+
+async def replay_pipeline(records: List[dict], speed: float = 1.0) -> List[dict]:
+    """Rejoue chaque tour via les points d'entrée du service et mesure l'écart de latence."""
+    from services import service
+    from services.llm import set_backend
+
+    set_backend(ReplayBackend(records, speed=speed))
+    tools: Dict[Optional[int], deque] = {}
+    for r in records:
+        if r.get("kind") == "tool":
+            tools.setdefault(r.get("turn"), deque()).append(r)
+
+    def replay_tool(tool_name, args, cookies=None, turn=None):
+        queue = tools.get(turn)
+        if queue and speed > 0:
+            time.sleep(queue.popleft()["latency"] / speed)
+        return {"ok": True, "replayed": tool_name}
+
+
+    results = []
+    for turn in (r for r in records if r.get("kind") == "turn"):
+        fn = getattr(service, turn["entry"])
+        instruction = "x" * turn["system_instruction_chars"] or None
+        user_context = "x" * turn.get("context_chars", 0) or None
+        service.set_tool_executor(functools.partial(replay_tool, turn=turn["turn"]))
+        token = _current_turn.set(turn["turn"])
+        t0 = time.perf_counter()
+        error = None
+        try:
+            kwargs = {"user_context": user_context} if user_context else {}
+            await fn.__wrapped__(_build_parts(turn["parts"]), instruction, **kwargs)
+        except Exception as e:
+            error = type(e).__name__
+        finally:
+            _current_turn.reset(token)
+        replayed = time.perf_counter() - t0
+        recorded_latency = turn["latency"] / speed if speed > 0 else 0.0
+        results.append({
+            "turn": turn["turn"],
+            "entry": turn["entry"],
+            "recorded": recorded_latency,
+            "replayed": replayed,
+            "delta": replayed - recorded_latency,
+            "error": error,
+        })
+    return results
+
+
+def _percentile(values: List[float], q: float) -> float:
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+def summarize(results: List[dict]) -> dict:
+    deltas = [r["delta"] for r in results]
+    return {
+        "turns": len(results),
+        "errors": sum(1 for r in results if r["error"]),
+        "recorded_mean": statistics.fmean(r["recorded"] for r in results) if results else 0.0,
+        "replayed_mean": statistics.fmean(r["replayed"] for r in results) if results else 0.0,
+        "delta_mean": statistics.fmean(deltas) if deltas else 0.0,
+        "delta_p50": _percentile(deltas, 0.50),
+        "delta_p95": _percentile(deltas, 0.95),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Rejeu de cassettes LLM")
+    sub = parser.add_subparsers(dest="command", required=True)
+    rp = sub.add_parser("replay", help="Rejoue une cassette à travers le pipeline de chat")
+    rp.add_argument("cassette")
+    rp.add_argument("--speed", type=float, default=1.0, help="Facteur d'accélération (0 = sans attente)")
+    rp.add_argument("--json", action="store_true", help="Sortie JSON")
+    args = parser.parse_args(argv)
+
+    records = load_cassette(args.cassette)
+    results = asyncio.run(replay_pipeline(records, speed=args.speed))
+    summary = summarize(results)
+
+    if args.json:
+        print(json.dumps({"summary": summary, "turns": results}, indent=2))
+        return
+    print(f"{'turn':>5}  {'entry':<30} {'recorded':>10} {'replayed':>10} {'delta':>10}")
+    for r in results:
+        flag = f"  ({r['error']})" if r["error"] else ""
+        print(f"{r['turn']:>5}  {r['entry']:<30} {r['recorded'] * 1000:>8.1f}ms {r['replayed'] * 1000:>8.1f}ms "
+              f"{r['delta'] * 1000:>+8.1f}ms{flag}")
+    print(f"\n{summary['turns']} tours, {summary['errors']} erreurs — "
+          f"delta moyen {summary['delta_mean'] * 1000:+.1f}ms, "
+          f"p50 {summary['delta_p50'] * 1000:+.1f}ms, p95 {summary['delta_p95'] * 1000:+.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+"""
+Référentiel local des médicaments et recherche approchée des noms lus par OCR.
+
+- Données : services/data/medicaments_reference.tsv (nom<TAB>dci), ou un
+  fichier CIS_bdpm.txt de la base publique des médicaments via
+  DRUG_REFERENCE_FILE. Chargées une fois par processus.
+- Normalisation : accents retirés, majuscules, ponctuation → espace, et
+  confusions OCR courantes corrigées dans les mots (0→O, 1→I, 5→S, 8→B).
+- Index : dictionnaire exact sur la clé normalisée + index inversé de trigrammes
+  (listes d'identifiants dans des array('I')) qui fournit les candidats ; ceux-ci
+  sont départagés par distance d'édition sur le nom complet.
+- Prudence : deux molécules voisines ne diffèrent souvent que de quelques
+  lettres (Prazépam / Lorazépam, Clobazam / Clonazépam). Une correspondance
+  approchée n'est retenue qu'à une lettre près (deux au-delà de 12 lettres),
+  avec un score ≥ DRUG_MATCH_MIN_SCORE (défaut 0.8), et si aucune entrée d'une
+  autre substance n'est aussi proche. Le nom lu n'est jamais remplacé : les
+  appelants exposent la correspondance à côté (nom_reference, score).
+
+    match = get_drug_index().lookup("PARACETAMQL")  # → Paracétamol, score 0.91
+"""
+import heapq
+import logging
+import os
+import re
+import threading
+import unicodedata
+from array import array
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_REFERENCE_FILE = os.path.join(os.path.dirname(__file__), "data", "medicaments_reference.tsv")
+# En dessous, un trigramme ne discrimine plus assez (ex. « FER »)
+MIN_FUZZY_LENGTH = 4
+# Candidats (par trigrammes communs) départagés par distance d'édition
+RERANK_CANDIDATES = 10
+# Une faute de lecture tolérée par tranche de 12 lettres
+CHARS_PER_EDIT = 12
+
+_OCR_DIGITS = str.maketrans({"0": "O", "1": "I", "5": "S", "8": "B"})
+_NON_ALNUM_RE = re.compile(r"[^A-Z0-9]+")
+_BDPM_NAME_RE = re.compile(r"^[^\d,]+")
+
+
+def normalize(name: str) -> str:
+    decomposed = unicodedata.normalize("NFKD", name)
+    ascii_name = "".join(c for c in decomposed if not unicodedata.combining(c)).upper()
+    tokens = _NON_ALNUM_RE.sub(" ", ascii_name).split()
+    # Un chiffre au milieu d'un mot est presque toujours une lettre mal lue
+    return " ".join(t.translate(_OCR_DIGITS) if any(c.isalpha() for c in t) else t for t in tokens)
+
+
+def _trigrams(key: str) -> set:
+    padded = f" {key} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def _edit_distance(a: str, b: str, limit: int) -> int:
+    """Distance de Levenshtein, ou limit + 1 dès qu'elle est dépassée."""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+        if min(current) > limit:
+            return limit + 1
+        previous = current
+    return previous[-1]
+
+
+@dataclass(frozen=True)
+class DrugEntry:
+    nom: str
+    dci: Optional[str] = None
+
+    @property
+    def substance(self) -> str:
+        return self.dci or self.nom
+
+
+@dataclass(frozen=True)
+class DrugMatch:
+    entry: DrugEntry
+    score: float
+    exact: bool
+
+
+def _read_reference(path: str) -> Iterable[Tuple[str, Optional[str]]]:
+    """(nom, dci) depuis le TSV du dépôt ou un CIS_bdpm.txt (1re colonne numérique)."""
+    try:
+        with open(path, encoding="utf-8") as f:
+            lines = f.read().splitlines()
+    except UnicodeDecodeError:
+        # Les exports BDPM historiques sont en latin-1
+        with open(path, encoding="latin-1") as f:
+            lines = f.read().splitlines()
+    for line in lines:
+        if not line.strip() or line.startswith("#"):
+            continue
+        cols = line.split("\t")
+        if cols[0].strip().isdigit() and len(cols) > 1:
+            # BDPM : « DOLIPRANE 1000 mg, comprimé » → « DOLIPRANE »
+            m = _BDPM_NAME_RE.match(cols[1])
+            if m and m.group().strip():
+                yield m.group().strip().title(), None
+            continue
+        nom = cols[0].strip()
+        dci = cols[1].strip() if len(cols) > 1 and cols[1].strip() else None
+        yield nom, dci
+
+
+class DrugIndex:
+    def __init__(self, entries: Iterable[Tuple[str, Optional[str]]], min_score: float = None):
+        self.min_score = min_score or float(os.getenv("DRUG_MATCH_MIN_SCORE", "0.8"))
+        self._entries: List[DrugEntry] = []
+        self._keys: List[str] = []
+        self._exact: Dict[str, int] = {}
+        self._postings: Dict[str, array] = {}
+        for nom, dci in entries:
+            key = normalize(nom)
+            if not key or key in self._exact:
+                continue
+            idx = len(self._entries)
+            self._entries.append(DrugEntry(nom, dci))
+            self._keys.append(key)
+            self._exact[key] = idx
+            grams = _trigrams(key)
+            for g in grams:
+                self._postings.setdefault(g, array("I")).append(idx)
+
+    @classmethod
+    def from_file(cls, path: str = None) -> "DrugIndex":
+        path = path or os.getenv("DRUG_REFERENCE_FILE") or DEFAULT_REFERENCE_FILE
+        index = cls(_read_reference(path))
+        logger.info(f"Référentiel médicaments chargé : {len(index)} entrées ({path})")
+        return index
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _best(self, key: str, min_score: float) -> Optional[DrugMatch]:
+        idx = self._exact.get(key)
+        if idx is not None:
+            return DrugMatch(self._entries[idx], 1.0, True)
+        if len(key) < MIN_FUZZY_LENGTH:
+            return None
+        grams = _trigrams(key)
+        shared: Dict[int, int] = {}
+        for g in grams:
+            for i in self._postings.get(g, ()):
+                shared[i] = shared.get(i, 0) + 1
+        if not shared:
+            return None
+        top = heapq.nlargest(RERANK_CANDIDATES, shared, key=shared.__getitem__)
+        max_edits = 1 + len(key) // CHARS_PER_EDIT
+        ranked = sorted(
+            (d, i) for i in top if (d := _edit_distance(key, self._keys[i], max_edits)) <= max_edits
+        )
+        if not ranked:
+            return None
+        distance, best = ranked[0]
+        entry = self._entries[best]
+        # Une autre substance à la même distance : on ne choisit pas au hasard
+        if any(d == distance and self._entries[i].substance != entry.substance for d, i in ranked[1:]):
+            return None
+        score = 1 - distance / max(len(key), len(self._keys[best]))
+        if score < min_score:
+            return None
+        return DrugMatch(entry, score, False)
+
+    def lookup(self, name: str, min_score: float = None) -> Optional[DrugMatch]:
+        """
+        Entrée correspondant au nom complet `name` (tous ses mots), ou None. Pas
+        de repli sur les premiers mots : « Dafalgan codéine » n'est pas Dafalgan.
+        """
+        min_score = self.min_score if min_score is None else min_score
+        key = normalize(name or "")
+        if not key:
+            return None
+        return self._best(key, min_score)
+
+
+_index: Optional[DrugIndex] = None
+_index_lock = threading.Lock()
+
+
+def get_drug_index() -> DrugIndex:
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = DrugIndex.from_file()
+    return _index
@@ -0,0 +1,175 @@
+"""
+Cache adressé par contenu devant l'extraction d'ordonnance.
+
+Clé = sha256(modèle + version du prompt + textes du tour + empreintes des
+images normalisées) : orientation EXIF corrigée, RGB, réduite à
+NORMALIZED_SIZE, pour qu'un ré-envoi de la même photo (ou un renvoi du front à
+la reconnexion) retombe sur la même entrée ; un changement de modèle ou de
+prompt ne ressert jamais une ancienne extraction.
+
+Stockage sur disque local, un fichier JSON par clé dans des sous-dossiers
+sharding <clé[:2]>/ :
+- EXTRACTION_CACHE_DIR (défaut .cache/extractions), EXTRACTION_CACHE=0 pour désactiver,
+- EXTRACTION_CACHE_TTL_SECONDS : durée de validité (défaut 30 jours), comptée
+  depuis l'écriture : mtime du fichier, seule source de temps (la dernière
+  lecture est notée dans l'atime, pour l'éviction LRU),
+- EXTRACTION_CACHE_MAX_BYTES : taille totale au-delà de laquelle les entrées
+  les moins récemment lues sont supprimées (défaut 50 Mo).
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from typing import List, Optional
+
+from services import metrics
+from services.llm import _as_bool, _is_image, iter_parts
+
+logger = logging.getLogger(__name__)
+
+NORMALIZED_SIZE = (512, 512)
+
+_lookups = metrics.counter("extraction_cache_lookups_total", "Consultations du cache d'extraction (hit / miss / expired)")
+_evictions = metrics.counter("extraction_cache_evictions_total", "Entrées supprimées (ttl / size)")
+_size = metrics.gauge("extraction_cache_bytes", "Taille du cache d'extraction sur disque")
+
+
+def image_fingerprint(image) -> str:
+    """Empreinte des pixels après normalisation (indépendante de l'encodage du fichier)."""
+    from PIL import ImageOps
+
+    img = ImageOps.exif_transpose(image) or image
+    img = img.convert("RGB")
+    img.thumbnail(NORMALIZED_SIZE)
+    h = hashlib.sha256(f"{img.width}x{img.height}".encode())
+    h.update(img.tobytes())
+    return h.hexdigest()
+
+
+def cache_key(prompt_parts, prompt_version: str, model: str) -> Optional[str]:
+    """None si le tour ne contient pas d'image (rien à mettre en cache)."""
+    parts = list(iter_parts(prompt_parts))
+    if not any(_is_image(p) for p in parts):
+        return None
+    h = hashlib.sha256(f"{model}\0{prompt_version}".encode())
+    for part in parts:
+        h.update(b"\0")
+        h.update(image_fingerprint(part).encode() if _is_image(part) else str(part).encode("utf-8"))
+    return h.hexdigest()
+
+
+class ExtractionCache:
+    def __init__(self, directory: str = None, ttl: float = None, max_bytes: int = None):
+        self.directory = directory or os.getenv("EXTRACTION_CACHE_DIR", os.path.join(".cache", "extractions"))
+        self.ttl = ttl or float(os.getenv("EXTRACTION_CACHE_TTL_SECONDS", 30 * 24 * 3600))
+        self.max_bytes = max_bytes or int(os.getenv("EXTRACTION_CACHE_MAX_BYTES", 50 * 1024 * 1024))
+        self._lock = threading.Lock()
+        self._total: Optional[int] = None
+        _size.set_function(lambda: self._total or 0)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], f"{key}.json")
+
+    def _entries(self) -> List[os.DirEntry]:
+        entries = []
+        if not os.path.isdir(self.directory):
+            return entries
+        for shard in os.scandir(self.directory):
+            if shard.is_dir():
+                entries.extend(e for e in os.scandir(shard.path) if e.name.endswith(".json"))
+        return entries
+
+    def _ensure_total(self) -> None:
+        if self._total is None:
+            self._total = sum(e.stat().st_size for e in self._entries())
+
+    def get(self, key: str) -> Optional[dict]:
+        path = self._path(key)
+        try:
+            written = os.stat(path).st_mtime
+            if time.time() - written > self.ttl:
+                _lookups.inc(outcome="expired")
+                self._remove(path, reason="ttl")
+                return None
+            with open(path, encoding="utf-8") as f:
+                entry = json.load(f)
+        except FileNotFoundError:
+            _lookups.inc(outcome="miss")
+            return None
+        except (OSError, ValueError):
+            logger.warning(f"Entrée de cache illisible, ignorée : {path}")
+            _lookups.inc(outcome="miss")
+            return None
+
+        # atime = dernière lecture, pour l'éviction LRU ; mtime (écriture) inchangé
+        try:
+            os.utime(path, (time.time(), written))
+        except OSError:
+            pass
+        _lookups.inc(outcome="hit")
+        return entry.get("value")
+
+    def put(self, key: str, value: dict) -> None:
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        data = json.dumps({"value": value}, ensure_ascii=False).encode("utf-8")
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        with self._lock:
+            self._ensure_total()
+            previous = os.path.getsize(path) if os.path.exists(path) else 0
+            os.replace(tmp, path)
+            self._total += len(data) - previous
+            if self._total > self.max_bytes:
+                self._evict()
+
+    def _remove(self, path: str, reason: str) -> None:
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except OSError:
+            return
+        _evictions.inc(reason=reason)
+        with self._lock:
+            if self._total is not None:
+                self._total -= size
+
+    def _evict(self) -> None:
+        """Supprime les entrées expirées puis les moins récemment lues jusqu'à 90 % de la limite."""
+        now = time.time()
+        # expirées (écrites il y a plus de ttl) d'abord, puis par dernière lecture
+        entries = sorted(
+            ((e.stat(), e.path) for e in self._entries()),
+            key=lambda item: (now - item[0].st_mtime <= self.ttl, item[0].st_atime),
+        )
+        target = int(self.max_bytes * 0.9)
+        total = sum(st.st_size for st, _ in entries)
+        for st, path in entries:
+            expired = now - st.st_mtime > self.ttl
+            if total <= target and not expired:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= st.st_size
+            _evictions.inc(reason="ttl" if expired else "size")
+        self._total = total
+
+
+_cache: Optional[ExtractionCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_extraction_cache() -> Optional[ExtractionCache]:
+    global _cache
+    if not _as_bool(os.getenv("EXTRACTION_CACHE"), default=True):
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = ExtractionCache()
+    return _cache
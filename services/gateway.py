@@ -0,0 +1,271 @@
+"""
+Passerelle unique devant le fournisseur LLM.
+
+- Voies prioritaires : chat interactif > extraction d'ordonnance > batch.
+- Limiteurs « token bucket » sur les requêtes par seconde (QPS) et les tokens
+  par minute (TPM) ; les tokens sont estimés à l'admission puis réconciliés
+  avec l'usage réel.
+- Concurrence adaptative AIMD : +1/limite par succès rapide, ×0.9 si la
+  latence dépasse la cible, ×0.5 sur un 429.
+- Délestage : si l'attente estimée (ou réelle) dépasse le délai de la voie,
+  l'appel échoue tout de suite avec GatewayBusy pour répondre « occupé ».
+
+La passerelle est partagée entre boucles asyncio (serveur WebSocket, thread
+FastAPI) : son état est protégé par un verrou et les réveils passent par
+call_soon_threadsafe.
+"""
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Dict, Optional
+
+from services import metrics
+from services.llm import LLMBackend, LLMRequest, LLMResponse, estimate_prompt_tokens
+from services.resilience import LLMUnavailable, is_rate_limited
+
+logger = logging.getLogger(__name__)
+
+LANE_INTERACTIVE = "interactive"
+LANE_EXTRACTION = "extraction"
+LANE_BATCH = "batch"
+LANE_PRIORITY = {LANE_INTERACTIVE: 0, LANE_EXTRACTION: 1, LANE_BATCH: 2}
+
+
+class GatewayBusy(LLMUnavailable):
+    """Charge trop élevée : la requête est délestée plutôt que mise en attente."""
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, default))
+    except ValueError:
+        return default
+
+
+class TokenBucket:
+    def __init__(self, rate_per_sec: float, capacity: float):
+        self.rate = rate_per_sec
+        self.capacity = capacity
+        self.tokens = capacity
+        self._last = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def delay_for(self, amount: float, now: float) -> float:
+        """Temps d'attente avant de pouvoir consommer `amount` (0 si disponible)."""
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate if self.rate > 0 else float("inf")
+
+    def consume(self, amount: float) -> None:
+        self.tokens -= amount
+
+    def adjust(self, delta: float) -> None:
+        # Réconciliation estimation / réel ; peut devenir négatif (dette)
+        self.tokens = min(self.capacity, self.tokens + delta)
+
+
+@dataclass(order=True)
+class _Waiter:
+    priority: int
+    seq: int
+    lane: str = field(compare=False)
+    tokens: int = field(compare=False)
+    loop: asyncio.AbstractEventLoop = field(compare=False)
+    future: asyncio.Future = field(compare=False)
+    enqueued_at: float = field(compare=False)
+    granted: bool = field(default=False, compare=False)
+    cancelled: bool = field(default=False, compare=False)
+
+
+def _resolve(future: asyncio.Future) -> None:
+    if not future.done():
+        future.set_result(None)
+
+
+_in_flight = metrics.gauge("llm_gateway_in_flight", "Appels en cours")
+_limit = metrics.gauge("llm_gateway_concurrency_limit", "Limite de concurrence AIMD")
+_queue_depth = metrics.gauge("llm_gateway_queue_depth", "Appels en attente par voie")
+_queue_wait = metrics.histogram("llm_gateway_queue_wait_seconds", "Attente avant admission")
+_shed = metrics.counter("llm_gateway_shed_total", "Appels délestés")
+_outcomes = metrics.counter("llm_gateway_calls_total", "Appels admis par voie et issue")
+
+
+class LLMGateway:
+    def __init__(
+        self,
+        qps: float = None,
+        tpm: float = None,
+        initial_concurrency: float = None,
+        min_concurrency: float = 1,
+        max_concurrency: float = None,
+        target_latency: float = None,
+        max_wait: Optional[Dict[str, float]] = None,
+    ):
+        qps = qps or _env_float("LLM_GATEWAY_QPS", 10)
+        tpm = tpm or _env_float("LLM_GATEWAY_TPM", 1_000_000)
+        self._qps = TokenBucket(qps, max(qps, 1))
+        self._tpm = TokenBucket(tpm / 60.0, tpm)
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency or _env_float("LLM_GATEWAY_MAX_CONCURRENCY", 64)
+        self.limit = initial_concurrency or _env_float("LLM_GATEWAY_CONCURRENCY", 8)
+        self.target_latency = target_latency or _env_float("LLM_GATEWAY_TARGET_LATENCY_SECONDS", 8)
+        self.max_wait = max_wait or {
+            LANE_INTERACTIVE: _env_float("LLM_GATEWAY_MAX_WAIT_INTERACTIVE", 3),
+            LANE_EXTRACTION: _env_float("LLM_GATEWAY_MAX_WAIT_EXTRACTION", 10),
+            LANE_BATCH: _env_float("LLM_GATEWAY_MAX_WAIT_BATCH", 60),
+        }
+        self._lock = threading.Lock()
+        self._heap: list = []
+        self._seq = itertools.count()
+        self._in_flight = 0
+        self._depth = {lane: 0 for lane in LANE_PRIORITY}
+        self._avg_latency = self.target_latency / 2
+        self._timer_pending = False
+
+        _limit.set_function(lambda: self.limit)
+        _in_flight.set_function(lambda: self._in_flight)
+        for lane in LANE_PRIORITY:
+            _queue_depth.set_function(lambda lane=lane: self._depth[lane], lane=lane)
+
+    # ── Admission ────────────────────────────────────────────────────────────
+    def _expected_wait(self, priority: int, tokens: int, now: float) -> float:
+        ahead = sum(1 for w in self._heap if not w.cancelled and w.priority <= priority)
+        free = max(int(self.limit) - self._in_flight, 0)
+        queued = max(ahead + 1 - free, 0)
+        rate_delay = max(self._qps.delay_for(1, now), self._tpm.delay_for(tokens, now))
+        return queued * self._avg_latency / max(self.limit, 1) + rate_delay
+
+    def _dispatch_locked(self) -> None:
+        now = time.monotonic()
+        while self._heap and self._in_flight < int(self.limit):
+            waiter = self._heap[0]
+            if waiter.cancelled:
+                heapq.heappop(self._heap)
+                continue
+            delay = max(self._qps.delay_for(1, now), self._tpm.delay_for(waiter.tokens, now))
+            if delay > 0:
+                self._schedule_redispatch(waiter.loop, delay)
+                return
+            heapq.heappop(self._heap)
+            self._qps.consume(1)
+            self._tpm.consume(waiter.tokens)
+            self._in_flight += 1
+            self._depth[waiter.lane] -= 1
+            waiter.granted = True
+            waiter.loop.call_soon_threadsafe(_resolve, waiter.future)
+
+    def _schedule_redispatch(self, loop: asyncio.AbstractEventLoop, delay: float) -> None:
+        if self._timer_pending or loop.is_closed():
+            return
+        self._timer_pending = True
+        loop.call_soon_threadsafe(loop.call_later, delay, self._on_timer)
+
+    def _on_timer(self) -> None:
+        with self._lock:
+            self._timer_pending = False
+            self._dispatch_locked()
+
+    async def acquire(self, lane: str, tokens: int) -> float:
+        """Attend un créneau ; retourne le temps d'attente ou lève GatewayBusy."""
+        priority = LANE_PRIORITY.get(lane, LANE_PRIORITY[LANE_BATCH])
+        max_wait = self.max_wait.get(lane, self.max_wait[LANE_BATCH])
+        loop = asyncio.get_running_loop()
+        now = time.monotonic()
+        with self._lock:
+            expected = self._expected_wait(priority, tokens, now)
+            if expected > max_wait:
+                _shed.inc(lane=lane, reason="expected_wait")
+                raise GatewayBusy(f"Attente estimée {expected:.1f}s > {max_wait:.0f}s ({lane})")
+            waiter = _Waiter(priority, next(self._seq), lane, tokens, loop, loop.create_future(), now)
+            heapq.heappush(self._heap, waiter)
+            self._depth[lane] += 1
+            self._dispatch_locked()
+
+        try:
+            await asyncio.wait_for(waiter.future, timeout=max_wait)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            with self._lock:
+                if not waiter.granted:
+                    waiter.cancelled = True
+                    self._depth[lane] -= 1
+                    granted = False
+                else:
+                    granted = True
+            if not granted:
+                if isinstance(e, asyncio.CancelledError):
+                    raise
+                _shed.inc(lane=lane, reason="timeout")
+                raise GatewayBusy(f"Pas de créneau après {max_wait:.0f}s ({lane})") from e
+            if isinstance(e, asyncio.CancelledError):
+                self.release(lane, 0.0, tokens, 0, "cancelled")
+                raise
+        wait = time.monotonic() - now
+        _queue_wait.observe(wait, lane=lane)
+        return wait
+
+    def release(self, lane: str, latency: float, estimated_tokens: int, actual_tokens: int, outcome: str) -> None:
+        with self._lock:
+            self._in_flight -= 1
+            self._tpm.adjust(estimated_tokens - actual_tokens)
+            if outcome == "rate_limited":
+                self.limit = max(self.min_concurrency, self.limit * 0.5)
+            elif outcome == "ok":
+                self._avg_latency = 0.8 * self._avg_latency + 0.2 * latency
+                if latency > self.target_latency:
+                    self.limit = max(self.min_concurrency, self.limit * 0.9)
+                else:
+                    self.limit = min(self.max_concurrency, self.limit + 1.0 / self.limit)
+            self._dispatch_locked()
+        _outcomes.inc(lane=lane, outcome=outcome)
+
+    async def run(self, request: LLMRequest, call: Callable[[LLMRequest], Awaitable[LLMResponse]]) -> LLMResponse:
+        lane = request.lane
+        estimated = estimate_prompt_tokens(request) + int(request.generation_config.get("max_output_tokens", 0))
+        await self.acquire(lane, estimated)
+        t0 = time.perf_counter()
+        outcome, actual = "error", estimated
+        try:
+            resp = await call(request)
+            outcome, actual = "ok", resp.prompt_tokens + resp.output_tokens
+            return resp
+        except Exception as e:
+            if is_rate_limited(e):
+                outcome = "rate_limited"
+            raise
+        finally:
+            self.release(lane, time.perf_counter() - t0, estimated, actual, outcome)
+
+
+class GatewayBackend(LLMBackend):
+    """Fait passer chaque tentative (retries, hedges compris) par la passerelle."""
+
+    def __init__(self, inner: LLMBackend, gateway: LLMGateway):
+        self.inner = inner
+        self.gateway = gateway
+        self.name = f"gateway:{inner.name}"
+
+    async def generate(self, request: LLMRequest) -> LLMResponse:
+        return await self.gateway.run(request, self.inner.generate)
+
+
+_gateway: Optional[LLMGateway] = None
+_gateway_lock = threading.Lock()
+
+
+def get_gateway() -> LLMGateway:
+    global _gateway
+    if _gateway is None:
+        with _gateway_lock:
+            if _gateway is None:
+                _gateway = LLMGateway()
+    return _gateway
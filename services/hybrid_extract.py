@@ -0,0 +1,137 @@
+"""
+Extraction d'ordonnance hybride : OCR local d'abord, modèle seulement si besoin.
+
+1. OCR sur le pool (services/ocr_pool.py) puis parseur regex (ordo_extract).
+2. Score de confiance = moyenne pondérée de la confiance OCR des mots et de la
+   part des noms retrouvés dans le référentiel local (services/drug_index.py).
+3. Au-dessus de HYBRID_CONFIDENCE_THRESHOLD (défaut 0.75), le résultat local
+   est gardé ; sinon l'image part au modèle (extract_medications), avec le
+   texte OCR en indice si HYBRID_OCR_HINT=1.
+4. Si le modèle est indisponible (quota, délestage, panne) et que l'OCR a
+   trouvé quelque chose, on se rabat sur le résultat local.
+
+Répartition local / LLM et latence de chaque chemin dans services.metrics.
+
+    result = await extract_prescription("/tmp/ordo.jpg", prompt_parts, user_id=42)
+"""
+import asyncio
+import logging
+import os
+import time
+from dataclasses import dataclass, field
+from io import BytesIO
+from typing import Dict, List, Optional, Union
+
+from PIL import Image
+
+from services import metrics
+from services.llm import _as_bool
+from services.ocr_pool import OCRUnavailable, get_ocr_pool
+from services.ordo_extract import _meds_as_dicts
+from services.quota import QuotaExceeded
+from services.resilience import LLMUnavailable
+from services.service import extract_medications
+
+logger = logging.getLogger(__name__)
+
+SOURCE_LOCAL, SOURCE_LLM, SOURCE_LOCAL_FALLBACK = "local", "llm", "local_fallback"
+# Poids de la confiance OCR face à la part de noms reconnus
+OCR_CONFIDENCE_WEIGHT = 0.5
+OCR_HINT_MAX_CHARS = 4000
+
+_extractions = metrics.counter("hybrid_extractions_total", "Extractions d'ordonnance par chemin retenu (local / llm / local_fallback)")
+_path_latency = metrics.histogram("hybrid_path_seconds", "Latence de chaque chemin d'extraction (ocr / llm)")
+_confidence = metrics.histogram("hybrid_confidence", "Score de confiance de l'extraction locale")
+
+
+@dataclass
+class HybridExtraction:
+    medicaments: List[Dict]
+    source: str
+    confiance: float
+    latences: Dict[str, float] = field(default_factory=dict)
+    reponse_textuelle: Optional[str] = None
+
+
+def confidence_score(ocr_confidence: float, meds: List[Dict]) -> float:
+    """0 si rien n'a été trouvé ; sinon moyenne pondérée, entre 0 et 1."""
+    if not meds:
+        return 0.0
+    recognized = sum(1 for m in meds if m.get("reconnu")) / len(meds)
+    return OCR_CONFIDENCE_WEIGHT * (ocr_confidence / 100) + (1 - OCR_CONFIDENCE_WEIGHT) * recognized
+
+
+def _load_image(image: Union[bytes, str]) -> Image.Image:
+    """Image décodée ; le fichier est refermé avant l'appel au modèle."""
+    with Image.open(image if isinstance(image, str) else BytesIO(image)) as img:
+        img.load()
+    return img
+
+
+async def extract_prescription(
+    image: Union[bytes, str],
+    prompt_parts: Optional[list] = None,
+    user_id: Optional[int] = None,
+    threshold: Optional[float] = None,
+) -> Optional[HybridExtraction]:
+    """
+    `image` : chemin du fichier (lu par le worker OCR, sans copie) ou octets.
+    `prompt_parts` : contenu envoyé au modèle si l'OCR ne suffit pas (par
+    défaut, l'image seule). Retourne None si ni l'OCR ni le modèle n'ont
+    produit de résultat exploitable. Les erreurs du modèle (QuotaExceeded,
+    LLMUnavailable…) ne remontent que si l'OCR n'a rien trouvé.
+    """
+    threshold = float(os.getenv("HYBRID_CONFIDENCE_THRESHOLD", "0.75")) if threshold is None else threshold
+    latences: Dict[str, float] = {}
+
+    text, meds, score = "", [], 0.0
+    t0 = time.perf_counter()
+    try:
+        ocr = await get_ocr_pool().recognize(image)
+        text, meds = ocr.text, _meds_as_dicts(ocr.text)
+        score = confidence_score(ocr.confidence, meds)
+    except OCRUnavailable as e:
+        # pool saturé ou sans moteur : le modèle prend le relais
+        logger.info(f"OCR local indisponible, passage au modèle: {e}")
+    except Exception as e:
+        logger.warning(f"Échec OCR local: {e}")
+    latences["ocr"] = time.perf_counter() - t0
+    _path_latency.observe(latences["ocr"], path="ocr")
+    _confidence.observe(score)
+
+    if meds and score >= threshold:
+        _extractions.inc(source=SOURCE_LOCAL)
+        return HybridExtraction(meds, SOURCE_LOCAL, score, latences)
+
+    if prompt_parts:
+        parts = list(prompt_parts)
+    else:
+        # Décodage (plusieurs ms à centaines de ms) hors de la boucle d'événements
+        parts = [await asyncio.to_thread(_load_image, image)]
+    if text.strip() and _as_bool(os.getenv("HYBRID_OCR_HINT"), default=True):
+        parts.append(
+            "Texte lu par OCR sur cette ordonnance (peut contenir des erreurs) :\n" + text[:OCR_HINT_MAX_CHARS]
+        )
+    t0 = time.perf_counter()
+    try:
+        extraction = await extract_medications(parts, user_id=user_id)
+    except (LLMUnavailable, QuotaExceeded) as e:
+        if not meds:
+            raise
+        logger.info(f"Modèle indisponible ({type(e).__name__}), résultat OCR conservé")
+        _extractions.inc(source=SOURCE_LOCAL_FALLBACK)
+        return HybridExtraction(meds, SOURCE_LOCAL_FALLBACK, score, latences)
+    finally:
+        latences["llm"] = time.perf_counter() - t0
+        _path_latency.observe(latences["llm"], path="llm")
+
+    if extraction is None or not extraction.medicaments:
+        if meds:
+            _extractions.inc(source=SOURCE_LOCAL_FALLBACK)
+            return HybridExtraction(meds, SOURCE_LOCAL_FALLBACK, score, latences)
+        if extraction is None:
+            return None
+    _extractions.inc(source=SOURCE_LLM)
+    return HybridExtraction(
+        [m.model_dump() for m in extraction.medicaments], SOURCE_LLM, score, latences, extraction.reponse_textuelle
+    )
@@ -0,0 +1,467 @@
+"""
+Interface asynchrone des backends LLM utilisés par le chat.
+
+- `GeminiBackend` : appel réel à google.generativeai (import paresseux).
+- `FakeBackend`   : backend local déterministe (texte, tool-calls, bloc JSON
+  de médicaments) avec latence et débit de tokens configurables, pour tester
+  et mesurer le pipeline de chat sans réseau.
+
+Le backend est choisi par la variable d'environnement LLM_BACKEND
+(`gemini` par défaut, `fake`, ou `replay` — voir services/cassette.py).
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+from abc import ABC, abstractmethod
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Coût forfaitaire d'une image en tokens d'entrée (ordre de grandeur Gemini)
+IMAGE_TOKENS = 258
+
+
+@dataclass
+class FunctionCall:
+    name: str
+    args: Dict[str, Any] = field(default_factory=dict)
+
+
+@dataclass
+class LLMRequest:
+    """
+    parts: texte, images PIL, entrées d'historique {"role", "parts"} ou
+    résultats d'outils {"function_response": {...}}.
+    """
+    parts: List[Any]
+    model: str
+    system_instruction: Optional[str] = None
+    tools: Optional[list] = None
+    generation_config: Dict[str, Any] = field(default_factory=dict)
+    # Partie dynamique (profil utilisateur, date) séparée de l'instruction
+    # statique pour que cette dernière puisse être mise en cache côté fournisseur.
+    context: Optional[str] = None
+    # Nom de la route choisie (services/routing.py), pour les métriques
+    route: Optional[str] = None
+    # Voie de priorité dans la passerelle (services/gateway.py)
+    lane: str = "interactive"
+    # Utilisateur authentifié, pour les quotas (services/quota.py)
+    user_id: Optional[int] = None
+
+    def full_instruction(self) -> Optional[str]:
+        pieces = [p for p in (self.system_instruction, self.context) if p]
+        return "\n\n".join(pieces) if pieces else None
+
+
+@dataclass
+class LLMResponse:
+    text: str = ""
+    function_calls: List[FunctionCall] = field(default_factory=list)
+    model: str = ""
+    prompt_tokens: int = 0
+    output_tokens: int = 0
+    cached_tokens: int = 0
+    latency: float = 0.0
+
+
+class LLMBackend(ABC):
+    name = "abstract"
+
+    @abstractmethod
+    async def generate(self, request: LLMRequest) -> LLMResponse:
+        ...
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Helpers sur les parts
+# ──────────────────────────────────────────────────────────────────────────────
+def _is_image(part) -> bool:
+    return hasattr(part, "size") and hasattr(part, "mode")
+
+
+def iter_parts(parts):
+    """Aplatit les entrées d'historique {"role", "parts"} en parts simples."""
+    if isinstance(parts, (str, dict)) or _is_image(parts):
+        parts = [parts]
+    for part in parts or []:
+        if isinstance(part, dict) and "parts" in part:
+            yield from iter_parts(part["parts"])
+        else:
+            yield part
+
+
+def estimate_tokens(text: str) -> int:
+    return max(1, len(text) // 4) if text else 0
+
+
+def estimate_prompt_tokens(request: LLMRequest) -> int:
+    total = estimate_tokens(request.full_instruction() or "")
+    for part in iter_parts(request.parts):
+        if isinstance(part, str):
+            total += estimate_tokens(part)
+        elif _is_image(part):
+            total += IMAGE_TOKENS
+        elif isinstance(part, dict):
+            total += estimate_tokens(json.dumps(part, default=str))
+    return total
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Gemini
+# ──────────────────────────────────────────────────────────────────────────────
+def _as_bool(val: Optional[str], default: bool = False) -> bool:
+    if val is None:
+        return default
+    return val.strip().lower() in {"1", "true", "yes", "y", "on"}
+
+
+@dataclass
+class _CacheEntry:
+    handle: Any
+    expire_at: float
+
+
+class GeminiBackend(LLMBackend):
+    """
+    Avec GEMINI_CONTEXT_CACHE=1, l'instruction système statique et les
+    déclarations d'outils sont placées dans un CachedContent réutilisé
+    d'un appel à l'autre (clé = modèle + instruction + outils). La partie
+    dynamique (`request.context`) est alors envoyée en tête du contenu.
+    Le handle est prolongé avant expiration et recréé s'il a disparu.
+    """
+    name = "gemini"
+
+    def __init__(self, api_key: Optional[str] = None, context_cache: Optional[bool] = None):
+        import google.generativeai as genai
+        genai.configure(api_key=api_key or os.getenv("GEMAL_API_KEY"))
+        self._genai = genai
+        self.context_cache = _as_bool(os.getenv("GEMINI_CONTEXT_CACHE")) if context_cache is None else context_cache
+        self.cache_ttl = int(os.getenv("GEMINI_CACHE_TTL_SECONDS", "3600"))
+        self.cache_refresh_margin = int(os.getenv("GEMINI_CACHE_REFRESH_SECONDS", "300"))
+        self._caches: Dict[str, _CacheEntry] = {}
+        self._uncacheable: set = set()
+        self._cache_lock = threading.Lock()
+        # Un verrou par clé : les premiers appels concurrents ne créent qu'un CachedContent
+        self._key_locks: Dict[str, threading.Lock] = {}
+
+    async def generate(self, request: LLMRequest) -> LLMResponse:
+        t0 = time.perf_counter()
+        entry = await self._cached_context(request) if self._should_cache(request) else None
+        if entry is not None:
+            try:
+                resp = await self._generate_cached(entry, request)
+            except Exception as e:
+                if not _is_missing_cache_error(e):
+                    raise
+                # Cache expiré/supprimé côté fournisseur → on le recrée une fois
+                self._drop_cache(self._cache_key(request))
+                entry = await self._cached_context(request)
+                if entry is None:
+                    resp = await self._generate_plain(request)
+                else:
+                    resp = await self._generate_cached(entry, request)
+        else:
+            resp = await self._generate_plain(request)
+        return self._to_response(resp, request, time.perf_counter() - t0)
+
+    async def _generate_plain(self, request: LLMRequest):
+        model = self._genai.GenerativeModel(
+            model_name=request.model,
+            generation_config=request.generation_config,
+            system_instruction=request.full_instruction(),
+            tools=request.tools,
+        )
+        return await model.generate_content_async(request.parts)
+
+    async def _generate_cached(self, entry: _CacheEntry, request: LLMRequest):
+        model = self._genai.GenerativeModel.from_cached_content(
+            cached_content=entry.handle,
+            generation_config=request.generation_config,
+        )
+        return await model.generate_content_async(_prepend_context(request.parts, request.context))
+
+    # ── Gestion des CachedContent ────────────────────────────────────────────
+    def _should_cache(self, request: LLMRequest) -> bool:
+        return self.context_cache and bool(request.system_instruction) and \
+            self._cache_key(request) not in self._uncacheable
+
+    @staticmethod
+    def _cache_key(request: LLMRequest) -> str:
+        payload = json.dumps([request.model, request.system_instruction, request.tools], sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _drop_cache(self, key: str) -> None:
+        with self._cache_lock:
+            self._caches.pop(key, None)
+
+    async def _cached_context(self, request: LLMRequest) -> Optional[_CacheEntry]:
+        key = self._cache_key(request)
+        with self._cache_lock:
+            entry = self._caches.get(key)
+        if entry is not None and entry.expire_at - time.time() > self.cache_refresh_margin:
+            return entry
+        # Création / prolongation dans un thread, sous le verrou de la clé : le
+        # backend sert plusieurs boucles d'événements (asyncio.Lock impossible)
+        return await asyncio.to_thread(self._ensure_cached_context, key, request)
+
+    def _key_lock(self, key: str) -> threading.Lock:
+        with self._cache_lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+
+    def _ensure_cached_context(self, key: str, request: LLMRequest) -> Optional[_CacheEntry]:
+        with self._key_lock(key):
+            with self._cache_lock:
+                entry = self._caches.get(key)
+                if key in self._uncacheable:
+                    return None
+            # Un appel concurrent a pu créer ou prolonger le cache pendant l'attente du verrou
+            if entry is not None and entry.expire_at - time.time() > self.cache_refresh_margin:
+                return entry
+
+            ttl = timedelta(seconds=self.cache_ttl)
+            if entry is not None:
+                try:
+                    entry.handle.update(ttl=ttl)
+                    entry.expire_at = time.time() + self.cache_ttl
+                    return entry
+                except Exception as e:
+                    logger.info(f"Prolongation du cache de contexte impossible ({e}), recréation.")
+
+            try:
+                handle = self._genai.caching.CachedContent.create(
+                    model=f"models/{request.model}",
+                    system_instruction=request.system_instruction,
+                    tools=request.tools,
+                    ttl=ttl,
+                )
+            except Exception as e:
+                # Typiquement : instruction sous le minimum de tokens cachables
+                logger.warning(f"Cache de contexte indisponible pour {request.model}: {e}")
+                with self._cache_lock:
+                    self._uncacheable.add(key)
+                return None
+
+            entry = _CacheEntry(handle=handle, expire_at=time.time() + self.cache_ttl)
+            with self._cache_lock:
+                self._caches[key] = entry
+            logger.info(f"Cache de contexte créé pour {request.model} ({getattr(handle, 'name', '?')})")
+            return entry
+
+    @staticmethod
+    def _to_response(resp, request: LLMRequest, latency: float) -> LLMResponse:
+        texts: List[str] = []
+        function_calls: List[FunctionCall] = []
+        # Les objets du SDK ont des ATTRIBUTS (pas .get)
+        for cand in getattr(resp, "candidates", []) or []:
+            content = getattr(cand, "content", None)
+            if not content:
+                continue
+            for part in getattr(content, "parts", []) or []:
+                fc = getattr(part, "function_call", None)
+                if fc and getattr(fc, "name", None):
+                    function_calls.append(FunctionCall(name=fc.name, args=dict(getattr(fc, "args", {}) or {})))
+                elif getattr(part, "text", None):
+                    texts.append(part.text)
+            break  # un seul candidat demandé
+
+        usage = getattr(resp, "usage_metadata", None)
+        return LLMResponse(
+            text="".join(texts),
+            function_calls=function_calls,
+            model=request.model,
+            prompt_tokens=getattr(usage, "prompt_token_count", 0) or 0,
+            output_tokens=getattr(usage, "candidates_token_count", 0) or 0,
+            cached_tokens=getattr(usage, "cached_content_token_count", 0) or 0,
+            latency=latency,
+        )
+
+
+def _is_missing_cache_error(exc: Exception) -> bool:
+    return type(exc).__name__ in {"NotFound", "PermissionDenied"} or "cachedcontent" in str(exc).lower()
+
+
+def _prepend_context(parts, context: Optional[str]):
+    if not context:
+        return parts
+    parts = list(parts) if isinstance(parts, list) else [parts]
+    # Historique structuré (role/parts) : le contexte devient un tour utilisateur
+    if parts and isinstance(parts[0], dict) and "role" in parts[0]:
+        return [{"role": "user", "parts": [context]}, *parts]
+    return [context, *parts]
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Fake local
+# ──────────────────────────────────────────────────────────────────────────────
+DEFAULT_FAKE_MEDICAMENTS = [
+    {"nom": "PARACETAMOL", "dose": "1000 mg cp", "frequence": "1 comprimé 3 fois par jour pendant 5 jours"},
+    {"nom": "IBUPROFENE", "dose": "400 mg", "frequence": "1 comprimé le midi pendant 3 jours"},
+]
+
+CALENDAR_INTENT = re.compile(r"\b(rendez[- ]vous|rdv|rappel|agenda|calendrier)\b", re.IGNORECASE)
+
+
+class FakeBackend(LLMBackend):
+    """
+    Backend déterministe. Les règles scriptées (fichier JSON, clé "rules")
+    sont évaluées dans l'ordre ; chaque règle peut contenir :
+      - "match"  : regex testée sur le dernier texte utilisateur
+      - "when"   : "image" | "tools" | "tool_result" (condition supplémentaire)
+      - "text", "function_calls" [{"name", "args"}], "medicaments" [...]
+    À défaut, des réponses par défaut couvrent image, outils et texte.
+    """
+    name = "fake"
+
+    def __init__(
+        self,
+        rules: Optional[List[dict]] = None,
+        latency_ms: float = 0.0,
+        tokens_per_sec: float = 0.0,
+        jitter_ms: float = 0.0,
+        seed: int = 0,
+        context_cache: bool = False,
+    ):
+        self.rules = rules or []
+        self.context_cache = context_cache
+        self.latency_ms = latency_ms
+        self.tokens_per_sec = tokens_per_sec
+        self.jitter_ms = jitter_ms
+        self._rng = random.Random(seed)
+
+    @classmethod
+    def from_env(cls) -> "FakeBackend":
+        rules: List[dict] = []
+        script_path = os.getenv("LLM_FAKE_SCRIPT")
+        if script_path:
+            with open(script_path, encoding="utf-8") as f:
+                rules = json.load(f).get("rules", [])
+        return cls(
+            rules=rules,
+            latency_ms=float(os.getenv("LLM_FAKE_LATENCY_MS", "0")),
+            tokens_per_sec=float(os.getenv("LLM_FAKE_TOKENS_PER_SEC", "0")),
+            jitter_ms=float(os.getenv("LLM_FAKE_JITTER_MS", "0")),
+            seed=int(os.getenv("LLM_FAKE_SEED", "0")),
+            context_cache=_as_bool(os.getenv("GEMINI_CONTEXT_CACHE")),
+        )
+
+    async def generate(self, request: LLMRequest) -> LLMResponse:
+        t0 = time.perf_counter()
+        parts = list(iter_parts(request.parts))
+        has_image = any(_is_image(p) for p in parts)
+        has_tool_result = any(isinstance(p, dict) and "function_response" in p for p in parts)
+        last_text = next((p for p in reversed(parts) if isinstance(p, str) and p.strip()), "")
+
+        text, function_calls = self._answer(request, last_text, has_image, has_tool_result)
+
+        output_tokens = estimate_tokens(text) + sum(estimate_tokens(json.dumps(fc.args)) for fc in function_calls)
+        delay = self.latency_ms / 1000.0
+        if self.jitter_ms:
+            delay += self._rng.uniform(0, self.jitter_ms) / 1000.0
+        if self.tokens_per_sec:
+            delay += output_tokens / self.tokens_per_sec
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        return LLMResponse(
+            text=text,
+            function_calls=function_calls,
+            model=request.model,
+            prompt_tokens=estimate_prompt_tokens(request),
+            output_tokens=output_tokens,
+            # Simule la part de l'instruction statique servie depuis le cache
+            cached_tokens=estimate_tokens(request.system_instruction or "") if self.context_cache else 0,
+            latency=time.perf_counter() - t0,
+        )
+
+    def _answer(self, request: LLMRequest, last_text: str, has_image: bool, has_tool_result: bool):
+        json_mode = request.generation_config.get("response_mime_type") == "application/json"
+        conditions = {"image": has_image, "tools": bool(request.tools), "tool_result": has_tool_result}
+        for rule in self.rules:
+            when = rule.get("when")
+            if when and not conditions.get(when):
+                continue
+            if rule.get("match") and not re.search(rule["match"], last_text, re.IGNORECASE):
+                continue
+            # Pas de nouveau tool-call une fois les résultats d'outils reçus
+            if rule.get("function_calls") and has_tool_result:
+                continue
+            text = rule.get("text", "")
+            if rule.get("medicaments") is not None:
+                text = self._medication_block(rule["medicaments"], text or None, json_mode)
+            calls = [FunctionCall(name=fc["name"], args=fc.get("args", {})) for fc in rule.get("function_calls", [])]
+            return text, calls
+
+        if has_tool_result:
+            return "C'est noté, j'ai mis à jour votre calendrier.", []
+        if request.tools and CALENDAR_INTENT.search(last_text):
+            start = (datetime.now() + timedelta(days=1)).replace(hour=10, minute=0, second=0, microsecond=0)
+            args = {
+                "title": "Rendez-vous médical",
+                "start_dt": start.isoformat(),
+                "end_dt": (start + timedelta(hours=1)).isoformat(),
+                "timezone": "Europe/Paris",
+            }
+            return "", [FunctionCall(name="addEvent", args=args)]
+        if has_image or json_mode:
+            return self._medication_block(DEFAULT_FAKE_MEDICAMENTS if has_image else [], None, json_mode), []
+        return f"Bonjour, je suis Sorrel (réponse simulée). Vous avez écrit : {last_text}", []
+
+    @staticmethod
+    def _medication_block(medicaments: List[dict], reponse: Optional[str] = None, json_mode: bool = False) -> str:
+        payload = {
+            "reponse_textuelle": reponse or "J'ai bien analysé votre ordonnance. Voici les médicaments que j'ai identifiés :",
+            "medicaments": medicaments,
+        }
+        if json_mode:
+            # Sortie structurée : JSON brut, sans bloc markdown
+            return json.dumps(payload, ensure_ascii=False)
+        return "```json\n" + json.dumps(payload, ensure_ascii=False, indent=2) + "\n```"
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Sélection du backend
+# ──────────────────────────────────────────────────────────────────────────────
+_backend: Optional[LLMBackend] = None
+_backend_lock = threading.Lock()
+
+
+def _create_backend(name: str) -> LLMBackend:
+    if name == "fake":
+        return FakeBackend.from_env()
+    if name == "gemini":
+        return GeminiBackend()
+    if name == "replay":
+        from services.cassette import ReplayBackend
+        return ReplayBackend.from_env()
+    raise ValueError(f"LLM_BACKEND inconnu : {name}")
+
+
+def get_backend() -> LLMBackend:
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                name = os.getenv("LLM_BACKEND", "gemini").strip().lower()
+                backend = _create_backend(name)
+                from services.cassette import RecordingBackend, get_recorder
+                writer = get_recorder()
+                if writer is not None:
+                    backend = RecordingBackend(backend, writer)
+                _backend = backend
+                logger.info(f"Backend LLM : {_backend.name}")
+    return _backend
+
+
+def set_backend(backend: LLMBackend) -> None:
+    """Remplace le backend courant (benchmarks, replay)."""
+    global _backend
+    with _backend_lock:
+        _backend = backend
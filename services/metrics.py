@@ -0,0 +1,183 @@
+"""
+Registre de métriques en mémoire (compteurs, jauges, histogrammes étiquetés),
+exposé en JSON sur GET /metrics.
+
+    from services import metrics
+    metrics.counter("llm_calls_total").inc(route="light")
+    metrics.histogram("llm_latency_seconds").observe(0.42, model="gemini-2.5-flash")
+"""
+import threading
+from collections import deque
+from typing import Callable, Dict, Optional, Tuple
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+# Nombre d'observations conservées par série pour le calcul des quantiles
+RESERVOIR_SIZE = 1024
+
+
+def _key(labels: dict) -> LabelKey:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+class _Metric:
+    kind = "metric"
+
+    def __init__(self, name: str, description: str = ""):
+        self.name = name
+        self.description = description
+        self._lock = threading.Lock()
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, description: str = ""):
+        super().__init__(name, description)
+        self._values: Dict[LabelKey, float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = _key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(_key(labels), 0)
+
+    def snapshot(self):
+        with self._lock:
+            return [{"labels": dict(k), "value": v} for k, v in self._values.items()]
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, description: str = ""):
+        super().__init__(name, description)
+        self._values: Dict[LabelKey, float] = {}
+        self._functions: Dict[LabelKey, Callable[[], float]] = {}
+
+    def set(self, value: float, **labels) -> None:
+        with self._lock:
+            self._values[_key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = _key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels) -> None:
+        self.inc(-amount, **labels)
+
+    def set_function(self, fn: Callable[[], float], **labels) -> None:
+        """Valeur calculée à la lecture (ex: profondeur d'une file)."""
+        with self._lock:
+            self._functions[_key(labels)] = fn
+
+    def value(self, **labels) -> float:
+        key = _key(labels)
+        with self._lock:
+            fn = self._functions.get(key)
+            if fn is None:
+                return self._values.get(key, 0)
+        return fn()
+
+    def snapshot(self):
+        with self._lock:
+            values = dict(self._values)
+            functions = dict(self._functions)
+        for key, fn in functions.items():
+            try:
+                values[key] = fn()
+            except Exception:
+                values[key] = None
+        return [{"labels": dict(k), "value": v} for k, v in values.items()]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, description: str = ""):
+        super().__init__(name, description)
+        self._series: Dict[LabelKey, dict] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = _key(labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = {"count": 0, "sum": 0.0, "samples": deque(maxlen=RESERVOIR_SIZE)}
+            series["count"] += 1
+            series["sum"] += value
+            series["samples"].append(value)
+
+    def quantile(self, q: float, **labels) -> Optional[float]:
+        with self._lock:
+            series = self._series.get(_key(labels))
+            samples = sorted(series["samples"]) if series else []
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+    def count(self, **labels) -> int:
+        with self._lock:
+            series = self._series.get(_key(labels))
+            return series["count"] if series else 0
+
+    def snapshot(self):
+        with self._lock:
+            items = [(k, s["count"], s["sum"], sorted(s["samples"])) for k, s in self._series.items()]
+        out = []
+        for key, count, total, samples in items:
+            def q(p):
+                return samples[min(len(samples) - 1, int(p * len(samples)))] if samples else None
+            out.append({
+                "labels": dict(key),
+                "count": count,
+                "sum": total,
+                "p50": q(0.50),
+                "p95": q(0.95),
+                "p99": q(0.99),
+            })
+        return out
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics: Dict[str, _Metric] = {}
+
+    def _get_or_create(self, cls, name: str, description: str):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, description)
+            elif not isinstance(metric, cls):
+                raise TypeError(f"La métrique {name} existe déjà avec le type {metric.kind}")
+            return metric
+
+    def counter(self, name: str, description: str = "") -> Counter:
+        return self._get_or_create(Counter, name, description)
+
+    def gauge(self, name: str, description: str = "") -> Gauge:
+        return self._get_or_create(Gauge, name, description)
+
+    def histogram(self, name: str, description: str = "") -> Histogram:
+        return self._get_or_create(Histogram, name, description)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return {
+            m.name: {"type": m.kind, "description": m.description, "values": m.snapshot()}
+            for m in sorted(metrics, key=lambda m: m.name)
+        }
+
+
+REGISTRY = MetricsRegistry()
+
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
+snapshot = REGISTRY.snapshot
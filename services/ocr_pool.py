@@ -0,0 +1,376 @@
+"""
+Pool de processus OCR pour les scans d'ordonnance.
+
+- Chaque processus garde un moteur tesseract chargé : tesserocr (API C,
+  modèle « fra » initialisé une seule fois) s'il est installé, sinon pytesseract.
+- File bornée : au-delà de OCR_QUEUE_SIZE jobs en attente ou en cours,
+  submit lève OCRQueueFull (→ 503) au lieu d'empiler indéfiniment.
+- Prétraitement de l'image dans le worker (services/ocr_preprocess.py,
+  désactivable avec OCR_PREPROCESS=0).
+- Délai par job (OCR_JOB_TIMEOUT_SECONDS), compté à partir de la prise en
+  charge par un worker (heure de début publiée en mémoire partagée) :
+  pytesseract tue son sous-processus ; avec tesserocr, un job réellement bloqué
+  fait recycler le pool. L'attente en file a sa propre limite
+  (OCR_QUEUE_TIMEOUT_SECONDS) : au-delà, seule la requête concernée échoue
+  (OCRQueueFull), sans toucher aux jobs des autres.
+- PDF : chaque page est un job ; le worker ouvre le fichier (chemin, pas
+  d'octets copiés), rend la seule page demandée avec pypdfium2 et l'OCRise.
+  Si la page a déjà une couche texte (PDF numérique), elle est lue sans OCR.
+- Profondeur de file, attente et durée des jobs exposées dans services.metrics.
+
+    text = await get_ocr_pool().ocr("/tmp/ordo.jpg")  # ou des octets
+    text = await get_ocr_pool().ocr_pdf_page("/tmp/ordo.pdf", 0)
+"""
+import asyncio
+import itertools
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple, Union
+
+from services import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class OCRUnavailable(Exception):
+    """Aucun moteur OCR installé, ou le pool est hors service."""
+
+
+class OCRQueueFull(OCRUnavailable):
+    """File OCR pleine : le scan est refusé plutôt que mis en attente."""
+
+
+class OCRTimeout(OCRUnavailable):
+    pass
+
+
+@dataclass
+class OCRResult:
+    text: str
+    confidence: float  # moyenne des mots, 0-100
+    engine: str
+
+
+class _StartBoard:
+    """
+    Job en cours et heure de début de chaque worker, en mémoire partagée : le
+    serveur ne compte le délai d'exécution qu'à partir de la prise en charge.
+    """
+
+    def __init__(self, ctx, workers: int):
+        self.jobs = ctx.RawArray("q", workers)
+        self.times = ctx.RawArray("d", workers)
+        self.next_slot = ctx.Value("i", 0)
+
+    def started_at(self, job_id: int) -> Optional[float]:
+        for i in range(len(self.jobs)):
+            if self.jobs[i] == job_id:
+                return self.times[i]
+        return None
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Côté processus worker
+# ──────────────────────────────────────────────────────────────────────────────
+_engine = None
+_board: Optional[_StartBoard] = None
+_slot = 0
+
+
+class _TesserocrEngine:
+    name = "tesserocr"
+
+    def __init__(self, lang: str):
+        import tesserocr
+        self._api = tesserocr.PyTessBaseAPI(lang=lang)
+
+    def recognize(self, img, timeout: float) -> Tuple[str, float]:
+        self._api.SetImage(img)
+        return self._api.GetUTF8Text(), float(self._api.MeanTextConf())
+
+
+class _PytesseractEngine:
+    name = "pytesseract"
+
+    def __init__(self, lang: str):
+        import pytesseract
+        self._pytesseract = pytesseract
+        self._lang = lang
+        pytesseract.get_tesseract_version()  # échoue tôt si le binaire est absent
+
+    def recognize(self, img, timeout: float) -> Tuple[str, float]:
+        """
+        Un seul passage tesseract (image_to_data) : le texte est reconstruit
+        ligne par ligne à partir des mots, la confiance est leur moyenne.
+        """
+        data = self._pytesseract.image_to_data(
+            img, lang=self._lang, timeout=timeout, output_type=self._pytesseract.Output.DICT
+        )
+        lines: Dict[tuple, List[str]] = {}
+        confidences = []
+        for i, word in enumerate(data["text"]):
+            conf = float(data["conf"][i])
+            if conf < 0 or not word.strip():
+                continue
+            lines.setdefault((data["block_num"][i], data["par_num"][i], data["line_num"][i]), []).append(word)
+            confidences.append(conf)
+        text = "\n".join(" ".join(words) for words in lines.values())
+        return text, (sum(confidences) / len(confidences) if confidences else 0.0)
+
+
+def _init_worker(lang: str, board: Optional[_StartBoard] = None) -> None:
+    global _engine, _board, _slot
+    if board is not None:
+        with board.next_slot.get_lock():
+            _slot = board.next_slot.value
+            board.next_slot.value += 1
+        _board = board if _slot < len(board.jobs) else None
+    for engine_cls in (_TesserocrEngine, _PytesseractEngine):
+        try:
+            _engine = engine_cls(lang)
+            return
+        except Exception:
+            continue
+    _engine = None
+
+
+def _mark_started(job_id: int) -> None:
+    if _board is not None:
+        # L'heure d'abord : qui lit l'id du job lit une heure à jour
+        _board.times[_slot] = time.time()
+        _board.jobs[_slot] = job_id
+
+
+def _recognize(img, timeout: float, preprocess: bool) -> Tuple[str, float]:
+    if _engine is None:
+        raise OCRUnavailable("Aucun moteur OCR disponible (tesserocr / pytesseract)")
+    if preprocess:
+        from services.ocr_preprocess import preprocess_for_ocr
+        img = preprocess_for_ocr(img)
+    else:
+        img.load()
+    return _engine.recognize(img, timeout)
+
+
+def _ocr_job(image: Union[bytes, str], timeout: float, submitted_at: float, preprocess: bool = True, job_id: int = 0):
+    """
+    Exécuté dans le worker : (texte, confiance 0-100, attente en file, durée OCR, moteur).
+    `image` est un chemin (rien n'est copié entre processus) ou des octets.
+    """
+    _mark_started(job_id)
+    started = time.time()
+    from io import BytesIO
+    from PIL import Image
+
+    with Image.open(image if isinstance(image, str) else BytesIO(image)) as img:
+        text, confidence = _recognize(img, timeout, preprocess)
+    return text, confidence, started - submitted_at, time.time() - started, _engine.name
+
+
+def _pdf_page_job(path: str, page_index: int, dpi: int, min_text_chars: int,
+                  timeout: float, submitted_at: float, preprocess: bool = True, job_id: int = 0):
+    """Rend une seule page du PDF (mémoire bornée à une page par worker) puis l'OCRise."""
+    _mark_started(job_id)
+    started = time.time()
+    import pypdfium2 as pdfium
+
+    pdf = pdfium.PdfDocument(path)
+    try:
+        page = pdf[page_index]
+        try:
+            textpage = page.get_textpage()
+            text = textpage.get_text_range()
+            textpage.close()
+            if len(text.strip()) >= min_text_chars:
+                return text, 100.0, started - submitted_at, time.time() - started, "pdf-text"
+            img = page.render(scale=dpi / 72, grayscale=True).to_pil()
+        finally:
+            page.close()
+    finally:
+        pdf.close()
+    text, confidence = _recognize(img, timeout, preprocess)
+    return text, confidence, started - submitted_at, time.time() - started, _engine.name
+
+
+def pdf_page_count(path: str) -> int:
+    try:
+        import pypdfium2 as pdfium
+    except ImportError as e:
+        raise OCRUnavailable("pypdfium2 non installé : PDF non pris en charge") from e
+    pdf = pdfium.PdfDocument(path)
+    try:
+        return len(pdf)
+    finally:
+        pdf.close()
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Côté serveur
+# ──────────────────────────────────────────────────────────────────────────────
+_depth = metrics.gauge("ocr_queue_depth", "Jobs OCR en attente ou en cours")
+_jobs = metrics.counter("ocr_jobs_total", "Jobs OCR par issue (ok, timeout, queue_timeout, rejected, error)")
+_queue_wait = metrics.histogram("ocr_queue_wait_seconds", "Attente d'un job avant prise en charge")
+_duration = metrics.histogram("ocr_job_seconds", "Durée de l'OCR dans le worker")
+
+
+class OCRPool:
+    def __init__(self, workers: int = None, queue_size: int = None, timeout: float = None, lang: str = None):
+        self.workers = workers or int(os.getenv("OCR_WORKERS", max(1, min(4, (os.cpu_count() or 2) - 1))))
+        self.queue_size = queue_size or int(os.getenv("OCR_QUEUE_SIZE", self.workers * 4))
+        self.timeout = timeout or float(os.getenv("OCR_JOB_TIMEOUT_SECONDS", "30"))
+        self.queue_timeout = float(os.getenv("OCR_QUEUE_TIMEOUT_SECONDS", self.timeout * 2))
+        self.lang = lang or os.getenv("OCR_LANG", "fra")
+        self.preprocess = os.getenv("OCR_PREPROCESS", "1").strip().lower() in {"1", "true", "yes", "on"}
+        # En dessous, la couche texte d'une page PDF est jugée vide (scan) et la page est OCRisée
+        self.pdf_min_text_chars = int(os.getenv("OCR_PDF_MIN_TEXT_CHARS", "20"))
+        self._lock = threading.Lock()
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._board: Optional[_StartBoard] = None
+        self._job_ids = itertools.count(1)
+        self._in_queue = 0
+        _depth.set_function(lambda: self._in_queue)
+
+    def _get_executor(self) -> Tuple[ProcessPoolExecutor, _StartBoard]:
+        with self._lock:
+            if self._executor is None:
+                # spawn : le serveur a déjà des threads (FastAPI, quotas), fork serait risqué
+                ctx = multiprocessing.get_context(os.getenv("OCR_START_METHOD", "spawn"))
+                self._board = _StartBoard(ctx, self.workers)
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=ctx, initializer=_init_worker,
+                    initargs=(self.lang, self._board),
+                )
+                logger.info(f"Pool OCR démarré : {self.workers} worker(s), file de {self.queue_size}")
+            return self._executor, self._board
+
+    def _recycle(self, executor: ProcessPoolExecutor) -> None:
+        """Remplace un pool dont un worker est bloqué ou mort."""
+        with self._lock:
+            if self._executor is not executor:
+                return
+            self._executor = None
+            self._board = None
+        # Les workers bloqués dans tesseract ne rendent pas la main : on les termine
+        for proc in list(getattr(executor, "_processes", {}).values()):
+            proc.terminate()
+        executor.shutdown(wait=False, cancel_futures=True)
+        logger.warning("Pool OCR recyclé")
+
+    async def ocr(self, image: Union[bytes, str]) -> str:
+        """`image` : chemin d'un fichier (préféré, le worker le lit lui-même) ou octets."""
+        return (await self.recognize(image)).text
+
+    async def recognize(self, image: Union[bytes, str]) -> OCRResult:
+        """Comme ocr(), avec la confiance moyenne des mots et le moteur utilisé."""
+        return await self._run(_ocr_job, os.fspath(image) if isinstance(image, os.PathLike) else image,
+                               self.timeout, time.time(), self.preprocess)
+
+    async def ocr_pdf_page(self, path: str, page_index: int) -> str:
+        """OCR d'une page (0-indexée) d'un PDF présent sur disque."""
+        return (await self.recognize_pdf_page(path, page_index)).text
+
+    async def recognize_pdf_page(self, path: str, page_index: int) -> OCRResult:
+        from services.ocr_preprocess import default_target_dpi
+        return await self._run(
+            _pdf_page_job, path, page_index, default_target_dpi(), self.pdf_min_text_chars,
+            self.timeout, time.time(), self.preprocess,
+        )
+
+    async def _run(self, job, *args) -> OCRResult:
+        with self._lock:
+            if self._in_queue >= self.queue_size:
+                _jobs.inc(outcome="rejected")
+                raise OCRQueueFull(f"File OCR pleine ({self._in_queue}/{self.queue_size})")
+            self._in_queue += 1
+        try:
+            executor, board = self._get_executor()
+            job_id = next(self._job_ids)
+            future = executor.submit(job, *args, job_id)
+            try:
+                text, confidence, waited, duration, engine = await self._wait(executor, board, future, job_id)
+            except BrokenProcessPool as e:
+                _jobs.inc(outcome="error")
+                self._recycle(executor)
+                raise OCRUnavailable("Pool OCR interrompu") from e
+            except RuntimeError as e:
+                # pytesseract lève RuntimeError("Tesseract process timeout")
+                if "timeout" not in str(e).lower():
+                    _jobs.inc(outcome="error")
+                    raise
+                _jobs.inc(outcome="timeout")
+                raise OCRTimeout(str(e)) from e
+            except Exception:
+                _jobs.inc(outcome="error")
+                raise
+        finally:
+            with self._lock:
+                self._in_queue -= 1
+
+        _jobs.inc(outcome="ok", engine=engine)
+        _queue_wait.observe(waited)
+        _duration.observe(duration, engine=engine)
+        return OCRResult(text, confidence, engine)
+
+    async def _wait(self, executor: ProcessPoolExecutor, board: _StartBoard, future, job_id: int):
+        """
+        Attend le résultat du job. Avant sa prise en charge, seule l'attente en
+        file est limitée (OCR_QUEUE_TIMEOUT_SECONDS, échec de cette requête
+        seulement) ; ensuite, son exécution (timeout x2, marge pour pytesseract),
+        au-delà de laquelle le worker est jugé bloqué et le pool recyclé.
+        """
+        waiter = asyncio.wrap_future(future)
+        queue_deadline = time.time() + self.queue_timeout
+        while True:
+            started = board.started_at(job_id)
+            now = time.time()
+            if started is None:
+                if now >= queue_deadline and future.cancel():
+                    waiter.cancel()
+                    _jobs.inc(outcome="queue_timeout")
+                    raise OCRQueueFull(f"Attente OCR trop longue (> {self.queue_timeout:g}s)")
+                # Déjà transmis à un worker (annulation impossible) : on attend son début
+                remaining = max(queue_deadline - now, 0.05)
+            else:
+                remaining = started + self.timeout * 2 - now
+                if remaining <= 0:
+                    waiter.cancel()
+                    _jobs.inc(outcome="timeout")
+                    self._recycle(executor)
+                    raise OCRTimeout(f"OCR trop long (> {self.timeout * 2:g}s)")
+            # Réveil régulier pour voir le début du job, publié par le worker
+            try:
+                done, _ = await asyncio.wait({waiter}, timeout=min(remaining, 0.25))
+            except asyncio.CancelledError:
+                waiter.cancel()  # annule aussi le job s'il est encore en file
+                raise
+            if done:
+                break
+        if waiter.cancelled():
+            # Pool recyclé à cause du job bloqué d'une autre requête
+            raise OCRUnavailable("Pool OCR recyclé")
+        return waiter.result()
+
+    def shutdown(self) -> None:
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+_pool: Optional[OCRPool] = None
+_pool_lock = threading.Lock()
+
+
+def get_ocr_pool() -> OCRPool:
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = OCRPool()
+    return _pool
@@ -0,0 +1,144 @@
+"""
+Prétraitement des photos d'ordonnance avant OCR.
+
+Étapes (toutes vectorisées NumPy / PIL) :
+1. orientation EXIF,
+2. niveaux de gris,
+3. réduction à une résolution adaptée à tesseract (OCR_TARGET_DPI, ~300 dpi
+   pour une page A4),
+4. redressement (deskew) : l'angle maximise la variance du profil de
+   projection horizontal des pixels sombres,
+5. seuillage adaptatif (méthode de Bradley, moyenne locale par flou de boîte),
+6. recadrage optionnel sur la zone de texte (OCR_CROP=1).
+
+Sans NumPy, seules les étapes 1 à 3 sont appliquées.
+
+    img = preprocess_for_ocr(Image.open(path))
+"""
+import os
+from typing import Optional, Tuple
+
+from PIL import Image, ImageFilter, ImageOps
+
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except Exception:
+    NUMPY_AVAILABLE = False
+
+# Page A4 en pouces (grand côté)
+A4_LONG_SIDE_INCHES = 11.69
+DESKEW_MAX_ANGLE = 10.0
+DESKEW_STEP = 0.5
+# Côté maximal de l'image réduite utilisée pour estimer l'angle
+DESKEW_SAMPLE_SIDE = 800
+
+
+def _as_bool(val: Optional[str], default: bool = False) -> bool:
+    if val is None:
+        return default
+    return val.strip().lower() in {"1", "true", "yes", "y", "on"}
+
+
+def default_target_dpi() -> int:
+    return int(os.getenv("OCR_TARGET_DPI", "300"))
+
+
+def downscale_to_dpi(img: Image.Image, target_dpi: int) -> Image.Image:
+    """
+    Réduit l'image si elle dépasse la résolution cible. Le DPI EXIF des photos
+    de téléphone étant rarement fiable, on suppose une page A4 cadrée.
+    """
+    max_side = int(A4_LONG_SIDE_INCHES * target_dpi)
+    long_side = max(img.size)
+    if long_side <= max_side:
+        return img
+    scale = max_side / long_side
+    size = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+    # reducing_gap : réduction entière rapide avant le rééchantillonnage fin ;
+    # le bilinéaire suffit pour du texte à 300 dpi
+    return img.resize(size, Image.Resampling.BILINEAR, reducing_gap=2.0)
+
+
+def adaptive_threshold(img: Image.Image, window: int = None, t: float = 0.15) -> "np.ndarray":
+    """
+    Binarisation de Bradley : un pixel est de l'encre s'il est plus sombre que
+    (1 - t) × la moyenne de son voisinage. La moyenne locale est un flou de
+    boîte PIL (en C, mémoire constante) ; la comparaison est vectorisée.
+    Retourne un tableau booléen, True = fond.
+    """
+    window = window or max(15, max(img.size) // 32)
+    local_mean = np.asarray(img.filter(ImageFilter.BoxBlur(window // 2)), dtype=np.uint16)
+    # Comparaison entière (255 × 100 tient dans un uint16)
+    return np.asarray(img, dtype=np.uint16) * 100 >= local_mean * int(round((1 - t) * 100))
+
+
+def estimate_skew(img: Image.Image, max_angle: float = DESKEW_MAX_ANGLE, step: float = DESKEW_STEP) -> float:
+    """
+    Rotation (degrés, sens PIL) qui remet les lignes de texte à l'horizontale.
+    Sur une version réduite, les pixels d'encre (seuil local, pour ignorer les
+    grands aplats sombres comme le fond autour de la feuille) sont projetés sur
+    l'axe vertical pour chaque angle candidat ; on garde l'angle dont
+    l'histogramme est le plus « piqué » (somme des carrés maximale).
+    """
+    factor = max(1, max(img.size) // DESKEW_SAMPLE_SIDE)
+    small = img.reduce(factor) if factor > 1 else img
+    ys, xs = np.nonzero(~adaptive_threshold(small, t=0.25))
+    if ys.size < 50:
+        return 0.0
+    if ys.size > 50_000:
+        idx = np.random.default_rng(0).choice(ys.size, 50_000, replace=False)
+        ys, xs = ys[idx], xs[idx]
+
+    angles = np.arange(-max_angle, max_angle + step / 2, step)
+    rad = np.deg2rad(angles)[:, None]
+    # Ordonnée de chaque pixel après rotation PIL de `angle` (matrice angles × pixels)
+    rows = np.rint(ys[None, :] * np.cos(rad) - xs[None, :] * np.sin(rad)).astype(np.int64)
+    rows -= rows.min(axis=1, keepdims=True)
+    n_bins = int(rows.max()) + 1
+    offsets = (np.arange(len(angles)) * n_bins)[:, None]
+    hist = np.bincount((rows + offsets).ravel(), minlength=len(angles) * n_bins).reshape(len(angles), n_bins)
+    scores = (hist.astype(np.float64) ** 2).sum(axis=1)
+    return float(angles[int(scores.argmax())])
+
+
+def text_bbox(binary: "np.ndarray", margin: int = 20, min_fraction: float = 0.005) -> Optional[Tuple[int, int, int, int]]:
+    """Boîte englobante des lignes / colonnes contenant de l'encre (True = fond)."""
+    ink = ~binary
+    rows = np.flatnonzero(ink.mean(axis=1) > min_fraction)
+    cols = np.flatnonzero(ink.mean(axis=0) > min_fraction)
+    if rows.size == 0 or cols.size == 0:
+        return None
+    h, w = binary.shape
+    return (
+        max(int(cols[0]) - margin, 0), max(int(rows[0]) - margin, 0),
+        min(int(cols[-1]) + margin + 1, w), min(int(rows[-1]) + margin + 1, h),
+    )
+
+
+def preprocess_for_ocr(img: Image.Image, target_dpi: int = None, crop: bool = None) -> Image.Image:
+    target_dpi = target_dpi or default_target_dpi()
+    crop = _as_bool(os.getenv("OCR_CROP"), default=False) if crop is None else crop
+
+    if img.format == "JPEG":
+        # Décodage JPEG directement en gris et à l'échelle 1/2, 1/4… la plus proche
+        max_side = int(A4_LONG_SIDE_INCHES * target_dpi)
+        img.draft("L", (max_side, max_side))
+    img = ImageOps.exif_transpose(img) or img
+    img = img.convert("L")
+    img = downscale_to_dpi(img, target_dpi)
+    if not NUMPY_AVAILABLE:
+        return ImageOps.autocontrast(img)
+
+    # estimate_skew renvoie directement la rotation qui remet les lignes à l'horizontale
+    angle = estimate_skew(img)
+    if abs(angle) >= DESKEW_STEP:
+        img = img.rotate(angle, resample=Image.Resampling.BILINEAR, expand=True, fillcolor=255)
+
+    binary = adaptive_threshold(img)
+    if crop:
+        box = text_bbox(binary)
+        if box is not None:
+            x0, y0, x1, y1 = box
+            binary = binary[y0:y1, x0:x1]
+    return Image.fromarray((binary * 255).astype(np.uint8), mode="L")
@@ -1,7 +1,12 @@
-from typing import List, Dict, Optional
+from typing import AsyncIterator, Dict, Iterable, List, Optional, Union
 from dataclasses import dataclass
+import asyncio
+import logging
+import os
 import re
 
+from services.drug_index import get_drug_index
+
 try:
     from PIL import Image
     import pytesseract
@@ -13,60 +18,122 @@ except Exception:
 class MedItem:
     nom: str
     frequence: str  # ex: "1/jour", "2/jour", "1/semaine"
+    dose: Optional[str] = None  # ex: "500 mg", "1 cp", "5 ml"
+    duree: Optional[str] = None  # ex: "7 jours", "3 mois"
+
+# Une seule alternative compilée, appliquée en un passage (finditer) sur tout le
+# texte : la branche "eol" délimite les lignes, les autres produisent les jetons.
+# Les branches numériques partagent le même préfixe (un nombre) puis se
+# distinguent par le suffixe : une fréquence exige un séparateur (/, par, x,
+# fois), une dose une unité, et une unité de temps seule est une durée.
+# Le texte est mis en minuscules une fois (pas de re.IGNORECASE, coûteux) et le
+# lookahead initial écarte sans backtracking les positions qui ne peuvent
+# démarrer aucun jeton.
+_UNIT = r"(?:jours?|j|24\s*h|semaines?|sem|mois)"
+_FORM = r"(?:cp|comprim[ée]s?|g[ée]lules?|gél|ampoules?|sachets?|gouttes?|prises?|doses?|bouff[ée]es?)"
+MED_TOKEN_RE = re.compile(
+    rf"""
+    (?=[\d\n]|\b[tmqlcah])
+    (?:
+      (?P<eol>\n)
+    | (?P<num>(?<!\w)\d{{1,3}}(?:[ \u202f]\d{{3}})+|\d+(?:[.,]\d+)?)\s*
+      (?:
+          (?:{_FORM}\s*)?(?:x|fois)?\s*(?:/|par|x)\s*(?P<freq_unit>{_UNIT})\b
+        | (?P<times>x|fois)\s+(?:dans\s+la\s+journ[ée]e|quotidiennement)
+        | (?P<dose_unit>mg|µg|mcg|g|ml|ui|{_FORM})(?![a-zà-ÿ])
+        | (?P<dur_unit>{_UNIT})\b
+      )
+    | toutes\s+les\s+(?P<every_h>\d+)\s*h(?:eures?)?\b
+    | (?P<three_daily>matin\W+midi\W+(?:et\s+)?soir)
+    | (?P<two_daily>matin\s+et\s+soir)
+    | (?P<daily>quotidien(?:ne)?(?:ment)?|chaque\s+jour|le\s+matin|le\s+soir|au\s+coucher)
+    | (?P<weekly>hebdomadaire|chaque\s+semaine)
+    )
+    """,
+    re.VERBOSE,
+)
+_LEADING_NUMBER_RE = re.compile(r"^\s*(?:\d+[.)-]|[-•*])\s*")
+_NAME_STRIP = " -•:,;\t\r?!"
+
+_TIME_UNITS = {"j": "jour", "jours": "jour", "24h": "jour", "sem": "semaine", "semaines": "semaine"}
+_DOSE_UNITS = {"comprime": "cp", "comprimes": "cp", "comprimé": "cp", "comprimés": "cp", "mcg": "µg",
+               "gelule": "gélule", "gelules": "gélule", "gélules": "gélule", "gél": "gélule", "sachets": "sachet",
+               "ampoules": "ampoule", "gouttes": "goutte", "prises": "prise", "doses": "dose",
+               "bouffee": "bouffée", "bouffees": "bouffée", "bouffées": "bouffée", "ui": "UI"}
+_FIXED_FREQ = {"three_daily": "3/jour", "two_daily": "2/jour", "daily": "1/jour", "weekly": "1/semaine"}
+
+def _unit(raw: str, table: dict) -> str:
+    raw = "".join(raw.split())
+    return table.get(raw, raw)
 
-FREQ_PATTERNS = [
-    (r"\b(\d+)\s*/\s*jour\b", "{}/jour"),
-    (r"\b(\d+)\s*/\s*semaine\b", "{}/semaine"),
-    (r"\b(\d+)\s*/\s*sem\b", "{}/semaine"),
-    (r"\b(\d+)\s*x\s*par\s*jour\b", "{}/jour"),
-    (r"\b(\d+)\s*fois\s*par\s*jour\b", "{}/jour"),
-    (r"\bquotidien(ne)?\b", "1/jour"),
-]
+def _count(raw: str) -> int:
+    return int(float(raw.replace(",", ".")))
 
 def _parse_meds_from_text(text: str) -> List[MedItem]:
     """
-    Extraction par regex : lignes du type
-    - "Paracétamol 1/jour"
+    Extraction par regex en un seul passage sur le texte :
+    - "Paracétamol 500 mg 1 cp 3 fois par jour pendant 5 jours"
     - "Ibuprofène 2/jour"
-    - "Amoxicilline 3 x par jour"
+    - "Amoxicilline 1 g" puis, ligne suivante, "1 cp matin et soir pendant 7 jours"
+    Une ligne sans fréquence reste en attente et se complète avec la posologie
+    de la ligne suivante si celle-ci ne commence pas par un nom.
     """
+    low = text.lower()
+    # lower() peut changer la longueur (rare) : les noms sont alors pris dans `low`
+    src = text if len(low) == len(text) else low
     meds: List[MedItem] = []
-    # découpe en lignes, on ignore les trop courtes
-    for raw in [l.strip() for l in text.splitlines() if len(l.strip()) > 2]:
-        # heuristique : nom = début de ligne jusqu’à fréquence
-        freq: Optional[str] = None
-        for pat, fmt in FREQ_PATTERNS:
-            m = re.search(pat, raw, flags=re.IGNORECASE)
-            if m:
-                if m.groups() and m.group(1) and "{}" in fmt:
-                    freq = fmt.format(m.group(1))
-                else:
-                    freq = fmt
-                break
-        if not freq:
-            # autre pattern type "1 / jour ?" 
-            m = re.search(r"(\d+)\s*/\s*jour", raw, flags=re.IGNORECASE)
-            if m:
-                freq = f"{m.group(1)}/jour"
-
-        # nom = texte avant la fréquence trouvée sinon la ligne entière
-        if freq:
-            # coupe la ligne au début du match
-            cut = re.split(r"(\d+\s*/\s*jour|\d+\s*/\s*semaine|\d+\s*x\s*par\s*jour|\d+\s*fois\s*par\s*jour|quotidien(ne)?)",
-                           raw, flags=re.IGNORECASE)[0].strip(" -•:\t")
-            nom = re.sub(r"^\d+[\.\)-]\s*", "", cut)  # supprime "1) " ou "1. " en début
-        else:
-            # si pas de fréquence détectée, on saute
-            continue
+    pending = None  # (nom, dose) d'une ligne sans posologie
+    line_start, name_end = 0, None
+    freq = dose = duree = None
 
-        # nettoyage nom (retire symboles trop communs)
-        nom = re.sub(r"[\?\!]+$", "", nom).strip()
-        if len(nom) < 2:
+    for m in MED_TOKEN_RE.finditer(low + "\n"):
+        kind = m.lastgroup
+        if kind == "eol":
+            pending = _finish_line(src[line_start:m.start()], name_end, freq, dose, duree, pending, meds)
+            line_start, name_end = m.end(), None
+            freq = dose = duree = None
             continue
-
-        meds.append(MedItem(nom=nom, frequence=freq))
+        if name_end is None:
+            name_end = m.start() - line_start
+        if kind == "dose_unit":
+            if dose is None:
+                dose = f"{''.join(m.group('num').split()).replace(',', '.')} {_unit(m.group('dose_unit'), _DOSE_UNITS)}"
+        elif kind == "dur_unit":
+            if duree is None:
+                n, unit = _count(m.group("num")), _unit(m.group("dur_unit"), _TIME_UNITS)
+                duree = f"{n} {unit}" + ("s" if n > 1 and unit != "mois" else "")
+        elif freq is not None:
+            continue
+        elif kind == "freq_unit":
+            freq = f"{_count(m.group('num'))}/{_unit(m.group('freq_unit'), _TIME_UNITS)}"
+        elif kind == "times":
+            freq = f"{_count(m.group('num'))}/jour"
+        elif kind == "every_h":
+            hours = int(m.group("every_h"))
+            if hours:
+                freq = f"{max(24 // hours, 1)}/jour"
+        else:
+            freq = _FIXED_FREQ[kind]
     return meds
 
+def _finish_line(line: str, name_end, freq, dose, duree, pending, meds: List[MedItem]):
+    """Clôt une ligne ; retourne le nouvel état `pending`."""
+    if len(line.strip()) <= 2:
+        return pending
+    raw_name = line[:name_end] if name_end is not None else line
+    nom = _LEADING_NUMBER_RE.sub("", raw_name).strip(_NAME_STRIP)
+    if len(nom) < 2 or not any(c.isalpha() for c in nom):
+        nom = None
+    if nom is None and pending is not None:
+        # le dosage écrit avec le nom (ex: "1 g") prime sur la forme ("1 cp")
+        nom, dose = pending[0], pending[1] or dose
+    if freq and nom:
+        meds.append(MedItem(nom=nom, frequence=freq, dose=dose, duree=duree))
+        return None
+    if nom:
+        return (nom, dose)
+    return None
+
 def extract_text_from_image(image_bytes: bytes) -> str:
     if not OCR_AVAILABLE:
         return ""
@@ -75,20 +142,112 @@ def extract_text_from_image(image_bytes: bytes) -> str:
     txt = pytesseract.image_to_string(img, lang="fra")
     return txt
 
+def _meds_as_dicts(text: str) -> List[Dict]:
+    """
+    Les noms sont cherchés dans le référentiel local (services/drug_index.py) :
+    "nom" reste le nom lu, "nom_reference" et "score" donnent l'entrée retrouvée,
+    "reconnu" indique si elle l'a été, "composant" donne la DCI.
+    """
+    if not text:
+        return []
+    index = get_drug_index()
+    out = []
+    for m in _parse_meds_from_text(text):
+        match = index.lookup(m.nom)
+        out.append({
+            "nom": m.nom, "frequence": m.frequence, "dose": m.dose, "duree": m.duree,
+            "nom_reference": match.entry.nom if match else None,
+            "score": round(match.score, 2) if match else None,
+            "composant": match.entry.substance if match else None, "reconnu": match is not None,
+        })
+    return out
+
 def extract_meds(image_bytes: Optional[bytes], typed_text: Optional[str] = None) -> List[Dict]:
     """
     - Si image fournie et OCR dispo, on OCRise puis on parse
     - Sinon, on parse ce qui est envoyé en texte (ex: OCR côté mobile)
-    Retour: liste de dict [{"nom": "...", "frequence": "1/jour"}, ...]
+    Retour: liste de dict [{"nom": "...", "frequence": "1/jour", "dose": "500 mg", "duree": "5 jours",
+    "nom_reference": "Doliprane", "score": 1.0, "composant": "Paracétamol", "reconnu": True}, ...]
+    Version bloquante (scripts) ; côté API, utiliser extract_meds_async.
     """
     text = ""
     if image_bytes and OCR_AVAILABLE:
         text = extract_text_from_image(image_bytes)
-    if not text and typed_text:
-        text = typed_text
+    return _meds_as_dicts(text or typed_text or "")
 
-    if not text:
-        return []
+async def extract_meds_async(image: Union[bytes, str, None], typed_text: Optional[str] = None) -> List[Dict]:
+    """
+    Même contrat qu'extract_meds, l'OCR passant par le pool de processus
+    (services/ocr_pool.py) pour ne pas bloquer la boucle d'événements.
+    Lève OCRQueueFull si le pool est saturé ; si aucun moteur OCR n'est
+    disponible, on se rabat sur le texte fourni.
+    """
+    from services.ocr_pool import get_ocr_pool, OCRQueueFull, OCRUnavailable
+
+    text = ""
+    if image:
+        try:
+            text = await get_ocr_pool().ocr(image)
+        except OCRQueueFull:
+            raise
+        except OCRUnavailable as e:
+            logging.getLogger(__name__).warning(f"OCR indisponible: {e}")
+        except Exception as e:
+            # image illisible, format non supporté… : on se rabat sur le texte fourni
+            logging.getLogger(__name__).warning(f"Échec OCR: {e}")
+    return _meds_as_dicts(text or typed_text or "")
+
+async def iter_pdf_meds(path: str, max_pages: Optional[int] = None) -> AsyncIterator[Dict]:
+    """
+    OCR des pages d'un PDF sur le pool, au plus OCR_WORKERS pages en vol :
+    le PDF n'est jamais rasterisé en entier, chaque worker rend sa page.
+    Produit un dict par page, dans l'ordre d'achèvement :
+    {"page": 1, "medicaments": [...]} ou {"page": 1, "erreur": "..."}.
+    """
+    from services.ocr_pool import get_ocr_pool, pdf_page_count, OCRQueueFull
+
+    pool = get_ocr_pool()
+    max_pages = max_pages or int(os.getenv("OCR_PDF_MAX_PAGES", "30"))
+    nb_pages = min(await asyncio.to_thread(pdf_page_count, path), max_pages)
+    in_flight = asyncio.Semaphore(pool.workers)
+
+    async def ocr_page(index: int) -> Dict:
+        async with in_flight:
+            for attempt in range(3):
+                try:
+                    text = await pool.ocr_pdf_page(path, index)
+                    return {"page": index + 1, "medicaments": _meds_as_dicts(text)}
+                except OCRQueueFull:
+                    # File partagée avec les autres scans : on patiente plutôt que de perdre la page
+                    await asyncio.sleep(1 + attempt)
+                except Exception as e:
+                    logging.getLogger(__name__).warning(f"Échec OCR page {index + 1} de {path}: {e}")
+                    return {"page": index + 1, "erreur": "Page illisible"}
+            return {"page": index + 1, "erreur": "Trop de scans en cours"}
 
-    meds = _parse_meds_from_text(text)
-    return [ {"nom": m.nom, "frequence": m.frequence, "dose": m.dose} for m in meds ]
+    tasks = [asyncio.create_task(ocr_page(i)) for i in range(nb_pages)]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        # client parti en cours de route : on libère les workers
+        for task in tasks:
+            task.cancel()
+
+def merge_meds(pages: Iterable[List[Dict]]) -> List[Dict]:
+    """
+    Fusionne les médicaments de plusieurs pages : une même ligne (substance
+    ou nom, dose et fréquence) n'est gardée qu'une fois, complétée par les
+    champs manquants des pages suivantes.
+    """
+    merged: Dict[tuple, Dict] = {}
+    for meds in pages:
+        for med in meds:
+            key = ((med.get("composant") or med["nom"]).lower(), (med.get("dose") or "").lower(), med["frequence"])
+            if key not in merged:
+                merged[key] = dict(med)
+                continue
+            for field, value in med.items():
+                if merged[key].get(field) is None and value is not None:
+                    merged[key][field] = value
+    return list(merged.values())
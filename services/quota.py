@@ -0,0 +1,272 @@
+"""
+Quotas LLM par utilisateur : requêtes et tokens, par jour et par mois.
+
+- check() et record() ne lisent et n'écrivent que des compteurs en mémoire ;
+  aucun accès base sur le chemin d'un appel.
+- Un thread de fond vide les deltas toutes les QUOTA_FLUSH_SECONDS en un seul
+  upsert groupé dans la table quota_usage. Le RETURNING renvoie les totaux
+  consolidés (autres processus compris), qui remplacent la base locale.
+- À la première vue d'un utilisateur sur une période, ses totaux sont chargés
+  en tâche de fond ; d'ici là seuls les deltas locaux comptent (fail-open).
+
+Limites (0 = illimité) : QUOTA_DAILY_REQUESTS, QUOTA_DAILY_TOKENS,
+QUOTA_MONTHLY_REQUESTS, QUOTA_MONTHLY_TOKENS.
+"""
+import atexit
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass
+from datetime import date, datetime, timezone
+from typing import Dict, List, Optional, Tuple
+
+from services import metrics
+
+logger = logging.getLogger(__name__)
+
+DAY, MONTH = "day", "month"
+
+# (utilisateur_id, période, début de période)
+UsageKey = Tuple[int, str, date]
+
+
+class QuotaExceeded(Exception):
+    def __init__(self, user_id: int, period: str, kind: str, used: int, limit: int):
+        self.user_id = user_id
+        self.period = period
+        self.kind = kind
+        self.used = used
+        self.limit = limit
+        super().__init__(f"Quota {period}/{kind} atteint pour l'utilisateur {user_id} ({used}/{limit})")
+
+
+@dataclass
+class Usage:
+    requests: int = 0
+    prompt_tokens: int = 0
+    output_tokens: int = 0
+
+    @property
+    def tokens(self) -> int:
+        return self.prompt_tokens + self.output_tokens
+
+    def add(self, other: "Usage") -> None:
+        self.requests += other.requests
+        self.prompt_tokens += other.prompt_tokens
+        self.output_tokens += other.output_tokens
+
+
+def _env_int(name: str, default: int = 0) -> int:
+    try:
+        return int(os.getenv(name, default))
+    except ValueError:
+        return default
+
+
+def _periods(today: date) -> List[Tuple[str, date]]:
+    return [(DAY, today), (MONTH, today.replace(day=1))]
+
+
+_rejections = metrics.counter("quota_rejections_total", "Appels refusés par quota")
+_flushes = metrics.counter("quota_flushes_total", "Vidages des compteurs vers Postgres (ok / error)")
+_flush_latency = metrics.histogram("quota_flush_seconds", "Durée d'un vidage groupé")
+_pending = metrics.gauge("quota_pending_rows", "Lignes de quota en attente d'écriture")
+
+
+class QuotaTracker:
+    def __init__(self, limits: Optional[Dict[Tuple[str, str], int]] = None, flush_interval: float = None, session_factory=None):
+        self.limits = limits or {
+            (DAY, "requests"): _env_int("QUOTA_DAILY_REQUESTS"),
+            (DAY, "tokens"): _env_int("QUOTA_DAILY_TOKENS"),
+            (MONTH, "requests"): _env_int("QUOTA_MONTHLY_REQUESTS"),
+            (MONTH, "tokens"): _env_int("QUOTA_MONTHLY_TOKENS"),
+        }
+        self.flush_interval = flush_interval or float(os.getenv("QUOTA_FLUSH_SECONDS", "10"))
+        self._session_factory = session_factory
+        self._lock = threading.Lock()
+        self._base: Dict[UsageKey, Usage] = {}
+        self._pending: Dict[UsageKey, Usage] = {}
+        # Lot en cours d'écriture, toujours compté dans les totaux
+        self._flushing: Dict[UsageKey, Usage] = {}
+        self._to_load: set = set()
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        _pending.set_function(lambda: len(self._pending))
+
+    # ── Chemin chaud (mémoire uniquement) ────────────────────────────────────
+    def _today(self) -> date:
+        return datetime.now(timezone.utc).date()
+
+    def _total_locked(self, key: UsageKey) -> Usage:
+        total = Usage()
+        for source in (self._base, self._flushing, self._pending):
+            if key in source:
+                total.add(source[key])
+        return total
+
+    def check(self, user_id: Optional[int]) -> None:
+        """Lève QuotaExceeded si une limite jour/mois est déjà atteinte."""
+        if user_id is None:
+            return
+        with self._lock:
+            for period, start in _periods(self._today()):
+                key = (user_id, period, start)
+                if key not in self._base:
+                    self._to_load.add(key)
+                used = self._total_locked(key)
+                for kind, value in (("requests", used.requests), ("tokens", used.tokens)):
+                    limit = self.limits.get((period, kind), 0)
+                    if limit and value >= limit:
+                        _rejections.inc(period=period, kind=kind)
+                        raise QuotaExceeded(user_id, period, kind, value, limit)
+        self._ensure_worker()
+
+    def record(self, user_id: Optional[int], prompt_tokens: int, output_tokens: int) -> None:
+        if user_id is None:
+            return
+        delta = Usage(1, prompt_tokens, output_tokens)
+        with self._lock:
+            for period, start in _periods(self._today()):
+                self._pending.setdefault((user_id, period, start), Usage()).add(delta)
+        self._ensure_worker()
+
+    def usage(self, user_id: int) -> Dict[str, Usage]:
+        """Totaux connus (base + deltas non écrits) pour la période courante."""
+        out = {}
+        with self._lock:
+            for period, start in _periods(self._today()):
+                out[period] = self._total_locked((user_id, period, start))
+        return out
+
+    # ── Thread de fond ───────────────────────────────────────────────────────
+    def _ensure_worker(self) -> None:
+        if self._thread is not None:
+            if self._to_load:
+                self._wake.set()
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="quota-flusher", daemon=True)
+                self._thread.start()
+                atexit.register(self.flush)
+        self._wake.set()
+
+    def _sessions(self):
+        if self._session_factory is None:
+            from database.database import SessionLocal
+            self._session_factory = SessionLocal
+        return self._session_factory
+
+    def _run(self) -> None:
+        next_flush = time.monotonic() + self.flush_interval
+        while True:
+            self._wake.wait(timeout=max(next_flush - time.monotonic(), 0))
+            self._wake.clear()
+            try:
+                self._load()
+            except Exception:
+                logger.exception("Chargement des quotas impossible")
+            if time.monotonic() >= next_flush:
+                self.flush()
+                next_flush = time.monotonic() + self.flush_interval
+
+    def _load(self) -> None:
+        with self._lock:
+            keys, self._to_load = self._to_load, set()
+        if not keys:
+            return
+        from sqlalchemy import select, tuple_
+        from models.quota import QuotaUsage
+
+        stmt = select(
+            QuotaUsage.utilisateur_id, QuotaUsage.periode, QuotaUsage.debut_periode,
+            QuotaUsage.nb_requetes, QuotaUsage.tokens_entree, QuotaUsage.tokens_sortie,
+        ).where(tuple_(QuotaUsage.utilisateur_id, QuotaUsage.periode, QuotaUsage.debut_periode).in_(list(keys)))
+        try:
+            with self._sessions()() as db:
+                rows = db.execute(stmt).all()
+        except Exception:
+            with self._lock:
+                self._to_load |= keys
+            raise
+        loaded = {(r[0], r[1], r[2]): Usage(r[3], r[4], r[5]) for r in rows}
+        with self._lock:
+            for key in keys:
+                self._base.setdefault(key, loaded.get(key, Usage()))
+
+    def _upsert(self, batch: Dict[UsageKey, Usage]):
+        from sqlalchemy.dialects.postgresql import insert
+        from models.quota import QuotaUsage
+
+        stmt = insert(QuotaUsage).values([
+            {
+                "utilisateur_id": user_id, "periode": period, "debut_periode": start,
+                "nb_requetes": u.requests, "tokens_entree": u.prompt_tokens, "tokens_sortie": u.output_tokens,
+            }
+            for (user_id, period, start), u in batch.items()
+        ])
+        stmt = stmt.on_conflict_do_update(
+            constraint="uq_quota_usage_periode",
+            set_={
+                "nb_requetes": QuotaUsage.nb_requetes + stmt.excluded.nb_requetes,
+                "tokens_entree": QuotaUsage.tokens_entree + stmt.excluded.tokens_entree,
+                "tokens_sortie": QuotaUsage.tokens_sortie + stmt.excluded.tokens_sortie,
+            },
+        ).returning(
+            QuotaUsage.utilisateur_id, QuotaUsage.periode, QuotaUsage.debut_periode,
+            QuotaUsage.nb_requetes, QuotaUsage.tokens_entree, QuotaUsage.tokens_sortie,
+        )
+        with self._sessions()() as db:
+            rows = db.execute(stmt).all()
+            db.commit()
+        return rows
+
+    def flush(self) -> None:
+        """Écrit les deltas en attente en un seul upsert ; remis en file en cas d'erreur."""
+        with self._lock:
+            batch, self._pending = self._pending, {}
+            self._flushing = batch
+        if not batch:
+            self._prune()
+            return
+
+        t0 = time.perf_counter()
+        try:
+            rows = self._upsert(batch)
+        except Exception:
+            logger.exception(f"Écriture de {len(batch)} ligne(s) de quota impossible, nouvel essai au prochain cycle")
+            _flushes.inc(outcome="error")
+            with self._lock:
+                self._flushing = {}
+                for key, usage in batch.items():
+                    self._pending.setdefault(key, Usage()).add(usage)
+            return
+        _flushes.inc(outcome="ok")
+        _flush_latency.observe(time.perf_counter() - t0)
+
+        with self._lock:
+            self._flushing = {}
+            for r in rows:
+                self._base[(r[0], r[1], r[2])] = Usage(r[3], r[4], r[5])
+        self._prune()
+
+    def _prune(self) -> None:
+        """Oublie les périodes révolues déjà écrites."""
+        current = set(_periods(self._today()))
+        with self._lock:
+            for key in [k for k in self._base if (k[1], k[2]) not in current and k not in self._pending]:
+                del self._base[key]
+
+
+_tracker: Optional[QuotaTracker] = None
+_tracker_lock = threading.Lock()
+
+
+def get_quota() -> QuotaTracker:
+    global _tracker
+    if _tracker is None:
+        with _tracker_lock:
+            if _tracker is None:
+                _tracker = QuotaTracker()
+    return _tracker
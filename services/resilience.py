@@ -0,0 +1,266 @@
+"""
+Couche de résilience autour des appels au modèle :
+
+- délai maximal par tentative et pour l'appel complet,
+- retries avec backoff exponentiel « full jitter » sur les erreurs transitoires
+  (429, 5xx, timeouts, coupures réseau),
+- requête couverte (hedging) optionnelle : si la réponse tarde au-delà du p95
+  observé, une seconde requête identique est lancée et la première réponse gagne,
+- disjoncteur : après N échecs consécutifs les appels échouent immédiatement
+  pendant une période de refroidissement, puis une requête de sonde est autorisée.
+
+État du disjoncteur, retries et hedges sont exposés dans services.metrics.
+"""
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+from typing import Optional
+
+from services import metrics
+from services.llm import LLMBackend, LLMRequest, LLMResponse
+
+logger = logging.getLogger(__name__)
+
+
+class LLMUnavailable(Exception):
+    """Le fournisseur est indisponible (disjoncteur ouvert, délai ou retries épuisés)."""
+
+
+_RETRYABLE_NAMES = {
+    "TimeoutError", "ResourceExhausted", "TooManyRequests", "ServiceUnavailable",
+    "InternalServerError", "DeadlineExceeded", "GatewayTimeout", "BadGateway",
+    "ConnectionError", "ClientConnectionError", "ServerDisconnectedError", "RetryError",
+}
+_RETRYABLE_CODES = {429, 500, 502, 503, 504}
+
+
+def _status_code(exc: Exception) -> Optional[int]:
+    code = getattr(exc, "code", None)
+    if callable(code):
+        try:
+            code = code()
+        except Exception:
+            code = None
+    if isinstance(code, int):
+        return code
+    value = getattr(code, "value", None)
+    if isinstance(value, tuple):
+        value = value[0]
+    return value if isinstance(value, int) else None
+
+
+def is_rate_limited(exc: Exception) -> bool:
+    return type(exc).__name__ in {"ResourceExhausted", "TooManyRequests"} or _status_code(exc) == 429
+
+
+def is_retryable(exc: Exception) -> bool:
+    if isinstance(exc, (asyncio.TimeoutError, ConnectionError)):
+        return True
+    return type(exc).__name__ in _RETRYABLE_NAMES or _status_code(exc) in _RETRYABLE_CODES
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, default))
+    except ValueError:
+        return default
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Disjoncteur
+# ──────────────────────────────────────────────────────────────────────────────
+CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+_STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+_breaker_state = metrics.gauge("llm_breaker_state", "0=fermé, 1=semi-ouvert, 2=ouvert")
+_breaker_rejections = metrics.counter("llm_breaker_rejections_total", "Appels refusés par le disjoncteur")
+_breaker_transitions = metrics.counter("llm_breaker_transitions_total", "Changements d'état du disjoncteur")
+
+
+class CircuitBreaker:
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        _breaker_state.set(_STATE_VALUES[CLOSED], breaker=name)
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._state
+
+    def _transition(self, state: str) -> None:
+        if state == self._state:
+            return
+        logger.warning(f"Disjoncteur {self.name}: {self._state} → {state}")
+        self._state = state
+        _breaker_state.set(_STATE_VALUES[state], breaker=self.name)
+        _breaker_transitions.inc(breaker=self.name, to=state)
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._state == OPEN:
+                if time.monotonic() - self._opened_at < self.reset_timeout:
+                    return False
+                self._transition(HALF_OPEN)
+            if self._state == HALF_OPEN:
+                if self._probe_in_flight:
+                    return False
+                self._probe_in_flight = True
+            return True
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            self._probe_in_flight = False
+            self._transition(CLOSED)
+
+    def release(self) -> None:
+        """
+        Tentative abandonnée ou sans verdict sur le fournisseur (délestage,
+        annulation, erreur de requête) : libère la sonde sans changer d'état.
+        """
+        with self._lock:
+            self._probe_in_flight = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            self._probe_in_flight = False
+            if self._state == HALF_OPEN or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+                self._transition(OPEN)
+
+
+# ──────────────────────────────────────────────────────────────────────────────
+# Appels résilients
+# ──────────────────────────────────────────────────────────────────────────────
+_retries = metrics.counter("llm_retries_total", "Nouvelles tentatives après erreur transitoire")
+_hedges = metrics.counter("llm_hedges_total", "Requêtes couvertes lancées / gagnantes")
+_call_latency = metrics.histogram("llm_call_latency_seconds", "Latence d'une tentative réussie")
+_failures = metrics.counter("llm_call_failures_total", "Tentatives en échec")
+
+
+class ResilientCaller:
+    def __init__(
+        self,
+        name: str = "llm",
+        attempt_timeout: float = None,
+        total_deadline: float = None,
+        max_retries: int = None,
+        backoff_base: float = None,
+        backoff_cap: float = None,
+        hedge: bool = None,
+        hedge_min_samples: int = 20,
+        breaker: Optional[CircuitBreaker] = None,
+    ):
+        self.name = name
+        self.attempt_timeout = attempt_timeout or _env_float("LLM_CALL_TIMEOUT_SECONDS", 30.0)
+        self.total_deadline = total_deadline or _env_float("LLM_TOTAL_DEADLINE_SECONDS", 60.0)
+        self.max_retries = int(max_retries if max_retries is not None else _env_float("LLM_MAX_RETRIES", 2))
+        self.backoff_base = backoff_base or _env_float("LLM_BACKOFF_BASE_SECONDS", 0.5)
+        self.backoff_cap = backoff_cap or _env_float("LLM_BACKOFF_CAP_SECONDS", 8.0)
+        if hedge is None:
+            hedge = os.getenv("LLM_HEDGE", "0").strip().lower() in {"1", "true", "yes", "on"}
+        self.hedge = hedge
+        self.hedge_min_samples = hedge_min_samples
+        self.breaker = breaker or CircuitBreaker(
+            name,
+            failure_threshold=int(_env_float("LLM_BREAKER_FAILURES", 5)),
+            reset_timeout=_env_float("LLM_BREAKER_RESET_SECONDS", 30.0),
+        )
+        self._rng = random.Random()
+
+    def _hedge_delay(self, model: str) -> Optional[float]:
+        if not self.hedge or _call_latency.count(model=model) < self.hedge_min_samples:
+            return None
+        return _call_latency.quantile(0.95, model=model)
+
+    async def _attempt(self, backend: LLMBackend, request: LLMRequest, timeout: float) -> LLMResponse:
+        t0 = time.perf_counter()
+        resp = await asyncio.wait_for(backend.generate(request), timeout=timeout)
+        _call_latency.observe(time.perf_counter() - t0, model=request.model)
+        return resp
+
+    async def _hedged_attempt(self, backend: LLMBackend, request: LLMRequest, timeout: float) -> LLMResponse:
+        delay = self._hedge_delay(request.model)
+        if delay is None or delay >= timeout:
+            return await self._attempt(backend, request, timeout)
+
+        primary = asyncio.ensure_future(self._attempt(backend, request, timeout))
+        tasks = [primary]
+        try:
+            done, _ = await asyncio.wait({primary}, timeout=delay)
+            if done:
+                return primary.result()
+
+            _hedges.inc(model=request.model, outcome="launched")
+            hedge = asyncio.ensure_future(self._attempt(backend, request, max(timeout - delay, 0.001)))
+            tasks.append(hedge)
+            pending = {primary, hedge}
+            error: Optional[BaseException] = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedge:
+                            _hedges.inc(model=request.model, outcome="won")
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            # Aussi quand l'appelant est annulé (client parti, délai global) :
+            # aucune des deux tentatives ne doit continuer seule
+            for task in tasks:
+                task.cancel()
+
+    async def generate(self, backend: LLMBackend, request: LLMRequest) -> LLMResponse:
+        deadline = time.monotonic() + self.total_deadline
+        attempt = 0
+        while True:
+            if not self.breaker.allow():
+                _breaker_rejections.inc(breaker=self.breaker.name)
+                raise LLMUnavailable(f"Disjoncteur {self.breaker.name} ouvert")
+
+            remaining = deadline - time.monotonic()
+            try:
+                resp = await self._hedged_attempt(backend, request, min(self.attempt_timeout, remaining))
+            except LLMUnavailable:
+                # Délestée par la passerelle : le fournisseur n'a pas été sollicité
+                self.breaker.release()
+                raise
+            except Exception as e:
+                retryable = is_retryable(e)
+                reason = "rate_limited" if is_rate_limited(e) else type(e).__name__
+                _failures.inc(model=request.model, reason=reason)
+                if not retryable:
+                    # Erreur de requête (400…) : ne dit rien de l'état du fournisseur,
+                    # la sonde est libérée sans refermer le disjoncteur
+                    self.breaker.release()
+                    raise
+                self.breaker.record_failure()
+                attempt += 1
+                backoff = self._rng.uniform(0, min(self.backoff_cap, self.backoff_base * (2 ** attempt)))
+                remaining = deadline - time.monotonic()
+                if attempt > self.max_retries or backoff >= remaining:
+                    raise LLMUnavailable(f"Appel {request.model} en échec après {attempt} tentative(s): {reason}") from e
+                _retries.inc(model=request.model, reason=reason)
+                logger.info(f"Retry {attempt}/{self.max_retries} pour {request.model} dans {backoff:.2f}s ({reason})")
+                await asyncio.sleep(backoff)
+                continue
+            except BaseException:
+                # Annulation (client déconnecté…) : sans libération, une sonde
+                # annulée laisserait le disjoncteur semi-ouvert pour toujours
+                self.breaker.release()
+                raise
+
+            self.breaker.record_success()
+            return resp
@@ -0,0 +1,103 @@
+"""
+Politique de routage des appels LLM vers des niveaux de modèles.
+
+- image dans le tour            → route "multimodal" (modèle complet, plafond de sortie élevé)
+- texte court sans intention
+  calendrier                    → route "light" (modèle léger, outils gardés : une
+                                  confirmation courte comme « oui, ajoute-le » doit
+                                  pouvoir déclencher l'action proposée au tour précédent)
+- sinon                         → route par défaut ("full", avec outils)
+
+La configuration (modèles, plafonds de tokens, prix) est lue dans
+services/model_routes.json, ou dans le fichier désigné par LLM_ROUTES_FILE.
+Les coûts estimés par route alimentent services.metrics pour ajuster la politique.
+"""
+import json
+import logging
+import os
+import threading
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+from services.llm import _is_image, iter_parts
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ROUTES_FILE = os.path.join(os.path.dirname(__file__), "model_routes.json")
+
+
+@dataclass(frozen=True)
+class Route:
+    name: str
+    model: str
+    max_output_tokens: int
+    tools: bool = True
+    cost_per_million_input: float = 0.0
+    cost_per_million_cached_input: float = 0.0
+    cost_per_million_output: float = 0.0
+
+    def cost(self, prompt_tokens: int, cached_tokens: int, output_tokens: int) -> float:
+        uncached = max(prompt_tokens - cached_tokens, 0)
+        return (
+            uncached * self.cost_per_million_input
+            + cached_tokens * self.cost_per_million_cached_input
+            + output_tokens * self.cost_per_million_output
+        ) / 1_000_000
+
+
+class ModelRouter:
+    def __init__(self, config: dict):
+        self.routes: Dict[str, Route] = {
+            name: Route(name=name, **spec) for name, spec in config.get("routes", {}).items()
+        }
+        self.default_route = config.get("default_route", "full")
+        if self.default_route not in self.routes:
+            raise ValueError(f"Route par défaut inconnue : {self.default_route}")
+        self.light_max_chars = int(config.get("light_max_chars", 0))
+        self.tool_keywords: List[str] = [k.lower() for k in config.get("tool_keywords", [])]
+
+    @classmethod
+    def from_file(cls, path: Optional[str] = None) -> "ModelRouter":
+        path = path or os.getenv("LLM_ROUTES_FILE") or DEFAULT_ROUTES_FILE
+        with open(path, encoding="utf-8") as f:
+            return cls(json.load(f))
+
+    def _wants_tools(self, text: str) -> bool:
+        lowered = text.lower()
+        return any(k in lowered for k in self.tool_keywords)
+
+    def choose(self, prompt_parts, tools_available: bool = False) -> Route:
+        parts = list(iter_parts(prompt_parts))
+        if any(_is_image(p) for p in parts) and "multimodal" in self.routes:
+            return self.routes["multimodal"]
+
+        # Pour un historique complet, seul le dernier message compte
+        last_text = next((p for p in reversed(parts) if isinstance(p, str) and p.strip()), "")
+        if (
+            "light" in self.routes
+            and len(last_text) <= self.light_max_chars
+            and not (tools_available and self._wants_tools(last_text))
+        ):
+            return self.routes["light"]
+        return self.routes[self.default_route]
+
+
+_router: Optional[ModelRouter] = None
+_router_lock = threading.Lock()
+
+
+def get_router() -> ModelRouter:
+    global _router
+    if _router is None:
+        with _router_lock:
+            if _router is None:
+                _router = ModelRouter.from_file()
+                logger.info(f"Routes LLM : {', '.join(f'{r.name}={r.model}' for r in _router.routes.values())}")
+    return _router
+
+
+def reload_router(path: Optional[str] = None) -> ModelRouter:
+    global _router
+    with _router_lock:
+        _router = ModelRouter.from_file(path)
+    return _router
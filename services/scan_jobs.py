@@ -0,0 +1,326 @@
+"""
+Scans d'ordonnance asynchrones, adossés à la table scan_job.
+
+- enqueue_scan_job() insère le job pour un fichier déjà reçu dans
+  SCAN_JOBS_DIR (volume partagé si les workers tournent sur d'autres
+  conteneurs) ; la route y copie l'upload par blocs (server/uploads.py).
+- Les workers réservent un job à la fois avec FOR UPDATE SKIP LOCKED : plusieurs
+  workers (tâches ou processus) ne prennent jamais le même. Le bail
+  (SCAN_JOBS_LEASE_SECONDS) est prolongé pendant le traitement ; un job dont le
+  bail expire (worker tué, redémarrage) est repris, au plus
+  SCAN_JOBS_MAX_ATTEMPTS fois.
+- Une erreur passagère (pool OCR saturé, modèle indisponible, base injoignable)
+  remet le job en attente avec son fichier, repris après un délai croissant ;
+  les autres erreurs le terminent en échec.
+- Les résultats partiels (pages d'un PDF) sont écrits au fil de l'eau ; la fin
+  du job est publiée sur le broker (topic user:<id>) et arrive sur la
+  WebSocket de l'utilisateur.
+
+Dans le serveur, SCAN_JOBS_IN_PROCESS=1 (défaut) démarre un worker sur la
+boucle principale ; en processus séparé (BROKER_BACKEND=postgres requis pour
+la notification) :
+
+    python -m services.scan_jobs
+"""
+import asyncio
+import contextlib
+import logging
+import os
+import threading
+from datetime import date, timedelta
+from typing import Optional
+
+from services import metrics
+from services.blob_store import file_sha256, get_blob_store
+from services.broker import get_broker, user_topic
+
+logger = logging.getLogger(__name__)
+
+PENDING, RUNNING, DONE, FAILED = "en_attente", "en_cours", "termine", "echec"
+
+_jobs = metrics.counter("scan_jobs_total", "Scans asynchrones par statut (termine / echec / repris / remis)")
+_job_latency = metrics.histogram("scan_job_seconds", "Durée de traitement d'un scan asynchrone")
+
+
+def _is_transient(error: Exception) -> bool:
+    """Erreur qui peut disparaître d'elle-même : le job sera retenté."""
+    from sqlalchemy.exc import InterfaceError, OperationalError, TimeoutError as PoolTimeout
+    from services.ocr_pool import OCRUnavailable
+    from services.resilience import LLMUnavailable
+
+    # GatewayBusy hérite de LLMUnavailable, OCRQueueFull / OCRTimeout d'OCRUnavailable
+    return isinstance(error, (OCRUnavailable, LLMUnavailable, OperationalError, InterfaceError, PoolTimeout))
+
+
+def jobs_dir() -> str:
+    return os.getenv("SCAN_JOBS_DIR", os.path.join(".cache", "scan_jobs"))
+
+
+def enqueue_scan_job(db, utilisateur_id: int, path: str, filename: Optional[str], content_type: Optional[str],
+                     valid_until: Optional[date] = None):
+    """
+    Insère le job pour le fichier `path` (dans jobs_dir()) ; retourne le
+    ScanJob créé. Le fichier est supprimé si l'insertion échoue.
+    """
+    from models import ScanJob
+
+    job = ScanJob(
+        utilisateur_id=utilisateur_id, statut=PENDING, chemin_fichier=os.path.abspath(path),
+        nom_fichier=filename, type_contenu=content_type, valid_until=valid_until,
+    )
+    try:
+        db.add(job)
+        db.commit()
+    except Exception:
+        db.rollback()
+        os.remove(path)
+        raise
+    db.refresh(job)
+    get_scan_worker().notify()
+    return job
+
+
+def job_as_dict(job) -> dict:
+    return {
+        "job_id": job.id,
+        "statut": job.statut,
+        "nom_fichier": job.nom_fichier,
+        "resultats": job.resultats,
+        "ordonnance_id": job.ordonnance_id,
+        "erreur": job.erreur,
+        "cree_le": job.cree_le.isoformat() if job.cree_le else None,
+        "termine_le": job.termine_le.isoformat() if job.termine_le else None,
+    }
+
+
+class ScanJobWorker:
+    def __init__(self, concurrency: int = None, poll_interval: float = None, lease: float = None, max_attempts: int = None):
+        self.concurrency = concurrency or int(os.getenv("SCAN_JOBS_CONCURRENCY", "2"))
+        self.poll_interval = poll_interval or float(os.getenv("SCAN_JOBS_POLL_SECONDS", "2"))
+        self.lease = lease or float(os.getenv("SCAN_JOBS_LEASE_SECONDS", "120"))
+        self.max_attempts = max_attempts or int(os.getenv("SCAN_JOBS_MAX_ATTEMPTS", "3"))
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wake: Optional[asyncio.Event] = None
+
+    # ── Accès base (exécutés dans un thread) ─────────────────────────────────
+    def _claim(self):
+        from sqlalchemy import func, or_, select, update
+        from database.database import SessionLocal
+        from models import ScanJob
+
+        # Le bail d'un job en attente est le délai avant nouvelle tentative
+        candidate = (
+            select(ScanJob.id)
+            .where(
+                ScanJob.statut.in_((PENDING, RUNNING)),
+                or_(ScanJob.bail_jusqu_a.is_(None), ScanJob.bail_jusqu_a < func.now()),
+            )
+            .order_by(ScanJob.id)
+            .limit(1)
+            .with_for_update(skip_locked=True)
+            .scalar_subquery()
+        )
+        stmt = (
+            update(ScanJob)
+            .where(ScanJob.id == candidate)
+            .values(statut=RUNNING, tentatives=ScanJob.tentatives + 1,
+                    bail_jusqu_a=func.now() + timedelta(seconds=self.lease))
+            .returning(ScanJob.id, ScanJob.utilisateur_id, ScanJob.chemin_fichier, ScanJob.type_contenu,
+                       ScanJob.valid_until, ScanJob.tentatives)
+            .execution_options(synchronize_session=False)
+        )
+        with SessionLocal() as db:
+            row = db.execute(stmt).first()
+            db.commit()
+        return row
+
+    def _update(self, job_id: int, **values) -> None:
+        from sqlalchemy import update
+        from database.database import SessionLocal
+        from models import ScanJob
+
+        with SessionLocal() as db:
+            db.execute(update(ScanJob).where(ScanJob.id == job_id).values(**values).execution_options(synchronize_session=False))
+            db.commit()
+
+    def _extend_lease(self, job_id: int) -> None:
+        from sqlalchemy import func
+        self._update(job_id, bail_jusqu_a=func.now() + timedelta(seconds=self.lease))
+
+    def _finish(self, job_id: int, utilisateur_id: int, valid_until, meds, resultats, image_sha256: str = None) -> int:
+        """Ordonnance et fin du job dans la même transaction."""
+        from sqlalchemy import func, update
+        from database.controller import create_ordonnance_with_meds
+        from database.database import SessionLocal
+        from models import ScanJob
+
+        with SessionLocal() as db:
+            ordon = create_ordonnance_with_meds(
+                db, utilisateur_id=utilisateur_id, valid_until=valid_until, meds=meds, image_sha256=image_sha256
+            )
+            db.execute(
+                update(ScanJob).where(ScanJob.id == job_id)
+                .values(statut=DONE, ordonnance_id=ordon.id, resultats=resultats, erreur=None,
+                        termine_le=func.now(), bail_jusqu_a=None)
+                .execution_options(synchronize_session=False)
+            )
+            db.commit()
+            return ordon.id
+
+    # ── Boucle ───────────────────────────────────────────────────────────────
+    def notify(self) -> None:
+        """Réveille les workers de ce processus (appelable depuis n'importe quel thread)."""
+        if self._loop is not None and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._wake.set)
+
+    async def run(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._wake = asyncio.Event()
+        logger.info(f"Worker de scans démarré ({self.concurrency} job(s) en parallèle)")
+        await asyncio.gather(*(self._slot() for _ in range(self.concurrency)))
+
+    async def _slot(self) -> None:
+        while True:
+            try:
+                row = await asyncio.to_thread(self._claim)
+            except Exception:
+                logger.exception("Réservation d'un scan impossible")
+                row = None
+            if row is None:
+                self._wake.clear()
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(self._wake.wait(), timeout=self.poll_interval)
+                continue
+            await self._process(*row)
+
+    async def _process(self, job_id: int, utilisateur_id: int, path: str, content_type: Optional[str], valid_until, attempts: int) -> None:
+        if attempts > 1:
+            _jobs.inc(statut="repris")
+        if attempts > self.max_attempts:
+            await self._fail(job_id, utilisateur_id, path, "Nombre maximal de tentatives atteint")
+            return
+
+        heartbeat = asyncio.create_task(self._heartbeat(job_id))
+        started = self._loop.time()
+        try:
+            meds, resultats = await self._extract(job_id, utilisateur_id, path, content_type)
+            if not meds:
+                await self._fail(job_id, utilisateur_id, path, "Impossible d'extraire des médicaments.", resultats)
+                return
+            image_sha256 = await asyncio.to_thread(file_sha256, path)
+            ordonnance_id = await asyncio.to_thread(
+                self._finish, job_id, utilisateur_id, valid_until, meds, resultats, image_sha256
+            )
+        except Exception as e:
+            erreur = str(e) or type(e).__name__
+            if _is_transient(e) and attempts < self.max_attempts:
+                logger.warning(f"Scan {job_id} remis en attente (tentative {attempts}): {erreur}")
+                await self._release(job_id, attempts, erreur)
+                return
+            logger.exception(f"Échec du scan {job_id}")
+            await self._fail(job_id, utilisateur_id, path, erreur)
+            return
+        finally:
+            heartbeat.cancel()
+
+        _jobs.inc(statut=DONE)
+        _job_latency.observe(self._loop.time() - started)
+        # Le fichier du job devient l'image de l'ordonnance (déplacé, pas copié)
+        try:
+            store = get_blob_store()
+            await asyncio.to_thread(store.put_file, path, image_sha256)
+            store.schedule_thumbnail(image_sha256)
+        except Exception:
+            logger.exception(f"Image du scan {job_id} non conservée")
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+        get_broker().publish(user_topic(utilisateur_id), {
+            "type": "scan.termine", "job_id": job_id, "statut": DONE,
+            "ordonnance_id": ordonnance_id, "medicaments": meds,
+        })
+
+    async def _heartbeat(self, job_id: int) -> None:
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            try:
+                await asyncio.to_thread(self._extend_lease, job_id)
+            except Exception:
+                logger.exception(f"Prolongation du bail du scan {job_id} impossible")
+
+    async def _extract(self, job_id: int, utilisateur_id: int, path: str, content_type: Optional[str]):
+        from services.ordo_extract import iter_pdf_meds, merge_meds
+
+        with open(path, "rb") as f:
+            is_pdf = content_type == "application/pdf" or f.read(5) == b"%PDF-"
+        if is_pdf:
+            pages = []
+            async for page in iter_pdf_meds(path):
+                pages.append(page)
+                pages.sort(key=lambda p: p["page"])
+                await asyncio.to_thread(self._update, job_id, resultats={"pages": pages})
+                get_broker().publish(user_topic(utilisateur_id), {
+                    "type": "scan.progression", "job_id": job_id, "page": page["page"], "pages_traitees": len(pages),
+                })
+            meds = merge_meds(p["medicaments"] for p in pages if "medicaments" in p)
+            return meds, {"pages": pages, "medicaments": meds}
+
+        from services.hybrid_extract import extract_prescription
+
+        extraction = await extract_prescription(path, user_id=utilisateur_id)
+        if extraction is None:
+            return [], None
+        return extraction.medicaments, {
+            "medicaments": extraction.medicaments, "source": extraction.source,
+            "confiance": round(extraction.confiance, 3),
+        }
+
+    async def _release(self, job_id: int, attempts: int, erreur: str) -> None:
+        """Remet le job en attente, fichier conservé, après un délai croissant."""
+        from sqlalchemy import func
+
+        _jobs.inc(statut="remis")
+        delay = min(self.poll_interval * 2 ** attempts, self.lease)
+        try:
+            await asyncio.to_thread(
+                self._update, job_id, statut=PENDING, erreur=erreur,
+                bail_jusqu_a=func.now() + timedelta(seconds=delay),
+            )
+        except Exception:
+            # Base toujours injoignable : le bail en cours expirera et le job sera repris
+            logger.exception(f"Impossible de remettre le scan {job_id} en attente")
+
+    async def _fail(self, job_id: int, utilisateur_id: int, path: str, erreur: str, resultats=None) -> None:
+        from sqlalchemy import func
+
+        _jobs.inc(statut=FAILED)
+        values = dict(statut=FAILED, erreur=erreur, termine_le=func.now(), bail_jusqu_a=None)
+        if resultats is not None:
+            values["resultats"] = resultats
+        try:
+            await asyncio.to_thread(self._update, job_id, **values)
+        except Exception:
+            logger.exception(f"Impossible de marquer le scan {job_id} en échec")
+            return
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path)
+        get_broker().publish(user_topic(utilisateur_id), {
+            "type": "scan.termine", "job_id": job_id, "statut": FAILED, "erreur": erreur,
+        })
+
+
+_worker: Optional[ScanJobWorker] = None
+_worker_lock = threading.Lock()
+
+
+def get_scan_worker() -> ScanJobWorker:
+    global _worker
+    if _worker is None:
+        with _worker_lock:
+            if _worker is None:
+                _worker = ScanJobWorker()
+    return _worker
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(get_scan_worker().run())
@@ -1,14 +1,29 @@
-import google.generativeai as genai
+import asyncio
+import time
 from typing import List, Union
 from PIL import Image
-import os
 from dotenv import load_dotenv
 import requests
 from datetime import datetime
+
+import logging
+
+from services.llm import LLMRequest, LLMResponse, get_backend
+from services.cassette import recorded, record_tool_call
+from services import metrics
+from services.resilience import ResilientCaller
+from services.gateway import GatewayBackend, get_gateway, LANE_INTERACTIVE, LANE_EXTRACTION
+from services.quota import get_quota
+from services.extraction_cache import cache_key, get_extraction_cache
+from services.routing import get_router
+from services.drug_index import get_drug_index
+from pydantic import ValidationError
+from database.schemas import ExtractionOrdonnance
+
+logger = logging.getLogger(__name__)
  
  
-genai.configure(api_key=os.getenv("GEMAL_API_KEY"))
- 
+# Valeurs par défaut ; modèle et plafond de sortie sont fixés par route (services/model_routes.json)
 generation_config = {
     "temperature": 1,
     "max_output_tokens": 1024,
@@ -53,42 +68,204 @@ Ne fournis aucune interprétation, aucun conseil médical, et ne pose aucune que
 Ensuite, présente les informations extraites sous forme de liste claire. Si l'image n'est pas lisible ou n'est pas une ordonnance, indique-le simplement.
 """
  
-model = genai.GenerativeModel(
-    model_name="gemini-2.5-flash",
-    generation_config=generation_config,
-    system_instruction=system_instruction
-)
+_prompt_tokens = metrics.counter("llm_prompt_tokens_total", "Tokens d'entrée, cached/uncached")
+_output_tokens = metrics.counter("llm_output_tokens_total", "Tokens de sortie")
+ 
+_route_calls = metrics.counter("llm_route_calls_total", "Appels par route")
+_route_latency = metrics.histogram("llm_route_latency_seconds", "Latence des appels par route")
+_route_cost = metrics.counter("llm_route_cost_usd_total", "Coût estimé par route (USD)")
  
-def generate_response(prompt_parts: List[Union[str, Image.Image]], system_instruction_update: str = None) -> str:
+# Délais, retries, hedging et disjoncteur (voir services/resilience.py)
+_resilience = ResilientCaller("llm")
+ 
+def _routed_request(prompt_parts, instruction, user_context, tools=None, lane=LANE_INTERACTIVE, user_id=None) -> LLMRequest:
+    """Choisit modèle, plafond de sortie et outils selon la politique de routage."""
+    route = get_router().choose(prompt_parts, tools_available=bool(tools))
+    return LLMRequest(
+        parts=prompt_parts,
+        model=route.model,
+        system_instruction=instruction or system_instruction,
+        tools=tools if route.tools else None,
+        generation_config={**generation_config, "max_output_tokens": route.max_output_tokens},
+        context=user_context,
+        route=route.name,
+        lane=lane,
+        user_id=user_id,
+    )
+ 
+async def _generate(request: LLMRequest) -> LLMResponse:
+    """
+    Appel résilient au backend via la passerelle (voies, débit, concurrence) +
+    quotas utilisateur, comptage des tokens (cache de contexte) et coûts par route.
+    """
+    quota = get_quota()
+    quota.check(request.user_id)
+    t0 = time.perf_counter()
+    response = await _resilience.generate(GatewayBackend(get_backend(), get_gateway()), request)
+    quota.record(request.user_id, response.prompt_tokens, response.output_tokens)
+    cached = min(response.cached_tokens, response.prompt_tokens)
+    _prompt_tokens.inc(cached, model=request.model, kind="cached")
+    _prompt_tokens.inc(response.prompt_tokens - cached, model=request.model, kind="uncached")
+    _output_tokens.inc(response.output_tokens, model=request.model)
+    if request.route:
+        route = get_router().routes.get(request.route)
+        _route_calls.inc(route=request.route)
+        _route_latency.observe(time.perf_counter() - t0, route=request.route)
+        if route is not None:
+            _route_cost.inc(route.cost(response.prompt_tokens, cached, response.output_tokens), route=request.route)
+    logger.info(
+        f"LLM {request.route or '-'}/{request.model}: {response.prompt_tokens} tokens d'entrée "
+        f"({cached} en cache, {response.prompt_tokens - cached} hors cache), "
+        f"{response.output_tokens} en sortie, {response.latency * 1000:.0f}ms"
+    )
+    return response
+ 
+@recorded("generate_response")
+async def generate_response(
+    prompt_parts: List[Union[str, Image.Image]],
+    system_instruction_update: str = None,
+    user_context: str | None = None,
+    user_id: int | None = None
+) -> str:
     """
     Generate a response from the model based on the provided prompt parts (text and images).
     
     Args:
         prompt_parts (List[Union[str, Image.Image]]): The input parts for the model.
-        system_instruction_update (str, optional): Additional system instructions for this call.
+        system_instruction_update (str, optional): Replacement static system instruction.
+        user_context (str, optional): Per-user dynamic instructions (profile, date), kept
+            out of the cacheable static instruction.
+        user_id (int, optional): Authenticated user, charged against their quotas.
         
     Returns:
         str: The generated response from the model.
     """
-    # Crée un nouveau modèle si une instruction système mise à jour est fournie
-    if system_instruction_update:
-        updated_model = genai.GenerativeModel(
-            model_name="gemini-2.5-flash",
-            generation_config=generation_config,
-            system_instruction=system_instruction_update
-        )
-        response = updated_model.generate_content(prompt_parts)
-    else:
-        response = model.generate_content(prompt_parts)
-        
+    request = _routed_request(prompt_parts, system_instruction_update, user_context, user_id=user_id)
+    response = await _generate(request)
     return response.text
  
+# ──────────────────────────────────────────────────────────────────────────────
+# Extraction structurée d'ordonnance
+# ──────────────────────────────────────────────────────────────────────────────
+# À incrémenter à chaque modification du prompt ou du schéma
+EXTRACTION_PROMPT_VERSION = "v2"
+ 
+extraction_instruction = """
+Tu extrais les médicaments d'une photo d'ordonnance.
+Pour chaque médicament, donne :
+- "nom" : le nom du médicament tel qu'écrit,
+- "dose" : la posologie ou le dosage (ex: 500 mg, 20 mg cp), ou null si absent,
+- "frequence" : la fréquence et la durée de la prise (ex: 2 fois par jour pendant 7 jours).
+"reponse_textuelle" est une phrase courte destinée au patient.
+Si l'image n'est pas une ordonnance ou n'est pas lisible, renvoie une liste "medicaments" vide
+et explique-le dans "reponse_textuelle". Ne donne aucun conseil médical.
+"""
+ 
+MEDICATION_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "reponse_textuelle": {"type": "STRING"},
+        "medicaments": {
+            "type": "ARRAY",
+            "items": {
+                "type": "OBJECT",
+                "properties": {
+                    "nom": {"type": "STRING"},
+                    "dose": {"type": "STRING", "nullable": True},
+                    "frequence": {"type": "STRING"},
+                },
+                "required": ["nom", "frequence"],
+            },
+        },
+    },
+    "required": ["reponse_textuelle", "medicaments"],
+}
+ 
+_extractions = metrics.counter("llm_extraction_total", "Extractions structurées par issue (ok, empty, parse_error, cached)")
+metrics.gauge("llm_extraction_parse_failure_rate", "Part des extractions dont la sortie est invalide").set_function(
+    lambda: _extractions.value(outcome="parse_error") / max(
+        sum(_extractions.value(outcome=o) for o in ("ok", "empty", "parse_error")), 1)
+)
+ 
+def _canonicalize_medications(extraction: ExtractionOrdonnance) -> ExtractionOrdonnance:
+    """
+    Cherche les noms lus par le modèle dans le référentiel local : l'entrée
+    retrouvée et la DCI sont renseignées à côté, le nom lu n'est pas modifié.
+    """
+    index = get_drug_index()
+    for med in extraction.medicaments:
+        match = index.lookup(med.nom)
+        med.nom_reference = match.entry.nom if match else None
+        med.score = round(match.score, 2) if match else None
+        if match is not None:
+            med.composant = match.entry.substance
+    return extraction
+
+@recorded("extract_medications")
+async def extract_medications(
+    prompt_parts: List[Union[str, Image.Image]],
+    system_instruction_update: str | None = None,
+    lane: str = LANE_EXTRACTION,
+    user_id: int | None = None
+) -> ExtractionOrdonnance | None:
+    """
+    Appel dédié à l'extraction : sortie JSON contrainte par MEDICATION_SCHEMA,
+    validée par pydantic. Retourne None si la sortie est inexploitable.
+    `lane` permet aux traitements de masse de passer en voie "batch".
+    Les résultats sont mis en cache par modèle, EXTRACTION_PROMPT_VERSION et contenu du tour.
+    """
+    route = get_router().choose(prompt_parts)
+    cache = get_extraction_cache() if system_instruction_update is None else None
+    key = None
+    if cache is not None:
+        key = await asyncio.to_thread(cache_key, prompt_parts, EXTRACTION_PROMPT_VERSION, route.model)
+        cached = await asyncio.to_thread(cache.get, key) if key else None
+        if cached is not None:
+            try:
+                extraction = ExtractionOrdonnance.model_validate(cached)
+            except ValidationError:
+                logger.warning(f"Entrée de cache d'extraction invalide ({key[:12]}), ignorée")
+            else:
+                _extractions.inc(outcome="cached")
+                return _canonicalize_medications(extraction)
+
+    request = LLMRequest(
+        parts=prompt_parts,
+        model=route.model,
+        system_instruction=system_instruction_update or extraction_instruction,
+        generation_config={
+            **generation_config,
+            "temperature": 0,
+            "max_output_tokens": route.max_output_tokens,
+            "response_mime_type": "application/json",
+            "response_schema": MEDICATION_SCHEMA,
+        },
+        route=route.name,
+        lane=lane,
+        user_id=user_id,
+    )
+    response = await _generate(request)
+    try:
+        extraction = ExtractionOrdonnance.model_validate_json(response.text)
+    except ValidationError as e:
+        _extractions.inc(outcome="parse_error")
+        logger.warning(f"Sortie d'extraction invalide ({len(response.text)} caractères): {e.error_count()} erreur(s)")
+        return None
+    _extractions.inc(outcome="ok" if extraction.medicaments else "empty")
+    _canonicalize_medications(extraction)
+    if key:
+        try:
+            await asyncio.to_thread(cache.put, key, extraction.model_dump(mode="json"))
+        except OSError as e:
+            logger.warning(f"Écriture du cache d'extraction impossible: {e}")
+    return extraction
+ 
 if __name__ == '__main__':
     while True:
         user_input = input("Enter your prompt: ")
         if user_input.lower() == "exit":
             break
-        response = generate_response(user_input)
+        response = asyncio.run(generate_response([user_input]))
         print(f"Model Response: {response}")
  
  
@@ -154,66 +331,60 @@ def _call_calendar_api(tool_name: str, args: dict, cookies: dict | None = None):
         return r.json()
     return {"error": f"Unknown tool {tool_name}"}
  
-def generate_response_with_tools(
+# Exécuteur des tools, remplaçable (rejeu de cassettes)
+_tool_executor = _call_calendar_api
+ 
+def set_tool_executor(executor) -> None:
+    global _tool_executor
+    _tool_executor = executor
+ 
+@recorded("generate_response_with_tools")
+async def generate_response_with_tools(
     prompt_parts: List[Union[str, Image.Image]],
     system_instruction_update: str | None = None,
-    session_token: str | None = None
+    session_token: str | None = None,
+    user_context: str | None = None,
+    user_id: int | None = None
 ) -> str:
     """
     Variante qui permet à Gemini d'appeler des tools (calendar).
     - session_token: le cookie 'session_token' du user pour authentifier les appels API
+    - user_context: instructions propres à l'utilisateur, hors cache de contexte
+    - user_id: utilisateur authentifié, décompté de ses quotas
     """
-    used_model = genai.GenerativeModel(
-        model_name="gemini-2.5-flash",
-        generation_config=generation_config,
-        system_instruction=(system_instruction_update or system_instruction),
-        tools=CALENDAR_TOOLS
-    )
+    request = _routed_request(prompt_parts, system_instruction_update, user_context, tools=CALENDAR_TOOLS, user_id=user_id)
  
     # 1er tour
-    resp = used_model.generate_content(prompt_parts)
+    resp = await _generate(request)
  
     # Boucle de tool-calls (max 3)
     for _ in range(3):
-        function_calls = []
- 
-        # ✅ Les objets du SDK ont des ATTRIBUTS (pas .get)
-        for cand in getattr(resp, "candidates", []) or []:
-            content = getattr(cand, "content", None)
-            if not content:
-                continue
-            for part in getattr(content, "parts", []) or []:
-                fc = getattr(part, "function_call", None)
-                if fc:
-                    name = getattr(fc, "name", None)
-                    args = dict(getattr(fc, "args", {}) or {})
-                    if name:
-                        function_calls.append({"name": name, "args": args})
- 
-        if not function_calls:
+        if not resp.function_calls:
             break
  
         tool_outputs = []
         cookies = {"session_token": session_token} if session_token else None
  
-        for fc in function_calls:
-            name = fc["name"]
-            args = fc.get("args", {})
-            result = _call_calendar_api(name, args, cookies=cookies)
+        for fc in resp.function_calls:
+            # Appel HTTP bloquant → hors de la boucle asyncio
+            t0 = time.perf_counter()
+            try:
+                result = await asyncio.to_thread(_tool_executor, fc.name, fc.args, cookies)
+            except Exception as e:
+                # L'erreur est rendue au modèle plutôt que de relancer tout le tour
+                logger.warning(f"Tool {fc.name} en échec: {e}")
+                result = {"error": str(e)}
+            record_tool_call(fc.name, time.perf_counter() - t0)
  
             tool_outputs.append({
                 "function_response": {
-                    "name": name,
+                    "name": fc.name,
                     "response": result
                 }
             })
  
         # 2e tour : on renvoie les résultats tools au modèle
-        resp = used_model.generate_content(
-            [
-                *prompt_parts,
-                *tool_outputs
-            ]
-        )
- 
-    return resp.text
\ No newline at end of file
+        request.parts = [*prompt_parts, *tool_outputs]
+        resp = await _generate(request)
+ 
+    return resp.text
@@ -0,0 +1,55 @@
+"""
+Référentiel médicaments : une molécule voisine absente du référentiel ne doit
+jamais être prise pour une autre, et le nom lu n'est jamais remplacé.
+
+    python -m pytest tests
+"""
+import pytest
+
+from services.drug_index import DEFAULT_REFERENCE_FILE, DrugIndex
+from services.ordo_extract import _meds_as_dicts
+
+
+@pytest.fixture(scope="module")
+def index():
+    return DrugIndex.from_file(DEFAULT_REFERENCE_FILE)
+
+
+@pytest.mark.parametrize("name", [
+    "Prazépam",        # ≠ Lorazépam
+    "Nordazépam",      # ≠ Lorazépam
+    "Tétrazépam",      # ≠ Lorazépam
+    "Clobazam",        # ≠ Clonazépam
+    "Oxcarbazépine",   # ≠ Carbamazépine
+    "Vildagliptine",   # ≠ Sitagliptine
+    "Dafalgan codéine",  # ≠ Dafalgan (pas de repli sur le premier mot)
+])
+def test_near_miss_drugs_are_not_matched(index, name):
+    assert index.lookup(name) is None
+
+
+@pytest.mark.parametrize("name, expected", [
+    ("Lorazépam", "Lorazépam"),
+    ("LORAZEPAM", "Lorazépam"),
+    ("L0RAZEPAM", "Lorazépam"),
+    ("PARACETAMQL", "Paracétamol"),
+    ("PRQZAC", "Prozac"),
+    ("AMOXlClLLINE", "Amoxicilline"),
+])
+def test_exact_and_ocr_noisy_names_are_matched(index, name, expected):
+    match = index.lookup(name)
+    assert match is not None and match.entry.nom == expected
+
+
+def test_ambiguous_match_is_rejected():
+    index = DrugIndex([("Alpha", "Substance A"), ("Alphb", "Substance B")], min_score=0.5)
+    assert index.lookup("Alphc") is None
+    assert index.lookup("Alpha").entry.nom == "Alpha"
+
+
+def test_meds_keep_the_name_as_read():
+    meds = _meds_as_dicts("Prazepam 10 mg 1/jour\nPARACETAMQL 1 g 3/jour\n")
+    assert [m["nom"] for m in meds] == ["Prazepam", "PARACETAMQL"]
+    assert meds[0]["nom_reference"] is None and meds[0]["composant"] is None and not meds[0]["reconnu"]
+    assert meds[1]["nom_reference"] == "Paracétamol" and meds[1]["reconnu"]
+    assert 0.8 <= meds[1]["score"] < 1
@@ -0,0 +1,51 @@
+"""
+Cache d'extraction (services/extraction_cache.py) : une seule source de temps
+pour l'expiration, et une clé qui change avec le modèle et le prompt.
+
+    python -m pytest tests
+"""
+import os
+import time
+
+from PIL import Image
+
+from services.extraction_cache import ExtractionCache, cache_key
+
+
+def _age(cache: ExtractionCache, key: str, seconds: float) -> None:
+    path = cache._path(key)
+    past = time.time() - seconds
+    os.utime(path, (past, past))
+
+
+def test_entry_expires_from_write_time_even_if_read_often(tmp_path):
+    cache = ExtractionCache(directory=str(tmp_path), ttl=100, max_bytes=10_000)
+    cache.put("ab01", {"medicaments": []})
+    _age(cache, "ab01", 50)
+    assert cache.get("ab01") == {"medicaments": []}
+    assert time.time() - os.stat(cache._path("ab01")).st_mtime >= 50  # la lecture ne prolonge pas l'entrée
+    _age(cache, "ab01", 150)
+    assert cache.get("ab01") is None
+    assert not os.path.exists(cache._path("ab01"))
+
+
+def test_eviction_removes_expired_entries_before_recently_read_ones(tmp_path):
+    cache = ExtractionCache(directory=str(tmp_path), ttl=100, max_bytes=10_000)
+    cache.put("aa01", {"n": 1})
+    cache.put("bb02", {"n": 2})
+    _age(cache, "aa01", 150)
+    os.utime(cache._path("aa01"), (time.time(), os.stat(cache._path("aa01")).st_mtime))  # lue à l'instant
+    _age(cache, "bb02", 10)
+    cache._evict()
+    assert not os.path.exists(cache._path("aa01"))
+    assert os.path.exists(cache._path("bb02"))
+
+
+def test_key_depends_on_model_prompt_version_and_text():
+    image = Image.new("RGB", (40, 40), "white")
+    base = cache_key([image], "v2", "gemini-a")
+    assert base == cache_key([image], "v2", "gemini-a")
+    assert base != cache_key([image], "v3", "gemini-a")
+    assert base != cache_key([image], "v2", "gemini-b")
+    assert base != cache_key([image, "Texte lu par OCR : Doliprane"], "v2", "gemini-a")
+    assert cache_key(["texte seul"], "v2", "gemini-a") is None
@@ -0,0 +1,38 @@
+"""
+Extraction regex des posologies (services/ordo_extract.py) : dose, fréquence
+et durée sur les formes courantes des ordonnances.
+
+    python -m pytest tests
+"""
+import pytest
+
+from services.ordo_extract import MedItem, _parse_meds_from_text
+
+
+@pytest.mark.parametrize("line, expected", [
+    ("Doxycycline 100 mg 1 cp/jour pendant 3 mois", MedItem("Doxycycline", "1/jour", "100 mg", "3 mois")),
+    ("Amoxicilline 500 mg 2 gél/jour 7 jours", MedItem("Amoxicilline", "2/jour", "500 mg", "7 jours")),
+    ("Kardegic 75 mg 1 sachet/jour", MedItem("Kardegic", "1/jour", "75 mg")),
+    ("Vitamine D 1 ampoule/mois", MedItem("Vitamine D", "1/mois")),
+    ("Ibuprofène 400 mg 1 cp / jour", MedItem("Ibuprofène", "1/jour", "400 mg")),
+    ("Lévothyrox 50 µg 1 cp par jour", MedItem("Lévothyrox", "1/jour", "50 µg")),
+    ("Paracétamol 1 g 1 cp x 3/jour", MedItem("Paracétamol", "3/jour", "1 g")),
+    ("Spasfon 2 cp x 3 par jour", MedItem("Spasfon", "3/jour", "2 cp")),
+    ("Doliprane 1000 mg 1 comprimé 3 fois par jour pendant 5 jours",
+     MedItem("Doliprane", "3/jour", "1000 mg", "5 jours")),
+    ("Augmentin 1 g 1 cp matin et soir 8 j", MedItem("Augmentin", "2/jour", "1 g", "8 jours")),
+    ("Doliprane 1 cp toutes les 6 h", MedItem("Doliprane", "4/jour", "1 cp")),
+    ("Advil 2/jour", MedItem("Advil", "2/jour")),
+])
+def test_posologies(line, expected):
+    assert _parse_meds_from_text(line) == [expected]
+
+
+def test_posologie_on_next_line():
+    text = "Amoxicilline 1 g\n1 cp matin et soir pendant 7 jours\n"
+    assert _parse_meds_from_text(text) == [MedItem("Amoxicilline", "2/jour", "1 g", "7 jours")]
+
+
+def test_lines_without_posologie_are_ignored():
+    text = "Dr Lefebvre  dermatologue\nVentoline 100 µg 2 bouffées si gêne\nFait a Lyon le 2/11/2023\n"
+    assert _parse_meds_from_text(text) == []
@@ -0,0 +1,30 @@
+"""
+Routage des appels LLM (services/routing.py) : la route légère ne doit pas
+retirer les outils d'une confirmation courte.
+
+    python -m pytest tests
+"""
+import pytest
+from PIL import Image
+
+from services.routing import DEFAULT_ROUTES_FILE, ModelRouter
+
+
+@pytest.fixture(scope="module")
+def router():
+    return ModelRouter.from_file(DEFAULT_ROUTES_FILE)
+
+
+@pytest.mark.parametrize("message", ["oui, ajoute-le", "ok vas-y", "non, supprime-le plutôt"])
+def test_short_confirmations_keep_tools(router, message):
+    route = router.choose([message], tools_available=True)
+    assert route.name == "light" and route.tools
+
+
+def test_calendar_intent_goes_to_the_full_route(router):
+    assert router.choose(["Ajoute un rendez-vous demain à 10h"], tools_available=True).name == "full"
+
+
+def test_long_or_image_turns(router):
+    assert router.choose(["x" * (router.light_max_chars + 1)]).name == "full"
+    assert router.choose(["Que dit cette ordonnance ?", Image.new("RGB", (8, 8))]).name == "multimodal"
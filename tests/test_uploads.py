@@ -0,0 +1,91 @@
+"""
+Réception en flux des fichiers de scan (server/uploads.py) : un fichier trop
+gros est refusé dès que la limite est franchie, sans lire le reste du corps.
+
+    python -m pytest tests
+"""
+import asyncio
+import hashlib
+import os
+
+import pytest
+from fastapi import HTTPException
+from starlette.requests import Request
+
+from server.uploads import receive_multipart
+
+BOUNDARY = "----scan"
+
+
+def _body(content: bytes, filename: str = "ordo.jpg") -> bytes:
+    return (
+        f"--{BOUNDARY}\r\n"
+        'Content-Disposition: form-data; name="valid_until"\r\n\r\n'
+        "2030-01-01\r\n"
+        f"--{BOUNDARY}\r\n"
+        f'Content-Disposition: form-data; name="image"; filename="{filename}"\r\n'
+        "Content-Type: image/jpeg\r\n\r\n"
+    ).encode() + content + f"\r\n--{BOUNDARY}--\r\n".encode()
+
+
+class _ChunkedRequest:
+    """Requête ASGI dont le corps arrive par blocs ; compte les blocs lus."""
+
+    def __init__(self, body: bytes, chunk_size: int = 1024):
+        self.chunks = [body[i:i + chunk_size] for i in range(0, len(body), chunk_size)]
+        self.received = 0
+        scope = {
+            "type": "http", "method": "POST", "path": "/ordonnances/scan",
+            "headers": [(b"content-type", f"multipart/form-data; boundary={BOUNDARY}".encode())],
+        }
+        self.request = Request(scope, self.receive)
+
+    async def receive(self):
+        chunk = self.chunks[self.received]
+        self.received += 1
+        return {"type": "http.request", "body": chunk, "more_body": self.received < len(self.chunks)}
+
+
+def test_upload_is_hashed_and_written_to_disk(tmp_path):
+    content = os.urandom(50_000)
+    source = _ChunkedRequest(_body(content))
+    form = asyncio.run(receive_multipart(source.request, "image", directory=str(tmp_path)))
+    try:
+        assert form.fields == {"valid_until": "2030-01-01"}
+        [staged] = form.files
+        assert staged.size == len(content)
+        assert staged.sha256 == hashlib.sha256(content).hexdigest()
+        assert staged.filename == "ordo.jpg" and staged.content_type == "image/jpeg" and not staged.is_pdf
+        with open(staged.path, "rb") as f:
+            assert f.read() == content
+    finally:
+        form.discard()
+    assert os.listdir(tmp_path) == []
+
+
+def test_oversized_upload_is_rejected_without_reading_the_whole_body(tmp_path):
+    source = _ChunkedRequest(_body(b"x" * 1_000_000))
+    with pytest.raises(HTTPException) as exc:
+        asyncio.run(receive_multipart(source.request, "image", directory=str(tmp_path), max_bytes=10_000))
+    assert exc.value.status_code == 413
+    # arrêt juste après la limite : ~10 Ko lus sur ~1 Mo
+    assert source.received < 20 < len(source.chunks)
+    assert os.listdir(tmp_path) == []
+
+
+def test_declared_length_above_the_limit_is_rejected_before_reading(tmp_path):
+    source = _ChunkedRequest(_body(b"x" * 100))
+    source.request.scope["headers"].append((b"content-length", b"%d" % (50 * 1024 * 1024)))
+    with pytest.raises(HTTPException) as exc:
+        asyncio.run(receive_multipart(source.request, "image", directory=str(tmp_path), max_bytes=10_000))
+    assert exc.value.status_code == 413
+    assert source.received == 0
+
+
+def test_too_many_files_are_rejected(tmp_path):
+    part = _body(b"abc").split(f"--{BOUNDARY}--".encode())[0]
+    source = _ChunkedRequest(part + part[part.index(f"--{BOUNDARY}".encode(), 1):] + f"--{BOUNDARY}--\r\n".encode())
+    with pytest.raises(HTTPException) as exc:
+        asyncio.run(receive_multipart(source.request, "image", directory=str(tmp_path)))
+    assert exc.value.status_code == 413
+    assert os.listdir(tmp_path) == []